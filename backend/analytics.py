@@ -0,0 +1,154 @@
+"""
+SMS Platform - Analytics
+Incrementally maintained, time-bucketed message counters
+"""
+
+import marshal
+import threading
+import time
+from collections import deque
+from typing import Dict, Iterable, List, Tuple
+
+MINUTE = 60
+HOUR = 3600
+DAY = 86400
+RESOLUTIONS = (MINUTE, HOUR, DAY)
+
+# Counter slots in each bucket
+SENT, DELIVERED, FAILED, SEGMENTS, COST = range(5)
+FIELDS = ('sent', 'delivered', 'failed', 'segments', 'cost')
+DELIVERY_SLOTS = {'delivered': DELIVERED, 'failed': FAILED}
+
+
+class Rollups:
+    """
+    Per-minute, per-hour and per-day counters of sent, delivered and failed
+    messages, segments and cost, keyed by the (UTC-aligned) start of each
+    bucket. Events update three buckets; a window query sums at most a few
+    hundred buckets no matter how many messages it covers.
+    Minute buckets older than `minute_retention` seconds are dropped and
+    windows reaching that far back are answered at hour granularity.
+    """
+    def __init__(self, minute_retention: int = 2 * DAY):
+        self.minute_retention = minute_retention
+        self._buckets: Dict[int, Dict[int, List]] = {resolution: {} for resolution in RESOLUTIONS}
+        self._minute_order = deque()
+        self._totals = [0, 0, 0, 0, 0.0]
+        self._lock = threading.Lock()
+        # Bumped by every recorded event
+        self.generation = 0
+
+    def _add(self, ts: float, slot: int, amount) -> None:
+        recent = ts >= time.time() - self.minute_retention
+        for resolution, buckets in self._buckets.items():
+            if resolution == MINUTE and not recent:
+                continue
+            start = int(ts // resolution) * resolution
+            bucket = buckets.get(start)
+            if bucket is None:
+                bucket = buckets[start] = [0, 0, 0, 0, 0.0]
+                if resolution == MINUTE:
+                    self._minute_order.append(start)
+                    self._prune_minutes()
+            bucket[slot] += amount
+        self._totals[slot] += amount
+
+    def _prune_minutes(self) -> None:
+        cutoff = time.time() - self.minute_retention
+        order = self._minute_order
+        minutes = self._buckets[MINUTE]
+        while order and order[0] < cutoff:
+            minutes.pop(order.popleft(), None)
+
+    def record_sent(self, ts: float, segments: int, cost: float) -> None:
+        """Count a message sent at epoch `ts`"""
+        with self._lock:
+            self.generation += 1
+            self._add(ts, SENT, 1)
+            self._add(ts, SEGMENTS, segments)
+            self._add(ts, COST, cost)
+
+    def record_delivery(self, ts: float, old_status: str, new_status: str) -> None:
+        """Move a message sent at `ts` between delivery outcomes"""
+        self.record_deliveries([(ts, old_status, new_status)])
+
+    def record_deliveries(self, events: Iterable[Tuple[float, str, str]]) -> None:
+        """Record many (ts, old_status, new_status) changes under one lock acquisition"""
+        with self._lock:
+            self.generation += 1
+            for ts, old_status, new_status in events:
+                if old_status in DELIVERY_SLOTS:
+                    self._add(ts, DELIVERY_SLOTS[old_status], -1)
+                if new_status in DELIVERY_SLOTS:
+                    self._add(ts, DELIVERY_SLOTS[new_status], 1)
+
+    def dump(self) -> bytes:
+        """Every counter as one marshalled blob, for a snapshot"""
+        with self._lock:
+            return marshal.dumps((self._buckets, list(self._minute_order), self._totals))
+
+    def restore(self, data) -> None:
+        """Replace every counter with a dump's (startup only)"""
+        buckets, minute_order, totals = marshal.loads(data)
+        with self._lock:
+            self.generation += 1
+            self._buckets = buckets
+            self._minute_order = deque(minute_order)
+            self._totals = totals
+            self._prune_minutes()
+
+    def _spans(self, since: int, until: int) -> List[Tuple[int, int]]:
+        """Cover minute-aligned [since, until) with the fewest (resolution, bucket_start) pieces"""
+        spans = []
+        cutoff = time.time() - self.minute_retention
+        while since < until:
+            for resolution in (DAY, HOUR, MINUTE):
+                if since % resolution == 0 and since + resolution <= until:
+                    break
+            if resolution == MINUTE and since < cutoff:
+                # Minute buckets are gone this far back; use the enclosing hour
+                resolution = HOUR
+                since -= since % HOUR
+            spans.append((resolution, since))
+            since += resolution
+        return spans
+
+    def window(self, since: float = None, until: float = None) -> Dict:
+        """Totals for messages sent in [since, until); None means unbounded"""
+        with self._lock:
+            if since is None and until is None:
+                values = list(self._totals)
+            else:
+                if since is None:
+                    since = min(self._buckets[DAY], default=0)
+                if until is None:
+                    until = time.time() + MINUTE
+                start = int(since // MINUTE) * MINUTE
+                end = -(-int(until) // MINUTE) * MINUTE
+                values = [0, 0, 0, 0, 0.0]
+                for resolution, bucket_start in self._spans(start, end):
+                    bucket = self._buckets[resolution].get(bucket_start)
+                    if bucket is not None:
+                        for slot in range(len(values)):
+                            values[slot] += bucket[slot]
+        return summarize(values)
+
+    def series(self, since: float, until: float, resolution: int) -> List[Dict]:
+        """Per-bucket counters between `since` and `until` at one resolution"""
+        start = int(since // resolution) * resolution
+        points = []
+        with self._lock:
+            buckets = self._buckets[resolution]
+            for bucket_start in range(start, int(until), resolution):
+                bucket = buckets.get(bucket_start)
+                if bucket is not None:
+                    points.append({'start': bucket_start, **summarize(bucket)})
+        return points
+
+
+def summarize(values) -> Dict:
+    summary = dict(zip(FIELDS, values))
+    summary['cost'] = round(summary['cost'], 2)
+    sent = summary['sent']
+    summary['delivery_rate'] = round(summary['delivered'] / sent * 100, 2) if sent else 0
+    return summary
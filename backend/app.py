@@ -1,34 +1,756 @@
-from flask import Flask, request, jsonify
+from flask import Flask, Response, g, request, jsonify, stream_with_context
 from flask_cors import CORS
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
+from functools import wraps
+from operator import itemgetter
+import atexit
+import csv
+import hmac
+import io
 import json
+import math
+import random
+import time
 
 # Import local modules
 from config import get_config
-from models import Message, Contact, ScheduledMessage, Analytics
+from models import US, Message, Contact, ScheduledMessage, Analytics
 from utils import (
     validate_phone_number, 
     validate_message_content,
     format_phone_number,
+    format_utc,
     calculate_message_segments,
+    calculate_segments_batch,
     estimate_cost,
+    iter_contact_rows,
     parse_scheduled_time,
-    sanitize_input
+    parse_timestamp,
+    sanitize_input,
+    validate_batch
 )
+from scheduler import Scheduler
+from analytics import DAY, HOUR, MINUTE, Rollups
+from cache import ResponseCache
+from delivery import DeliveryQueue, create_provider
+from indexes import scheduled_due_us
+from idempotency import IdempotencyCache, IdempotencyConflict, fingerprint
+from journal import Journal, JournalError
+from metrics import Metrics
+from profiler import SamplingProfiler
+from ratelimit import SharedTokenBuckets
+from receipts import ReceiptProcessor, receipt_status
+from repository import Repository
+from snapshot import SnapshotWriter, open_snapshot
+from storage import open_storage
+from tags import bitmap_contains, bitmap_ids
+from templates import compile_template
 
 # Initialize Flask app
 app = Flask(__name__)
 app.config.from_object(get_config())
 CORS(app, origins=app.config['CORS_ORIGINS'])
 
-# In-memory storage (replace with database in production)
-messages = []
-contacts = [
+SEED_CONTACTS = [
     {'id': 1, 'name': 'John Doe', 'phone': '+1 234 567 8901', 'messages': 45},
     {'id': 2, 'name': 'Jane Smith', 'phone': '+1 234 567 8902', 'messages': 32},
     {'id': 3, 'name': 'Bob Johnson', 'phone': '+1 234 567 8903', 'messages': 28},
 ]
-scheduled_messages = []
+
+# Persistent storage (write-behind SQLite, see DATABASE_URL)
+storage = open_storage(
+    app.config['DATABASE_URL'],
+    batch_size=app.config['DATABASE_BATCH_SIZE'],
+    flush_interval=app.config['DATABASE_FLUSH_INTERVAL']
+)
+
+rollups = Rollups(minute_retention=app.config['ANALYTICS_MINUTE_RETENTION'])
+
+
+def store_recovered(recovered):
+    """Write rows recovered from the journals of crashed workers to storage"""
+    for row in recovered.get('messages', ()):
+        storage.save_message(Message.from_dict(row))
+    for contact in recovered.get('contacts', ()):
+        storage.save_contact(contact)
+    for entry in recovered.get('scheduled_messages', ()):
+        storage.save_scheduled(entry)
+    for template in recovered.get('templates', ()):
+        storage.save_template(template)
+    for row in recovered.get('idempotency_keys', ()):
+        storage.save_idempotency(*row)
+    storage.flush()
+
+
+# Write-ahead journal: changes are fsynced (in groups) before a request is acknowledged.
+# What crashed workers journaled goes to storage before the stores load from it.
+journal = None
+recovered = {}
+if app.config['JOURNAL_DIR']:
+    journal = Journal(app.config['JOURNAL_DIR'], commit_window=app.config['JOURNAL_COMMIT_WINDOW'])
+    recovered = journal.recover()
+    if storage is not None and recovered:
+        store_recovered(recovered)
+
+
+def message_time(msg):
+    """Epoch seconds a message was sent at"""
+    return msg.timestamp_us / US
+
+
+def record_history(msgs):
+    """Count messages that are already stored in the analytics rollups"""
+    for msg, segments in zip(msgs, calculate_segments_batch(msg.message for msg in msgs)):
+        sent_at = message_time(msg)
+        rollups.record_sent(sent_at, segments, estimate_cost(msg.message, segments=segments))
+        rollups.record_delivery(sent_at, None, msg.delivery_status)
+
+
+def record_changes(changes):
+    """Count what Repository.catch_up() added and changed in the analytics rollups"""
+    added, delivery_changes = changes
+    record_history(added)
+    rollups.record_deliveries((message_time(msg), old_status, msg.delivery_status)
+                              for msg, old_status in delivery_changes)
+
+
+def restore_snapshot(snapshot):
+    """
+    Stores and rollups from a snapshot, brought up to date with what storage
+    gained since it was taken. Returns the Repository, or None when storage
+    changed in a way the snapshot cannot take.
+    """
+    restored = Repository(storage, journal=journal)
+    restored.restore(snapshot.sections)
+    if storage is not None:
+        since = snapshot.meta.get('synced', 0)
+        synced = storage.change_sequence()
+        if synced < since:
+            # Taken against another database
+            return None
+        changes = restored.catch_up(
+            messages=storage.load_messages(since),
+            contacts=storage.load_contacts(since),
+            scheduled=storage.load_scheduled(since),
+            templates=storage.load_templates(since)
+        )
+        if changes is None:
+            return None
+        storage.synced = synced
+    rollups.restore(snapshot.sections['rollups'])
+    if storage is not None:
+        record_changes(changes)
+    return restored
+
+
+# Thread-safe stores shared by request threads, delivery workers and the scheduler,
+# restored from the latest snapshot when there is a usable one
+repository = None
+if app.config['SNAPSHOT_PATH']:
+    snapshot = open_snapshot(app.config['SNAPSHOT_PATH'])
+    if snapshot is not None:
+        repository = restore_snapshot(snapshot)
+if repository is None:
+    repository = Repository(storage, journal=journal)
+    if storage is not None:
+        synced = storage.change_sequence()
+        stored_contacts = storage.load_contacts()
+        if not stored_contacts:
+            for contact in SEED_CONTACTS:
+                storage.save_contact(contact)
+            storage.flush()
+        repository.load(
+            messages=(Message.from_dict(row) for row in storage.load_messages()),
+            contacts=stored_contacts or SEED_CONTACTS,
+            scheduled=storage.load_scheduled(),
+            templates=storage.load_templates()
+        )
+        storage.synced = max(storage.synced, synced)
+    else:
+        repository.load(contacts=SEED_CONTACTS)
+    record_history(repository.messages)
+if storage is None and recovered:
+    # Without storage the journal is replayed into memory; rows already there are updated
+    changes = repository.catch_up(
+        messages=recovered.get('messages', ()),
+        contacts=recovered.get('contacts', ()),
+        scheduled=recovered.get('scheduled_messages', ()),
+        templates=recovered.get('templates', ())
+    )
+    if changes is not None:
+        record_changes(changes)
+
+# Module-level names for the stores and indexes
+messages = repository.messages
+contacts = repository.contacts
+scheduled_messages = repository.scheduled
+message_index = repository.message_index
+contact_index = repository.contact_index
+tag_index = repository.tag_index
+templates = repository.templates
+
+
+def capture_snapshot():
+    """Sections and metadata of a snapshot of every store and the rollups"""
+    if storage is not None:
+        storage.flush()
+    # Read first: every change stored up to it is already in memory
+    synced = storage.synced if storage is not None else 0
+    sections = repository.dump()
+    # Events of writes still in progress may land on either side of the dump
+    sections['rollups'] = rollups.dump()
+    return sections, {'synced': synced, 'taken_at': time.time()}
+
+
+snapshots = None
+if app.config['SNAPSHOT_PATH']:
+    snapshots = SnapshotWriter(app.config['SNAPSHOT_PATH'], capture_snapshot,
+                               interval=app.config['SNAPSHOT_INTERVAL'])
+    snapshots.start()
+    # Registered after storage, so it runs first and storage is still open
+    atexit.register(snapshots.stop)
+
+
+def store_message(msg, segments, cost):
+    """Add a message to the store, its indexes, analytics and storage"""
+    repository.add_message(msg)
+    rollups.record_sent(message_time(msg), segments, cost)
+
+
+def set_delivery_status(msg, delivery_status):
+    """Change a message's delivery status and keep indexes and analytics current"""
+    old_status = repository.update_message(msg, delivery_status=delivery_status)['delivery_status']
+    if old_status != delivery_status:
+        rollups.record_delivery(message_time(msg), old_status, delivery_status)
+
+
+def on_delivery_result(msg, provider_message_id, error):
+    """Record the outcome of handing a message to the provider"""
+    if error is None:
+        repository.update_message(msg, provider_message_id=provider_message_id, status='sent')
+    else:
+        repository.update_message(msg, status='failed')
+        set_delivery_status(msg, 'failed')
+
+
+delivery = DeliveryQueue(
+    create_provider(app.config),
+    on_delivery_result,
+    workers=app.config['DELIVERY_WORKERS'],
+    maxsize=app.config['DELIVERY_QUEUE_SIZE'],
+    max_retries=app.config['DELIVERY_MAX_RETRIES'],
+    backoff=app.config['DELIVERY_RETRY_BACKOFF']
+)
+delivery.start()
+
+
+def queue_message(msg, block=False):
+    """Hand a stored message to the delivery workers; False if the queue was full"""
+    if not delivery.submit(msg, msg.phone, msg.message, block=block):
+        on_delivery_result(msg, None, 'Delivery queue is full')
+        return False
+    return True
+
+
+# Messages accepted but never handed to the provider before a restart. Only the first
+# worker to open the database re-queues them: workers still running are sending their own
+if storage is None or storage.first_process:
+    for msg in message_index.query(status='queued', limit=len(messages))[0]:
+        queue_message(msg, block=True)
+
+
+def apply_receipts(batch):
+    """Apply a batch of delivery receipts; returns those matching no message yet"""
+    updates = []
+    unmatched = []
+    for receipt in batch:
+        msg = message_index.get_by_provider_id(receipt[0])
+        if msg is None:
+            unmatched.append(receipt)
+        else:
+            updates.append((msg, {'delivery_status': receipt[1]}))
+    if unmatched and storage is not None:
+        # Receipts for messages another worker sent reach that worker's messages through the database
+        stored = {row['provider_message_id'] for row in storage.update_delivery_statuses(
+            receipt[:2] for receipt in unmatched)}
+        unmatched = [receipt for receipt in unmatched if receipt[0] not in stored]
+    if not updates:
+        return unmatched
+    previous = repository.update_messages(updates)
+    rollups.record_deliveries([
+        (message_time(msg), old['delivery_status'], changes['delivery_status'])
+        for (msg, changes), old in zip(updates, previous)
+        if old['delivery_status'] != changes['delivery_status']
+    ])
+    return unmatched
+
+
+receipts = ReceiptProcessor(
+    apply_receipts,
+    batch_size=app.config['RECEIPT_BATCH_SIZE'],
+    flush_interval=app.config['RECEIPT_FLUSH_INTERVAL'],
+    match_ttl=app.config['RECEIPT_MATCH_TTL']
+)
+receipts.start()
+# Receipts crashed workers acknowledged but may not have applied
+for receipt in recovered.get('receipts', ()):
+    receipts.submit(*receipt)
+
+
+def checkpoint():
+    """Make every change applied so far durable without the journal"""
+    # Acknowledged receipts are only in the journal until they are applied
+    receipts.flush()
+    unmatched = receipts.unmatched()
+    if unmatched:
+        # Still waiting for their message, so they are carried into the new segment
+        journal.append('receipts', unmatched)
+        journal.commit()
+    if storage is not None:
+        # The journal segments are deleted next, so a flush that is not fsynced is not enough
+        storage.sync()
+    else:
+        snapshots.write()
+
+
+if journal is not None:
+    # Without storage or snapshots the journal is all that persists, so it is never compacted
+    compactable = storage is not None or snapshots is not None
+    if recovered and compactable:
+        journal.compact(checkpoint)
+    journal.start(checkpoint if compactable else None, app.config['JOURNAL_COMPACT_INTERVAL'])
+    # Registered last, so it runs before snapshots and storage are closed
+    atexit.register(journal.stop, checkpoint if compactable else None)
+
+
+def queue_full_response(needed=1):
+    """503 response when the delivery queue cannot take `needed` more messages"""
+    if delivery.available() >= needed:
+        return None
+    return queue_full_error()
+
+
+def queue_full_error():
+    response = jsonify({'error': 'Delivery queue is full, retry later'})
+    response.headers['Retry-After'] = '1'
+    return response, 503
+
+
+def dispatch_scheduled(batch):
+    """Send a batch of due scheduled entries; returns those that failed, for the scheduler to retry"""
+    failed = []
+    for item in batch:
+        entry, scheduled_at = item
+        # Claim the entry so it is sent once, however many workers dispatch it;
+        # one rescheduled since is left to its newer scheduler item
+        if not repository.update_scheduled(entry, expected_status='scheduled', expected_scheduled_at=scheduled_at,
+                                           status='sending'):
+            continue
+
+        try:
+            msg = Message(
+                phone=entry['phone'],
+                message=entry['message']
+            )
+            msg.status = 'queued'
+            segments = calculate_message_segments(msg.message)
+            store_message(msg, segments, estimate_cost(msg.message, segments=segments))
+            # Block rather than fail when a large send fills the queue
+            queue_message(msg, block=True)
+        except Exception:
+            app.logger.exception('Sending scheduled message %s failed', entry['id'])
+            # Released, so the retry can claim it again
+            repository.update_scheduled(entry, expected_status='sending', status='scheduled')
+            failed.append(item)
+            continue
+
+        repository.update_scheduled(entry, status='sent', sent_at=msg.timestamp, message_id=msg.id)
+    return failed
+
+
+scheduler = Scheduler(
+    dispatch_scheduled,
+    batch_size=app.config['SCHEDULER_BATCH_SIZE'],
+    retry_delay=app.config['SCHEDULER_RETRY_DELAY'],
+    max_retry_delay=app.config['SCHEDULER_MAX_RETRY_DELAY']
+)
+
+
+def schedule_dispatch(entry):
+    """Have the scheduler send an entry at its current due time"""
+    scheduler.schedule(scheduled_due_us(entry) / US, (entry, entry.get('scheduled_at')))
+
+
+# Every worker schedules the pending entries; the claim in dispatch_scheduled sends each once
+for entry in scheduled_messages:
+    if entry['status'] == 'scheduled':
+        schedule_dispatch(entry)
+if app.config['SCHEDULER_ENABLED']:
+    scheduler.start()
+
+# Rate limiting (token buckets shared by every worker on this host)
+rate_limiter = None
+recipient_limiter = None
+if app.config['RATE_LIMIT_ENABLED']:
+    rate_limiter = SharedTokenBuckets(
+        [(app.config['RATE_LIMIT_PER_HOUR'], 3600), (app.config['RATE_LIMIT_PER_DAY'], 86400)],
+        path=app.config['RATE_LIMIT_FILE'],
+        slots=app.config['RATE_LIMIT_SLOTS']
+    )
+    recipient_limiter = SharedTokenBuckets(
+        [(app.config['RECIPIENT_LIMIT_PER_HOUR'], 3600), (app.config['RECIPIENT_LIMIT_PER_DAY'], 86400)],
+        path=app.config['RECIPIENT_LIMIT_FILE'],
+        slots=app.config['RATE_LIMIT_SLOTS']
+    )
+
+
+def client_key():
+    """The caller's API key, or its IP address without a configured one"""
+    api_key = request.headers.get('X-API-Key')
+    # An unknown key would get a fresh bucket per request, so it counts as the IP
+    if api_key and api_key in app.config['API_KEYS']:
+        return f'key:{api_key}'
+    return f'ip:{request.remote_addr}'
+
+
+def charge(limiter, cost):
+    """Take `cost` tokens from the caller's buckets in `limiter`, or the error response"""
+    allowed, retry_after = limiter.consume(client_key(), cost)
+    if allowed:
+        return None
+    if math.isinf(retry_after):
+        # Waiting would never help: the cost is larger than a full bucket
+        capacity = int(min(capacity for capacity, _ in limiter.limits))
+        return jsonify({'error': f'Request costs {cost} rate limit tokens but at most {capacity} are available'}), 413
+    response = jsonify({'error': 'Rate limit exceeded'})
+    response.headers['Retry-After'] = str(max(1, math.ceil(retry_after)))
+    return response, 429
+
+
+def rate_limited(cost=None, recipients=None):
+    """
+    Charge the caller's API key (or IP) `cost()` tokens, or 1, before the view runs.
+    `recipients()` is charged to the separate per-recipient budget.
+    """
+    def decorator(view):
+        @wraps(view)
+        def wrapper(*args, **kwargs):
+            if rate_limiter is not None:
+                limited = charge(rate_limiter, cost() if cost else 1)
+                if limited is None and recipients:
+                    limited = charge(recipient_limiter, recipients())
+                if limited is not None:
+                    return limited
+            return view(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+# Responses by Idempotency-Key, so retried sends are not sent twice
+idempotency = IdempotencyCache(
+    max_entries=app.config['IDEMPOTENCY_CACHE_SIZE'],
+    max_bytes=app.config['IDEMPOTENCY_CACHE_BYTES'],
+    ttl=app.config['IDEMPOTENCY_TTL'],
+    storage=storage if app.config['IDEMPOTENCY_PERSIST'] else None,
+    journal=journal
+)
+idempotency.load()
+
+
+def idempotent(view):
+    """
+    Run the view once per Idempotency-Key (per caller and endpoint) and
+    replay its response to retries. Retries that arrive while the first
+    request is running wait for its response. Responses a retry could
+    change (429 and 5xx) are not stored.
+    """
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        key = request.headers.get('Idempotency-Key')
+        if key is None:
+            return view(*args, **kwargs)
+        if not key or len(key) > 255:
+            return jsonify({'error': 'Idempotency-Key must be 1 to 255 characters'}), 400
+        
+        cache_key = f'{client_key()}|{request.endpoint}|{key}'
+        request_fingerprint = fingerprint(request.method.encode(), request.path.encode(), request.get_data())
+        try:
+            stored = idempotency.acquire(cache_key, timeout=app.config['IDEMPOTENCY_WAIT_TIMEOUT'])
+        except IdempotencyConflict:
+            return jsonify({'error': 'A request with this Idempotency-Key is still in progress'}), 409
+        
+        if stored is None:
+            try:
+                response = app.make_response(view(*args, **kwargs))
+            except Exception:
+                idempotency.release(cache_key)
+                raise
+            if response.status_code == 429 or response.status_code >= 500:
+                idempotency.release(cache_key)
+                return response
+            stored = (request_fingerprint, response.status_code, response.get_data())
+            try:
+                idempotency.complete(cache_key, stored)
+            except JournalError:
+                idempotency.release(cache_key)
+                return jsonify({'error': 'Changes could not be saved durably'}), 503
+            return response
+        
+        stored_fingerprint, status, body = stored
+        if stored_fingerprint != request_fingerprint:
+            return jsonify({'error': 'Idempotency-Key was already used for a different request'}), 422
+        response = app.response_class(body, status=status, mimetype='application/json')
+        response.headers['Idempotent-Replayed'] = 'true'
+        return response
+    return wrapper
+
+
+# Request metrics and store gauges, served at /metrics
+metrics = Metrics(app.config['METRICS_DIR'])
+metrics.gauge('sms_messages', 'Messages in the store', lambda: len(messages), aggregate='max')
+metrics.gauge('sms_contacts', 'Contacts in the store', lambda: len(contacts), aggregate='max')
+metrics.gauge('sms_scheduled_messages', 'Scheduled messages in the store',
+              lambda: len(scheduled_messages), aggregate='max')
+metrics.gauge('sms_delivery_queue_depth', 'Messages waiting for a delivery worker', lambda: delivery.depth())
+metrics.gauge('sms_receipt_queue_depth', 'Delivery receipts waiting to be applied', lambda: len(receipts))
+metrics.gauge('sms_scheduler_pending', 'Scheduled messages waiting to become due', lambda: len(scheduler))
+metrics.start(app.config['METRICS_REFRESH_INTERVAL'])
+
+
+def timed_wsgi(wsgi_app):
+    """Stamp each WSGI request with its start time, before Flask sees it"""
+    def wrapper(environ, start_response):
+        environ['sms.request_started'] = time.perf_counter()
+        return wsgi_app(environ, start_response)
+    return wrapper
+
+
+app.wsgi_app = timed_wsgi(app.wsgi_app)
+
+
+@app.after_request
+def record_request_metrics(response):
+    # One proxy lookup: each costs about as much as recording the request
+    req = request._get_current_object()
+    started = req.environ.get('sms.request_started')
+    if started is not None:
+        rule = req.url_rule
+        # Streamed responses are timed up to their first byte
+        metrics.observe_request(rule.rule if rule is not None else 'unmatched', req.method,
+                                response.status_code, time.perf_counter() - started)
+    return response
+
+
+if journal is not None:
+    # Registered after the metrics hook, so it runs first and the wait is timed
+    @app.after_request
+    def wait_for_journal(response):
+        """Acknowledge a request only once the changes it made are durable"""
+        try:
+            journal.wait()
+        except JournalError:
+            return app.make_response((jsonify({'error': 'Changes could not be saved durably'}), 503))
+        return response
+
+
+def admin_authorized():
+    """Whether the request carries the admin token (never, if none is configured)"""
+    token = app.config['PROFILER_ADMIN_TOKEN']
+    supplied = request.headers.get('X-Admin-Token', '')
+    return bool(token) and hmac.compare_digest(supplied.encode(), token.encode())
+
+
+# Opt-in request profiling; when disabled no hook is installed at all
+profiler = None
+if app.config['PROFILER_ENABLED']:
+    profiler = SamplingProfiler(interval=app.config['PROFILER_INTERVAL'])
+    profiler.start()
+
+    @app.before_request
+    def start_profiling():
+        if request.endpoint is None:
+            return
+        if random.random() < app.config['PROFILER_SAMPLE_RATE'] or admin_authorized():
+            profiler.begin(request.endpoint)
+
+    @app.teardown_request
+    def stop_profiling(exc):
+        profiler.end()
+
+
+# Serialized responses of the polled list endpoints
+response_cache = ResponseCache(app.config['RESPONSE_CACHE_SIZE'])
+
+
+def cached_response(generation):
+    """
+    Serve the view's 200 responses from the response cache while
+    `generation()` is unchanged. Responses carry a strong ETag, and a
+    matching If-None-Match gets 304 Not Modified with no body.
+    """
+    def decorator(view):
+        @wraps(view)
+        def wrapper(*args, **kwargs):
+            key = (request.endpoint, tuple(sorted(kwargs.items())),
+                   tuple(sorted(request.args.items(multi=True))), generation())
+            entry = response_cache.get(key)
+            if entry is None:
+                response = app.make_response(view(*args, **kwargs))
+                if response.status_code != 200:
+                    return response
+                entry = response_cache.put(key, response.get_data())
+            body, etag = entry
+            response = app.response_class(body, mimetype='application/json')
+            response.set_etag(etag)
+            # Clients may keep the response but must revalidate before using it
+            response.headers['Cache-Control'] = 'no-cache'
+            return response.make_conditional(request)
+        return wrapper
+    return decorator
+
+
+def analytics_generation():
+    """Analytics change with any store, any recorded event, and the clock"""
+    return (repository.generation('messages', 'contacts', 'scheduled_messages'),
+            rollups.generation, int(time.time() // MINUTE))
+
+
+def batch_cost():
+    """Rate limit cost of a batch send: one token per recipient"""
+    data = request.get_json(silent=True)
+    if isinstance(data, dict):
+        items = data.get('messages', data.get('recipients', data.get('contact_ids')))
+        if isinstance(items, list):
+            return max(1, len(items))
+    return 1
+
+
+def template_dict(template):
+    """A stored template with the fields its body uses"""
+    return {**template, 'fields': list(compile_template(template['body']).fields)}
+
+
+def template_recipients(contact_ids=None):
+    """
+    Contacts to render a template for: the given IDs in order, or every contact.
+    Returns: (contacts, missing_ids), or (None, None) if the IDs are malformed
+    """
+    if contact_ids is None:
+        return list(contacts), []
+    if not isinstance(contact_ids, list):
+        return None, None
+    recipients = []
+    missing = []
+    for contact_id in contact_ids:
+        contact = repository.get_contact(contact_id) if isinstance(contact_id, int) else None
+        if contact is None:
+            missing.append(contact_id)
+        else:
+            recipients.append(contact)
+    return recipients, missing
+
+
+def resolve_audience(data):
+    """
+    Bitmap of the contacts matching a request's `tags` expression.
+    Returns: (bitmap, error_message)
+    """
+    if not isinstance(data, dict) or not isinstance(data.get('tags'), str):
+        return None, 'tags must be a tag expression, e.g. "vip AND NOT churned"'
+    try:
+        return tag_index.query(data['tags']), None
+    except ValueError as exc:
+        return None, str(exc)
+
+
+def request_audience():
+    """resolve_audience() for the current request, resolved once however often it is asked"""
+    if 'audience' not in g:
+        g.audience = resolve_audience(request.get_json(silent=True))
+    return g.audience
+
+
+def audience_cost():
+    """Recipient budget cost of an audience send: one token per recipient"""
+    audience, _ = request_audience()
+    return max(1, audience.bit_count()) if audience else 1
+
+
+def audience_message(data):
+    """
+    The template or sanitized message body an audience request sends.
+    Returns: (template, body, error_message)
+    """
+    if 'template_id' in data:
+        template_id = data['template_id']
+        template = repository.get_template(template_id) if isinstance(template_id, int) else None
+        if template is None:
+            return None, None, 'Template not found'
+        return compile_template(template['body']), None, None
+    body = data.get('message')
+    is_valid, error = validate_message_content(body if isinstance(body, str) else '')
+    if not is_valid:
+        return None, None, error
+    return None, sanitize_input(body), None
+
+
+def render_audience(data, recipients):
+    """
+    Bodies and segment counts for each recipient of an audience request.
+    Returns: (bodies, segment_counts, error_message)
+    """
+    template, body, error = audience_message(data)
+    if error:
+        return None, None, error
+    if template is not None:
+        return (*template.render_many(recipients), None)
+    segments = calculate_message_segments(body)
+    return [body] * len(recipients), [segments] * len(recipients), None
+
+
+def quote_audience_message(data, audience, size):
+    """
+    Segments and cost of sending a request's message or template to the audience.
+    Returns: (quote, error_message)
+    """
+    template, body, error = audience_message(data)
+    if error:
+        return None, error
+    if template is None:
+        # One body for everyone: no need to look at the contacts
+        segments = calculate_message_segments(body) * size
+    else:
+        recipients = [contact for contact in map(contact_index.get, bitmap_ids(audience)) if contact is not None]
+        segments = sum(template.render_many(recipients)[1])
+    return {
+        'recipients': size,
+        'segments': segments,
+        'estimated_cost': round(estimate_cost('', segments=segments), 2)
+    }, None
+
+
+def queue_messages(queued):
+    """Hand stored messages to the delivery workers, waiting for queue space"""
+    for msg in queued:
+        queue_message(msg, block=True)
+
+
+def queue_results(queued):
+    """Hand a request's stored messages to the delivery workers; returns how many the queue refused"""
+    refused = 0
+    for msg, result in queued:
+        if not queue_message(msg):
+            # The queue filled since it was checked; the message is stored as failed
+            result.update(success=False, error='Delivery queue is full')
+            result['data'].update(msg.to_dict())
+            refused += 1
+    return refused
+
+
+# Audience sends wait for delivery queue space here, one send after another
+audience_sends = ThreadPoolExecutor(max_workers=1, thread_name_prefix='sms-audience')
+
 
 @app.route('/')
 def home():
@@ -37,16 +759,33 @@ def home():
         'version': '1.0.0',
         'endpoints': {
             'send_sms': '/api/sms/send',
+            'send_sms_batch': '/api/sms/send/batch',
             'get_messages': '/api/sms/messages',
+            'export_messages': '/api/sms/messages/export',
             'get_contacts': '/api/contacts',
             'add_contact': '/api/contacts/add',
+            'import_contacts': '/api/contacts/import',
+            'update_contact': '/api/contacts/<id>',
+            'conversation': '/api/contacts/<id>/messages',
+            'contact_tags': '/api/contacts/tags',
+            'audience': '/api/audience',
+            'send_audience': '/api/audience/send',
+            'delivery_receipts': '/api/sms/receipts',
             'schedule_message': '/api/sms/schedule',
             'get_scheduled': '/api/sms/scheduled',
-            'analytics': '/api/analytics'
+            'reschedule': '/api/sms/scheduled/<id>',
+            'cancel_scheduled': '/api/sms/scheduled/<id>/cancel',
+            'templates': '/api/templates',
+            'render_template': '/api/templates/<id>/render',
+            'send_template': '/api/sms/send/template',
+            'analytics': '/api/analytics',
+            'metrics': '/metrics'
         }
     })
 
 @app.route('/api/sms/send', methods=['POST'])
+@idempotent
+@rate_limited()
 def send_sms():
     """Send an SMS message"""
     data = request.get_json()
@@ -71,34 +810,195 @@ def send_sms():
     phone = format_phone_number(phone)
     message_text = sanitize_input(message_text)
     
+    full = queue_full_response()
+    if full:
+        return full
+    
     # Create message object
     msg = Message(
         phone=phone,
-        message=message_text,
-        message_id=len(messages) + 1
+        message=message_text
     )
-    
-    messages.append(msg)
+    msg.status = 'queued'
     
     # Calculate segments and cost
     segments = calculate_message_segments(message_text)
-    cost = estimate_cost(message_text)
+    cost = estimate_cost(message_text, segments=segments)
+    
+    store_message(msg, segments, cost)
+    # Serialize before a delivery worker can change the status
+    data = msg.to_dict()
+    if not queue_message(msg):
+        # The queue filled since it was checked; the message is stored as failed
+        return queue_full_error()
     
     return jsonify({
         'success': True,
-        'message': 'SMS sent successfully',
+        'message': 'SMS queued for delivery',
         'data': {
-            **msg.to_dict(),
+            **data,
             'segments': segments,
             'estimated_cost': cost
         }
-    }), 200
+    }), 202
+
+@app.route('/api/sms/send/batch', methods=['POST'])
+@idempotent
+@rate_limited(cost=batch_cost)
+def send_sms_batch():
+    """Send SMS messages to many recipients in one request"""
+    data = request.get_json(silent=True)
+    
+    if not data or not isinstance(data, dict):
+        return jsonify({'error': 'No data provided'}), 400
+    
+    # Either one body for many recipients, or explicit (phone, message) pairs
+    if 'messages' in data:
+        items = data['messages']
+        if not isinstance(items, list) or not all(isinstance(item, dict) for item in items):
+            return jsonify({'error': 'messages must be a list of {phone, message} objects'}), 400
+        entries = [(item.get('phone', ''), item.get('message', '')) for item in items]
+    else:
+        recipients = data.get('recipients')
+        if not isinstance(recipients, list):
+            return jsonify({'error': 'recipients must be a list of phone numbers'}), 400
+        message_text = data.get('message', '')
+        entries = [(phone, message_text) for phone in recipients]
+    
+    if not entries:
+        return jsonify({'error': 'At least one recipient is required'}), 400
+    
+    max_recipients = app.config['MAX_RECIPIENTS_PER_REQUEST']
+    if len(entries) > max_recipients:
+        return jsonify({'error': f'Too many recipients (max {max_recipients} per request)'}), 400
+    
+    full = queue_full_response(len(entries))
+    if full:
+        return full
+    
+    validated = validate_batch(entries)
+    # Segments are computed once per distinct body
+    segment_counts = calculate_segments_batch(message_text or '' for _, message_text, _ in validated)
+    results = []
+    queued = []
+    sent = 0
+    total_segments = 0
+    total_cost = 0.0
+    
+    for index, (phone, message_text, error) in enumerate(validated):
+        if error:
+            results.append({
+                'index': index,
+                'success': False,
+                'phone': entries[index][0],
+                'error': error
+            })
+            continue
+        
+        segments = segment_counts[index]
+        cost = estimate_cost(message_text, segments=segments)
+        
+        msg = Message(
+            phone=phone,
+            message=message_text
+        )
+        msg.status = 'queued'
+        store_message(msg, segments, cost)
+        
+        sent += 1
+        total_segments += segments
+        total_cost += cost
+        results.append({
+            'index': index,
+            'success': True,
+            'data': {
+                **msg.to_dict(),
+                'segments': segments,
+                'estimated_cost': cost
+            }
+        })
+        queued.append((msg, results[-1]))
+    
+    sent -= queue_results(queued)
+    
+    return jsonify({
+        'success': sent > 0,
+        'message': f'{sent} of {len(entries)} messages queued',
+        'summary': {
+            'total': len(entries),
+            'queued': sent,
+            'failed': len(entries) - sent,
+            'segments': total_segments,
+            'estimated_cost': round(total_cost, 2)
+        },
+        'results': results
+    }), 202
+
+@app.route('/api/sms/receipts', methods=['POST'])
+def delivery_receipts():
+    """Accept delivery receipts from the SMS provider (single or batched)"""
+    token = app.config['RECEIPT_WEBHOOK_TOKEN']
+    if not token:
+        # Anyone could settle any message without a shared secret
+        return jsonify({'error': 'Receipt webhook is disabled until RECEIPT_WEBHOOK_TOKEN is set'}), 403
+    supplied = request.headers.get('X-Webhook-Token') or request.args.get('token', '')
+    if not hmac.compare_digest(supplied.encode(), token.encode()):
+        return jsonify({'error': 'Invalid webhook token'}), 401
+    
+    # Twilio posts one form-encoded callback; JSON may carry one receipt or a list
+    if request.is_json:
+        data = request.get_json(silent=True)
+        if isinstance(data, dict):
+            data = data.get('receipts', [data])
+        if not isinstance(data, list):
+            return jsonify({'error': 'Expected a receipt object or a list of receipts'}), 400
+        items = data
+    else:
+        items = [request.form]
+    
+    accepted = []
+    ignored = invalid = 0
+    received_at = time.time()
+    for item in items:
+        if not hasattr(item, 'get'):
+            invalid += 1
+            continue
+        provider_message_id = item.get('provider_message_id') or item.get('MessageSid')
+        status = item.get('status') or item.get('MessageStatus')
+        if not provider_message_id or not status:
+            invalid += 1
+            continue
+        delivery_status = receipt_status(str(status))
+        if delivery_status is None:
+            ignored += 1
+            continue
+        receipt = (str(provider_message_id), delivery_status, received_at)
+        receipts.submit(*receipt)
+        accepted.append(receipt)
+    if accepted and journal is not None:
+        # The provider will not send them again once they are acknowledged
+        journal.append('receipts', accepted)
+    
+    return jsonify({
+        'success': True,
+        'accepted': len(accepted),
+        'ignored': ignored,
+        'invalid': invalid
+    }), 202
+
+# Any of these switches get_messages to keyset pagination
+MESSAGE_FILTERS = ('cursor', 'phone', 'status', 'delivery_status', 'since', 'until', 'order')
 
 @app.route('/api/sms/messages', methods=['GET'])
+@cached_response(lambda: repository.generation('messages'))
 def get_messages():
     """Get all sent messages with pagination"""
-    page = request.args.get('page', 1, type=int)
-    per_page = request.args.get('per_page', 20, type=int)
+    args = request.args
+    if any(key in args for key in MESSAGE_FILTERS):
+        return get_messages_filtered()
+    
+    page = args.get('page', 1, type=int)
+    per_page = args.get('per_page', 20, type=int)
     
     # Limit per_page
     per_page = min(per_page, 100)
@@ -115,29 +1015,172 @@ def get_messages():
         'page': page,
         'per_page': per_page,
         'total_pages': (len(messages) + per_page - 1) // per_page,
-        'messages': [msg.to_dict() if hasattr(msg, 'to_dict') else msg for msg in paginated_messages]
+        'messages': [msg.to_dict() for msg in paginated_messages]
+    }), 200
+
+
+def get_messages_filtered():
+    """Keyset-paginated, filtered message listing"""
+    args = request.args
+    per_page = max(1, min(args.get('per_page', app.config['DEFAULT_PAGE_SIZE'], type=int),
+                          app.config['MAX_PAGE_SIZE']))
+    order = args.get('order', 'asc')
+    if order not in ('asc', 'desc'):
+        return jsonify({'error': 'order must be asc or desc'}), 400
+    
+    cursor = args.get('cursor')
+    if cursor is not None:
+        try:
+            cursor = int(cursor)
+        except ValueError:
+            return jsonify({'error': 'Invalid cursor'}), 400
+    
+    bounds = {}
+    for key in ('since', 'until'):
+        value = args.get(key)
+        if value is None:
+            continue
+        try:
+            bounds[key] = parse_timestamp(value)
+        except ValueError:
+            return jsonify({'error': f'Invalid {key} timestamp. Use ISO format: YYYY-MM-DDTHH:MM:SS'}), 400
+    
+    phone = args.get('phone')
+    page, next_cursor = message_index.query(
+        phone=format_phone_number(phone) if phone else None,
+        status=args.get('status'),
+        delivery_status=args.get('delivery_status'),
+        since=bounds.get('since'),
+        until=bounds.get('until'),
+        cursor=cursor,
+        limit=per_page,
+        descending=order == 'desc'
+    )
+    
+    return jsonify({
+        'success': True,
+        'per_page': per_page,
+        'order': order,
+        'next_cursor': next_cursor,
+        'messages': [msg.to_dict() for msg in page]
     }), 200
 
+# Messages serialized per chunk written to an export stream
+EXPORT_CHUNK_SIZE = 1000
+EXPORT_FIELDS = ('id', 'phone', 'message', 'timestamp', 'status', 'delivery_status', 'provider_message_id')
+# CSV columns of a serialized message, in EXPORT_FIELDS order
+export_row = itemgetter(*EXPORT_FIELDS)
+
+@app.route('/api/sms/messages/export', methods=['GET'])
+def export_messages():
+    """Stream message history as NDJSON or CSV"""
+    args = request.args
+    fmt = args.get('format', 'ndjson')
+    if fmt not in ('ndjson', 'csv'):
+        return jsonify({'error': 'format must be ndjson or csv'}), 400
+    
+    bounds = {}
+    for key in ('since', 'until'):
+        value = args.get(key)
+        if value is None:
+            continue
+        try:
+            bounds[key] = parse_timestamp(value)
+        except ValueError:
+            return jsonify({'error': f'Invalid {key} timestamp. Use ISO format: YYYY-MM-DDTHH:MM:SS'}), 400
+    
+    phone = args.get('phone')
+    filters = {
+        'phone': format_phone_number(phone) if phone else None,
+        'status': args.get('status'),
+        'delivery_status': args.get('delivery_status'),
+        'since': bounds.get('since'),
+        # Messages sent while the export runs are left for the next one
+        'until': bounds.get('until', time.time())
+    }
+    
+    def generate():
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
+        if fmt == 'csv':
+            writer.writerow(EXPORT_FIELDS)
+        cursor = None
+        while True:
+            # Each chunk resumes after the last ID, so memory stays flat
+            page, cursor = message_index.query(cursor=cursor, limit=EXPORT_CHUNK_SIZE, **filters)
+            if fmt == 'csv':
+                writer.writerows(export_row(msg.to_dict()) for msg in page)
+            else:
+                for msg in page:
+                    buffer.write(json.dumps(msg.to_dict(), ensure_ascii=False))
+                    buffer.write('\n')
+            if buffer.tell():
+                yield buffer.getvalue()
+                buffer.seek(0)
+                buffer.truncate()
+            if cursor is None:
+                return
+    
+    mimetype = 'text/csv' if fmt == 'csv' else 'application/x-ndjson'
+    # No Content-Length, so the body goes out with chunked transfer encoding
+    response = Response(stream_with_context(generate()), mimetype=mimetype)
+    response.headers['Content-Disposition'] = f'attachment; filename=messages.{fmt}'
+    return response
+
 @app.route('/api/contacts', methods=['GET'])
+@cached_response(lambda: repository.generation('contacts'))
 def get_contacts():
-    """Get all contacts with search"""
-    search = request.args.get('search', '').lower()
-    
-    filtered_contacts = contacts
-    if search:
-        filtered_contacts = [
-            c for c in contacts 
-            if search in c.get('name', '').lower() or search in c.get('phone', '')
-        ]
+    """Get all contacts with search and tag filtering"""
+    search = request.args.get('search', '')
+    page = request.args.get('page', 1, type=int)
+    per_page = request.args.get('per_page', type=int)
     
-    return jsonify({
+    # Without per_page every match is returned, as before
+    limit = None
+    offset = 0
+    if per_page is not None:
+        limit = max(1, min(per_page, app.config['MAX_PAGE_SIZE']))
+        offset = (max(page, 1) - 1) * limit
+    
+    end = None if limit is None else offset + limit
+    tags = request.args.get('tags', '')
+    if tags.strip():
+        try:
+            audience = tag_index.query(tags)
+        except ValueError as exc:
+            return jsonify({'error': str(exc)}), 400
+        if search.strip():
+            _, ranked = contact_index.search(search)
+            in_audience = bitmap_contains(audience)
+            matches = [contact for contact in ranked if in_audience(contact['id'])]
+            count, filtered_contacts = len(matches), matches[offset:end]
+        else:
+            count = audience.bit_count()
+            ids = bitmap_ids(audience, end)[offset:end]
+            filtered_contacts = [contact for contact in map(contact_index.get, ids) if contact is not None]
+    elif search.strip():
+        count, filtered_contacts = contact_index.search(search, limit=limit, offset=offset)
+    else:
+        count = len(contacts)
+        filtered_contacts = contacts[offset:end]
+    
+    response = {
         'success': True,
-        'count': len(filtered_contacts),
+        'count': count,
         'total': len(contacts),
         'contacts': filtered_contacts
-    }), 200
+    }
+    if limit is not None:
+        response.update({
+            'page': max(page, 1),
+            'per_page': limit,
+            'total_pages': (count + limit - 1) // limit
+        })
+    
+    return jsonify(response), 200
 
 @app.route('/api/contacts/add', methods=['POST'])
+@rate_limited()
 def add_contact():
     """Add a new contact"""
     data = request.get_json()
@@ -153,14 +1196,9 @@ def add_contact():
     if not is_valid_phone:
         return jsonify({'error': phone_error}), 400
     
-    # Check for duplicate
     phone_formatted = format_phone_number(phone)
-    for existing in contacts:
-        if existing.get('phone') == phone_formatted:
-            return jsonify({'error': 'Contact with this phone number already exists'}), 409
-    
     contact = {
-        'id': len(contacts) + 1,
+        'id': None,
         'name': name,
         'phone': phone_formatted,
         'messages': 0,
@@ -168,7 +1206,10 @@ def add_contact():
         'tags': data.get('tags', [])
     }
     
-    contacts.append(contact)
+    # Duplicate check and insert are atomic
+    contact, created = repository.add_contact(contact)
+    if not created:
+        return jsonify({'error': 'Contact with this phone number already exists'}), 409
     
     return jsonify({
         'success': True,
@@ -176,7 +1217,71 @@ def add_contact():
         'contact': contact
     }), 201
 
+@app.route('/api/contacts/import', methods=['POST'])
+@rate_limited()
+def import_contacts():
+    """Bulk import contacts from a streamed CSV or NDJSON upload"""
+    fmt = request.args.get('format')
+    upload = request.files.get('file')
+    if fmt is None:
+        mimetype = upload.mimetype if upload is not None else request.mimetype
+        filename = (upload.filename or '') if upload is not None else ''
+        if mimetype in ('text/csv', 'application/csv') or filename.endswith('.csv'):
+            fmt = 'csv'
+        elif mimetype in ('application/x-ndjson', 'application/jsonl') or filename.endswith(('.ndjson', '.jsonl')):
+            fmt = 'ndjson'
+    if fmt not in ('csv', 'ndjson'):
+        return jsonify({'error': 'Upload must be CSV (text/csv) or NDJSON (application/x-ndjson)'}), 400
+    
+    # Read the body incrementally instead of buffering it
+    stream = upload.stream if upload is not None else request.stream
+    lines = io.TextIOWrapper(stream, encoding='utf-8', errors='replace', newline='')
+    
+    max_errors = 100
+    created_at = datetime.now().isoformat()
+    inserted = duplicates = invalid = 0
+    errors = []
+    
+    for line_number, row, error in iter_contact_rows(lines, fmt):
+        if error is None:
+            phone = row['phone']
+            is_valid_phone, error = validate_phone_number(phone)
+            if is_valid_phone and not row['name'].strip():
+                error = 'Name is required'
+        if error is not None:
+            invalid += 1
+            if len(errors) < max_errors:
+                errors.append({'line': line_number, 'error': error})
+            continue
+        
+        _, created = repository.add_contact({
+            'id': None,
+            'name': sanitize_input(row['name']),
+            'phone': format_phone_number(phone),
+            'messages': 0,
+            'created_at': created_at,
+            'tags': row['tags']
+        })
+        if created:
+            inserted += 1
+        else:
+            duplicates += 1
+    
+    return jsonify({
+        'success': True,
+        'message': 'Contacts imported',
+        'summary': {
+            'inserted': inserted,
+            'duplicates': duplicates,
+            'invalid': invalid,
+            'total': inserted + duplicates + invalid
+        },
+        'errors': errors
+    }), 200
+
 @app.route('/api/sms/schedule', methods=['POST'])
+@idempotent
+@rate_limited()
 def schedule_message():
     """Schedule a message for later delivery"""
     data = request.get_json()
@@ -208,15 +1313,18 @@ def schedule_message():
     message_text = sanitize_input(message_text)
     
     scheduled_entry = {
-        'id': len(scheduled_messages) + 1,
+        'id': None,
         'phone': phone,
         'message': message_text,
         'scheduled_time': scheduled_time,
+        'scheduled_at': format_utc(parse_timestamp(scheduled_time)),
         'created_at': datetime.now().isoformat(),
-        'status': 'scheduled'
+        'status': 'scheduled',
+        'sent_at': None
     }
     
-    scheduled_messages.append(scheduled_entry)
+    repository.add_scheduled(scheduled_entry)
+    schedule_dispatch(scheduled_entry)
     
     return jsonify({
         'success': True,
@@ -224,36 +1332,534 @@ def schedule_message():
         'data': scheduled_entry
     }), 201
 
+SCHEDULED_FILTERS = ('cursor', 'phone', 'status', 'since', 'until', 'order', 'per_page')
+
 @app.route('/api/sms/scheduled', methods=['GET'])
+@cached_response(lambda: repository.generation('scheduled_messages'))
 def get_scheduled():
     """Get all scheduled messages"""
+    if any(key in request.args for key in SCHEDULED_FILTERS):
+        return get_scheduled_filtered()
     return jsonify({
         'success': True,
         'count': len(scheduled_messages),
         'scheduled_messages': scheduled_messages
     }), 200
 
+
+def get_scheduled_filtered():
+    """Scheduled messages in due-time order, filtered and keyset-paginated"""
+    args = request.args
+    per_page = max(1, min(args.get('per_page', app.config['DEFAULT_PAGE_SIZE'], type=int),
+                          app.config['MAX_PAGE_SIZE']))
+    order = args.get('order', 'asc')
+    if order not in ('asc', 'desc'):
+        return jsonify({'error': 'order must be asc or desc'}), 400
+    
+    cursor = args.get('cursor')
+    if cursor is not None:
+        try:
+            due, entry_id = cursor.split(':')
+            cursor = (int(due), int(entry_id))
+        except ValueError:
+            return jsonify({'error': 'Invalid cursor'}), 400
+    
+    bounds = {}
+    for key in ('since', 'until'):
+        value = args.get(key)
+        if value is None:
+            continue
+        try:
+            bounds[key] = parse_timestamp(value)
+        except ValueError:
+            return jsonify({'error': f'Invalid {key} timestamp. Use ISO format: YYYY-MM-DDTHH:MM:SS'}), 400
+    
+    phone = args.get('phone')
+    page, next_cursor = repository.scheduled_index.query(
+        phone=format_phone_number(phone) if phone else None,
+        status=args.get('status'),
+        since=bounds.get('since'),
+        until=bounds.get('until'),
+        cursor=cursor,
+        limit=per_page,
+        descending=order == 'desc'
+    )
+    
+    return jsonify({
+        'success': True,
+        'per_page': per_page,
+        'order': order,
+        'next_cursor': None if next_cursor is None else '%d:%d' % next_cursor,
+        'scheduled_messages': page
+    }), 200
+
+@app.route('/api/sms/scheduled/<int:entry_id>', methods=['PATCH'])
+@rate_limited()
+def reschedule_message(entry_id):
+    """Move a scheduled message that has not been sent to another time"""
+    entry = repository.get_scheduled(entry_id)
+    if entry is None:
+        return jsonify({'error': 'Scheduled message not found'}), 404
+    
+    data = request.get_json(silent=True)
+    if not data or not isinstance(data, dict) or 'scheduled_time' not in data:
+        return jsonify({'error': 'scheduled_time is required'}), 400
+    scheduled_time = data['scheduled_time']
+    is_valid_time, time_error = parse_scheduled_time(scheduled_time)
+    if not is_valid_time:
+        return jsonify({'error': time_error}), 400
+    
+    if not repository.update_scheduled(entry, expected_status='scheduled', scheduled_time=scheduled_time,
+                                       scheduled_at=format_utc(parse_timestamp(scheduled_time))):
+        return jsonify({'error': f"Scheduled message is already {entry['status']}"}), 409
+    schedule_dispatch(entry)
+    return jsonify({
+        'success': True,
+        'message': 'Message rescheduled successfully',
+        'data': entry
+    }), 200
+
+@app.route('/api/sms/scheduled/<int:entry_id>/cancel', methods=['POST'])
+@rate_limited()
+def cancel_scheduled(entry_id):
+    """Cancel a scheduled message that has not been sent"""
+    entry = repository.get_scheduled(entry_id)
+    if entry is None:
+        return jsonify({'error': 'Scheduled message not found'}), 404
+    if not repository.update_scheduled(entry, expected_status='scheduled', status='cancelled'):
+        return jsonify({'error': f"Scheduled message is already {entry['status']}"}), 409
+    return jsonify({
+        'success': True,
+        'message': 'Scheduled message cancelled',
+        'data': entry
+    }), 200
+
+@app.route('/api/templates', methods=['POST'])
+@rate_limited()
+def add_template():
+    """Register a message template with {field} placeholders"""
+    data = request.get_json(silent=True)
+    
+    if not data or 'name' not in data or 'body' not in data:
+        return jsonify({'error': 'Name and body are required'}), 400
+    
+    name = sanitize_input(str(data['name']))
+    body = sanitize_input(str(data['body']))
+    if not name:
+        return jsonify({'error': 'Name cannot be empty'}), 400
+    is_valid, error = validate_message_content(body)
+    if not is_valid:
+        return jsonify({'error': error}), 400
+    try:
+        compile_template(body)
+    except ValueError as exc:
+        return jsonify({'error': str(exc)}), 400
+    
+    template = {
+        'id': None,
+        'name': name,
+        'body': body,
+        'created_at': datetime.now().isoformat()
+    }
+    repository.add_template(template)
+    
+    return jsonify({
+        'success': True,
+        'message': 'Template added successfully',
+        'template': template_dict(template)
+    }), 201
+
+@app.route('/api/templates', methods=['GET'])
+@cached_response(lambda: repository.generation('templates'))
+def get_templates():
+    """Get all message templates"""
+    return jsonify({
+        'success': True,
+        'count': len(templates),
+        'templates': [template_dict(template) for template in list(templates.values())]
+    }), 200
+
+@app.route('/api/templates/<int:template_id>/render', methods=['POST'])
+@rate_limited()
+def render_template_for_contacts(template_id):
+    """Render a template for contacts (all of them by default) and quote the send"""
+    template = repository.get_template(template_id)
+    if template is None:
+        return jsonify({'error': 'Template not found'}), 404
+    
+    data = request.get_json(silent=True) or {}
+    recipients, missing = template_recipients(data.get('contact_ids'))
+    if recipients is None:
+        return jsonify({'error': 'contact_ids must be a list of contact IDs'}), 400
+    try:
+        preview = max(0, min(int(data.get('preview', 10)), app.config['MAX_PAGE_SIZE']))
+    except (TypeError, ValueError):
+        return jsonify({'error': 'preview must be an integer'}), 400
+    
+    bodies, segment_counts = compile_template(template['body']).render_many(recipients)
+    max_length = app.config['MAX_MESSAGE_LENGTH']
+    total_segments = sum(segment_counts)
+    
+    return jsonify({
+        'success': True,
+        'template': template_dict(template),
+        'summary': {
+            'recipients': len(recipients),
+            'missing_contact_ids': missing,
+            'too_long': sum(1 for body in bodies if len(body) > max_length),
+            'segments': total_segments,
+            'estimated_cost': round(estimate_cost('', segments=total_segments), 2)
+        },
+        'messages': [
+            {
+                'contact_id': contact['id'],
+                'phone': contact['phone'],
+                'message': body,
+                'segments': segments,
+                'estimated_cost': estimate_cost(body, segments=segments)
+            }
+            for contact, body, segments in zip(recipients[:preview], bodies, segment_counts)
+        ]
+    }), 200
+
+@app.route('/api/sms/send/template', methods=['POST'])
+@idempotent
+@rate_limited(cost=batch_cost)
+def send_template():
+    """Send a template, personalized for each contact, to many contacts"""
+    data = request.get_json(silent=True)
+    
+    if not data or not isinstance(data, dict) or 'template_id' not in data:
+        return jsonify({'error': 'template_id and contact_ids are required'}), 400
+    
+    template_id = data['template_id']
+    template = repository.get_template(template_id) if isinstance(template_id, int) else None
+    if template is None:
+        return jsonify({'error': 'Template not found'}), 404
+    
+    contact_ids = data.get('contact_ids')
+    if not isinstance(contact_ids, list) or not contact_ids:
+        return jsonify({'error': 'contact_ids must be a non-empty list of contact IDs'}), 400
+    max_recipients = app.config['MAX_RECIPIENTS_PER_REQUEST']
+    if len(contact_ids) > max_recipients:
+        return jsonify({'error': f'Too many recipients (max {max_recipients} per request)'}), 400
+    
+    recipients, missing = template_recipients(contact_ids)
+    if recipients is None:
+        return jsonify({'error': 'contact_ids must be a list of contact IDs'}), 400
+    
+    full = queue_full_response(len(recipients))
+    if full:
+        return full
+    
+    bodies, segment_counts = compile_template(template['body']).render_many(recipients)
+    results = [
+        {'contact_id': contact_id, 'success': False, 'error': 'Contact not found'}
+        for contact_id in missing
+    ]
+    queued = []
+    total_segments = 0
+    total_cost = 0.0
+    
+    for contact, body, segments in zip(recipients, bodies, segment_counts):
+        is_valid, error = validate_phone_number(contact['phone'])
+        if is_valid:
+            is_valid, error = validate_message_content(body)
+        if not is_valid:
+            results.append({'contact_id': contact['id'], 'success': False, 'error': error})
+            continue
+        
+        cost = estimate_cost(body, segments=segments)
+        msg = Message(
+            phone=format_phone_number(contact['phone']),
+            message=body
+        )
+        msg.status = 'queued'
+        store_message(msg, segments, cost)
+        
+        total_segments += segments
+        total_cost += cost
+        results.append({
+            'contact_id': contact['id'],
+            'success': True,
+            'data': {
+                **msg.to_dict(),
+                'segments': segments,
+                'estimated_cost': cost
+            }
+        })
+        queued.append((msg, results[-1]))
+    
+    sent = len(queued) - queue_results(queued)
+    
+    return jsonify({
+        'success': sent > 0,
+        'message': f'{sent} of {len(contact_ids)} messages queued',
+        'summary': {
+            'total': len(contact_ids),
+            'queued': sent,
+            'failed': len(contact_ids) - sent,
+            'segments': total_segments,
+            'estimated_cost': round(total_cost, 2)
+        },
+        'results': results
+    }), 202
+
+@app.route('/api/contacts/<int:contact_id>', methods=['PATCH'])
+@rate_limited()
+def update_contact(contact_id):
+    """Change a contact's name or tags"""
+    contact = repository.get_contact(contact_id)
+    if contact is None:
+        return jsonify({'error': 'Contact not found'}), 404
+    
+    data = request.get_json(silent=True)
+    if not data or not isinstance(data, dict):
+        return jsonify({'error': 'No data provided'}), 400
+    
+    changes = {}
+    if 'name' in data:
+        changes['name'] = sanitize_input(str(data['name']))
+        if not changes['name']:
+            return jsonify({'error': 'Name cannot be empty'}), 400
+    if 'tags' in data:
+        if not isinstance(data['tags'], list):
+            return jsonify({'error': 'tags must be a list'}), 400
+        changes['tags'] = [str(tag) for tag in data['tags']]
+    if not changes:
+        return jsonify({'error': 'Only name and tags can be changed'}), 400
+    
+    repository.update_contact(contact, **changes)
+    return jsonify({
+        'success': True,
+        'message': 'Contact updated successfully',
+        'contact': contact
+    }), 200
+
+@app.route('/api/contacts/<int:contact_id>/messages', methods=['GET'])
+@cached_response(lambda: repository.generation('messages', 'contacts'))
+def get_conversation(contact_id):
+    """Page through the messages sent to a contact, newest first by default"""
+    contact = repository.get_contact(contact_id)
+    if contact is None:
+        return jsonify({'error': 'Contact not found'}), 404
+    
+    args = request.args
+    per_page = max(1, min(args.get('per_page', app.config['DEFAULT_PAGE_SIZE'], type=int),
+                          app.config['MAX_PAGE_SIZE']))
+    order = args.get('order', 'desc')
+    if order not in ('asc', 'desc'):
+        return jsonify({'error': 'order must be asc or desc'}), 400
+    cursor = args.get('cursor')
+    if cursor is not None:
+        try:
+            cursor = int(cursor)
+        except ValueError:
+            return jsonify({'error': 'Invalid cursor'}), 400
+    
+    # The phone's own index rows: the page costs the same however long the history is
+    page, next_cursor = message_index.query(
+        phone=format_phone_number(contact['phone']),
+        cursor=cursor,
+        limit=per_page,
+        descending=order == 'desc'
+    )
+    return jsonify({
+        'success': True,
+        'contact': contact,
+        'per_page': per_page,
+        'order': order,
+        'next_cursor': next_cursor,
+        'messages': [msg.to_dict() for msg in page]
+    }), 200
+
+@app.route('/api/contacts/tags', methods=['GET'])
+@cached_response(lambda: repository.generation('contacts'))
+def get_contact_tags():
+    """Tags in use and how many contacts carry each"""
+    return jsonify({
+        'success': True,
+        'tags': tag_index.tags()
+    }), 200
+
+@app.route('/api/audience', methods=['POST'])
+@rate_limited()
+def quote_audience():
+    """Resolve a tag expression to its contacts and quote a send to them"""
+    data = request.get_json(silent=True)
+    audience, error = resolve_audience(data)
+    if error:
+        return jsonify({'error': error}), 400
+    
+    try:
+        preview = max(0, min(int(data.get('preview', 10)), app.config['MAX_PAGE_SIZE']))
+    except (TypeError, ValueError):
+        return jsonify({'error': 'preview must be an integer'}), 400
+    
+    size = audience.bit_count()
+    response = {
+        'success': True,
+        'audience': {
+            'tags': data['tags'],
+            'size': size,
+            'contact_ids': bitmap_ids(audience, preview)
+        }
+    }
+    if 'template_id' in data or 'message' in data:
+        quote, error = quote_audience_message(data, audience, size)
+        if error:
+            return jsonify({'error': error}), 400
+        response['quote'] = quote
+    return jsonify(response), 200
+
+@app.route('/api/audience/send', methods=['POST'])
+@idempotent
+@rate_limited(recipients=audience_cost)
+def send_audience():
+    """Send a message or template to every contact matching a tag expression"""
+    data = request.get_json(silent=True)
+    audience, error = request_audience()
+    if error:
+        return jsonify({'error': error}), 400
+    if 'template_id' not in data and 'message' not in data:
+        return jsonify({'error': 'message or template_id is required'}), 400
+    
+    size = audience.bit_count()
+    if not size:
+        return jsonify({'error': 'No contacts match the audience'}), 400
+    max_recipients = app.config['AUDIENCE_MAX_RECIPIENTS']
+    if size > max_recipients:
+        return jsonify({'error': f'Audience too large (max {max_recipients} recipients per send)'}), 400
+    
+    recipients = [contact for contact in map(contact_index.get, bitmap_ids(audience)) if contact is not None]
+    bodies, segment_counts, error = render_audience(data, recipients)
+    if error:
+        return jsonify({'error': error}), 400
+    
+    queued = []
+    errors = []
+    total_segments = 0
+    total_cost = 0.0
+    max_length = app.config['MAX_MESSAGE_LENGTH']
+    for contact, body, segments in zip(recipients, bodies, segment_counts):
+        is_valid, error = validate_phone_number(contact['phone'])
+        if is_valid and len(body) > max_length:
+            is_valid, error = False, f'Message too long (max {max_length} characters)'
+        if not is_valid:
+            errors.append({'contact_id': contact['id'], 'error': error})
+            continue
+        
+        cost = estimate_cost(body, segments=segments)
+        msg = Message(
+            phone=format_phone_number(contact['phone']),
+            message=body
+        )
+        msg.status = 'queued'
+        store_message(msg, segments, cost)
+        queued.append(msg)
+        total_segments += segments
+        total_cost += cost
+    
+    # A large send waits for queue space in the background instead of failing
+    audience_sends.submit(queue_messages, queued)
+    
+    return jsonify({
+        'success': len(queued) > 0,
+        'message': f'{len(queued)} of {len(recipients)} messages queued',
+        'summary': {
+            'total': len(recipients),
+            'queued': len(queued),
+            'failed': len(errors),
+            'segments': total_segments,
+            'estimated_cost': round(total_cost, 2)
+        },
+        # The first failures only; a large audience could fail in bulk
+        'errors': errors[:app.config['MAX_PAGE_SIZE']]
+    }), 202
+
+ANALYTICS_INTERVALS = {'minute': MINUTE, 'hour': HOUR, 'day': DAY}
+
 @app.route('/api/analytics', methods=['GET'])
+@cached_response(analytics_generation)
 def get_analytics():
     """Get SMS analytics"""
     total_sent = len(messages)
     total_scheduled = len(scheduled_messages)
     total_contacts = len(contacts)
     
-    # Calculate delivery rate (mock data)
-    delivery_rate = 98.5 if total_sent > 0 else 0
+    overall = rollups.window()
+    midnight = datetime.now().replace(hour=0, minute=0, second=0, microsecond=0)
+    today = rollups.window(since=midnight.timestamp())
+    
+    analytics = {
+        'total_sent': total_sent,
+        'total_scheduled': total_scheduled,
+        'total_contacts': total_contacts,
+        'delivery_rate': overall['delivery_rate'],
+        'active_today': today['sent'],
+        'total_delivered': overall['delivered'],
+        'total_failed': overall['failed'],
+        'total_segments': overall['segments'],
+        'total_cost': overall['cost']
+    }
+    
+    # Optional window (and per-bucket series) over [since, until)
+    since = request.args.get('since')
+    until = request.args.get('until')
+    interval = request.args.get('interval')
+    if since or until or interval:
+        try:
+            since_ts = parse_timestamp(since) if since else None
+            until_ts = parse_timestamp(until) if until else None
+        except ValueError:
+            return jsonify({'error': 'Invalid date format. Use ISO format: YYYY-MM-DDTHH:MM:SS'}), 400
+        analytics['window'] = {'since': since, 'until': until, **rollups.window(since_ts, until_ts)}
+        
+        if interval:
+            resolution = ANALYTICS_INTERVALS.get(interval)
+            if resolution is None:
+                return jsonify({'error': 'interval must be minute, hour or day'}), 400
+            now = datetime.now().timestamp()
+            series_since = since_ts if since_ts is not None else now - resolution * 60
+            series_until = until_ts if until_ts is not None else now
+            if (series_until - series_since) / resolution > 1000:
+                return jsonify({'error': 'Too many buckets (max 1000 per request)'}), 400
+            analytics['window']['series'] = [
+                {**point, 'start': datetime.fromtimestamp(point['start']).isoformat()}
+                for point in rollups.series(series_since, series_until, resolution)
+            ]
     
     return jsonify({
         'success': True,
-        'analytics': {
-            'total_sent': total_sent,
-            'total_scheduled': total_scheduled,
-            'total_contacts': total_contacts,
-            'delivery_rate': delivery_rate,
-            'active_today': total_sent
-        }
+        'analytics': analytics
     }), 200
 
+@app.route('/api/admin/profile', methods=['GET', 'DELETE'])
+def request_profile():
+    """Folded stacks sampled from profiled requests (DELETE clears them)"""
+    if profiler is None:
+        return jsonify({'error': 'Profiling is disabled'}), 404
+    if not admin_authorized():
+        return jsonify({'error': 'Invalid admin token'}), 401
+    
+    if request.method == 'DELETE':
+        profiler.reset()
+        return jsonify({'success': True}), 200
+    
+    if request.args.get('format') == 'json':
+        return jsonify({
+            'success': True,
+            'samples': profiler.samples,
+            'interval': profiler.interval,
+            'endpoints': profiler.endpoints()
+        }), 200
+    return Response(profiler.folded(request.args.get('endpoint')), mimetype='text/plain')
+
+@app.route('/metrics', methods=['GET'])
+def get_metrics():
+    """Request, queue and store metrics of every worker in Prometheus text format"""
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
+
 if __name__ == '__main__':
     print('🚀 SMS Platform API Server')
     print('📱 Endpoints available at http://localhost:5000')
@@ -0,0 +1,321 @@
+"""
+SMS Platform - Benchmarks
+Endpoint load tests and helper microbenchmarks with regression checks
+Run with: python benchmark.py [--sizes 10000,100000] [--gunicorn] [--baseline FILE]
+"""
+
+import argparse
+import http.client
+import json
+import os
+import platform
+import random
+import socket
+import subprocess
+import sys
+import threading
+import time
+from typing import Callable, Dict, List
+
+# Stores are seeded in memory and every limit that would skew timings is off
+BENCHMARK_ENV = {
+    'FLASK_ENV': 'production',
+    'DATABASE_URL': 'memory://',
+    'SMS_PROVIDER': 'none',
+    'RATE_LIMIT_ENABLED': 'false',
+    'SCHEDULER_ENABLED': 'false',
+    'RESPONSE_CACHE_SIZE': '0',
+    'SNAPSHOT_PATH': '',
+    'JOURNAL_DIR': '',
+}
+
+FIRST_NAMES = ('John', 'Jane', 'Alex', 'Maria', 'Wei', 'Fatima', 'Olga', 'Kwame', 'Priya', 'Diego')
+LAST_NAMES = ('Doe', 'Smith', 'Garcia', 'Chen', 'Okafor', 'Ivanova', 'Patel', 'Silva', 'Kim', 'Novak')
+BODIES = (
+    'Your verification code is 123456',
+    'Reminder: your appointment is tomorrow at 10:00',
+    'Flash sale! 20% off everything this weekend only, reply STOP to opt out',
+    'Привет! Ваш заказ отправлен',
+)
+
+
+def configure_environment() -> None:
+    for key, value in BENCHMARK_ENV.items():
+        os.environ.setdefault(key, value)
+
+
+def seed(app_module, size: int) -> None:
+    """Grow the app's stores to `size` messages and `size` contacts"""
+    from models import Message
+
+    rng = random.Random(size)
+    repository = app_module.repository
+    for number in range(len(repository.contacts), size):
+        repository.add_contact({
+            'id': None,
+            'name': f'{rng.choice(FIRST_NAMES)} {rng.choice(LAST_NAMES)} {number}',
+            'phone': f'+1 555 {number // 10000 % 1000:03d} {number % 10000:04d}',
+            'messages': 0,
+            'created_at': None,
+            'tags': []
+        })
+    for number in range(len(repository.messages), size):
+        msg = Message(phone=f'+1555{number % 10000:07d}', message=rng.choice(BODIES))
+        msg.status = 'sent'
+        app_module.store_message(msg, 1, 0.0075)
+
+
+def seeded_app(size: int):
+    """WSGI app with seeded stores, for gunicorn: "benchmark:seeded_app(10000)" """
+    configure_environment()
+    import app as app_module
+    seed(app_module, size)
+    return app_module.app
+
+
+def percentile(samples: List[float], fraction: float) -> float:
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * fraction))]
+
+
+def summarize(latencies: List[float], elapsed: float) -> Dict:
+    """Throughput and latency percentiles (milliseconds) of a run"""
+    return {
+        'ops_per_sec': round(len(latencies) / elapsed, 1),
+        'p50_ms': round(percentile(latencies, 0.50) * 1000, 4),
+        'p99_ms': round(percentile(latencies, 0.99) * 1000, 4),
+        'count': len(latencies),
+    }
+
+
+def measure(operation: Callable[[int], None], iterations: int) -> Dict:
+    """Time `operation(i)` for i in range(iterations), after a short warm-up"""
+    for i in range(min(iterations // 10, 100)):
+        operation(i)
+    latencies = []
+    started = time.perf_counter()
+    for i in range(iterations):
+        begin = time.perf_counter()
+        operation(i)
+        latencies.append(time.perf_counter() - begin)
+    return summarize(latencies, time.perf_counter() - started)
+
+
+def endpoint_cases(size: int) -> Dict[str, Callable]:
+    """name -> callable(client, i) issuing one request"""
+    rng = random.Random(1)
+    pages = max(1, size // 20)
+    surnames = [name.lower()[:4] for name in LAST_NAMES]
+
+    def check(response):
+        if response.status_code >= 400:
+            raise RuntimeError(f'{response.status_code}: {response.data[:200]!r}')
+
+    return {
+        'send_sms': lambda client, i: check(client.post(
+            '/api/sms/send', json={'phone': f'+1 555 777 {i % 10000:04d}', 'message': BODIES[i % len(BODIES)]})),
+        'get_messages_page': lambda client, i: check(client.get(
+            f'/api/sms/messages?page={rng.randrange(pages) + 1}&per_page=20')),
+        'get_messages_cursor': lambda client, i: check(client.get(
+            f'/api/sms/messages?phone=%2B1555{i % 10000:07d}&per_page=20')),
+        'get_contacts_search': lambda client, i: check(client.get(
+            f'/api/contacts?search={surnames[i % len(surnames)]}&per_page=20')),
+        'get_contacts_phone': lambda client, i: check(client.get(
+            f'/api/contacts?search=555{i % 1000:03d}&per_page=20')),
+        'analytics': lambda client, i: check(client.get('/api/analytics')),
+    }
+
+
+def run_flask(app_module, size: int, iterations: int) -> Dict[str, Dict]:
+    client = app_module.app.test_client()
+    results = {}
+    for name, case in endpoint_cases(size).items():
+        results[name] = measure(lambda i: case(client, i), iterations)
+        # Deliveries from send_sms must not spill into the next case
+        app_module.delivery.join(timeout=60)
+    return results
+
+
+def run_micro(iterations: int) -> Dict[str, Dict]:
+    from utils import (
+        calculate_message_segments,
+        format_phone_number,
+        sanitize_input,
+        validate_batch,
+        validate_message_content,
+        validate_phone_number
+    )
+
+    gsm = 'Flash sale! 20% off everything this weekend only, reply STOP to opt out. ' * 4
+    ucs2 = 'Привет! Ваш заказ отправлен 📦 ' * 6
+    batch = [(f'+1 555 010 {n:04d}', BODIES[n % len(BODIES)]) for n in range(100)]
+    cases = {
+        'validate_phone_number': lambda i: validate_phone_number('+1 (555) 010-0000'),
+        'format_phone_number': lambda i: format_phone_number('+1 (555) 010-0000'),
+        'validate_message_content': lambda i: validate_message_content(gsm),
+        'sanitize_input': lambda i: sanitize_input(gsm),
+        'segments_gsm7': lambda i: calculate_message_segments(gsm),
+        'segments_ucs2': lambda i: calculate_message_segments(ucs2),
+        'validate_batch_100': lambda i: validate_batch(batch),
+    }
+    return {name: measure(case, iterations) for name, case in cases.items()}
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def run_gunicorn(size: int, requests: int, concurrency: int, workers: int) -> Dict[str, Dict]:
+    """Load-test a local gunicorn server seeded with `size` records"""
+    port = free_port()
+    env = dict(os.environ, **BENCHMARK_ENV)
+    server = subprocess.Popen(
+        [sys.executable, '-m', 'gunicorn', '--workers', str(workers), '--threads', '4',
+         '--bind', f'127.0.0.1:{port}', '--log-level', 'warning', f'benchmark:seeded_app({size})'],
+        cwd=os.path.dirname(os.path.abspath(__file__)), env=env
+    )
+    try:
+        deadline = time.monotonic() + 600
+        while True:
+            try:
+                with socket.create_connection(('127.0.0.1', port), timeout=1):
+                    break
+            except OSError:
+                if server.poll() is not None or time.monotonic() > deadline:
+                    raise RuntimeError('gunicorn did not start')
+                time.sleep(0.5)
+        # Every worker seeds on its own; make sure all of them answer
+        time.sleep(1)
+
+        paths = {
+            'get_messages_page': lambda i: f'/api/sms/messages?page={i % 50 + 1}&per_page=20',
+            'get_messages_cursor': lambda i: f'/api/sms/messages?phone=%2B1555{i % 10000:07d}&per_page=20',
+            'get_contacts_search': lambda i: f'/api/contacts?search={LAST_NAMES[i % len(LAST_NAMES)][:4]}&per_page=20',
+            'analytics': lambda i: '/api/analytics',
+        }
+        return {name: load_test(port, path, requests, concurrency) for name, path in paths.items()}
+    finally:
+        server.terminate()
+        server.wait(timeout=30)
+
+
+def load_test(port: int, path: Callable[[int], str], requests: int, concurrency: int) -> Dict:
+    """GET `path(i)` `requests` times from `concurrency` keep-alive connections"""
+    latencies: List[float] = []
+    errors = []
+    lock = threading.Lock()
+    per_thread = requests // concurrency
+
+    def worker(offset: int) -> None:
+        conn = http.client.HTTPConnection('127.0.0.1', port, timeout=30)
+        local = []
+        try:
+            for i in range(offset, offset + per_thread):
+                begin = time.perf_counter()
+                conn.request('GET', path(i))
+                response = conn.getresponse()
+                response.read()
+                local.append(time.perf_counter() - begin)
+                if response.status >= 400:
+                    errors.append(response.status)
+        finally:
+            conn.close()
+            with lock:
+                latencies.extend(local)
+
+    threads = [threading.Thread(target=worker, args=(n * per_thread,)) for n in range(concurrency)]
+    started = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    if errors:
+        raise RuntimeError(f'{len(errors)} requests failed, e.g. HTTP {errors[0]}')
+    return summarize(latencies, time.perf_counter() - started)
+
+
+def compare(results: Dict[str, Dict], baseline: Dict[str, Dict], threshold: float) -> List[str]:
+    """
+    Regressions of `results` against `baseline`: a benchmark regresses when
+    its p50 latency grows, or its throughput drops, by more than `threshold`x.
+    """
+    regressions = []
+    for name, base in baseline.items():
+        current = results.get(name)
+        if current is None:
+            continue
+        if current['p50_ms'] > base['p50_ms'] * threshold:
+            regressions.append(f"{name}: p50 {base['p50_ms']}ms -> {current['p50_ms']}ms")
+        if current['ops_per_sec'] * threshold < base['ops_per_sec']:
+            regressions.append(f"{name}: {base['ops_per_sec']}/s -> {current['ops_per_sec']}/s")
+    return regressions
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description='SMS Platform benchmarks')
+    parser.add_argument('--sizes', default='10000,100000',
+                        help='comma-separated store sizes to seed (e.g. 10000,100000,1000000)')
+    parser.add_argument('--iterations', type=int, default=500, help='requests per endpoint case')
+    parser.add_argument('--micro-iterations', type=int, default=20000, help='calls per helper')
+    parser.add_argument('--gunicorn', action='store_true', help='also load-test a local gunicorn server')
+    parser.add_argument('--gunicorn-workers', type=int, default=2)
+    parser.add_argument('--requests', type=int, default=2000, help='requests per gunicorn case')
+    parser.add_argument('--concurrency', type=int, default=8)
+    parser.add_argument('--output', default='benchmark_results.json')
+    parser.add_argument('--baseline', help='results file to compare against')
+    parser.add_argument('--threshold', type=float, default=1.25,
+                        help='allowed slowdown factor before a result counts as a regression')
+    args = parser.parse_args(argv)
+
+    configure_environment()
+    import app as app_module
+
+    sizes = sorted(int(size) for size in args.sizes.split(','))
+    results: Dict[str, Dict] = {}
+    for name, metrics in run_micro(args.micro_iterations).items():
+        results[f'micro/{name}'] = metrics
+    for size in sizes:
+        started = time.perf_counter()
+        seed(app_module, size)
+        print(f'Seeded {size} records in {time.perf_counter() - started:.1f}s')
+        for name, metrics in run_flask(app_module, size, args.iterations).items():
+            results[f'flask/{size}/{name}'] = metrics
+        if args.gunicorn:
+            for name, metrics in run_gunicorn(size, args.requests, args.concurrency, args.gunicorn_workers).items():
+                results[f'gunicorn/{size}/{name}'] = metrics
+
+    width = max(len(name) for name in results)
+    print(f"{'benchmark':<{width}}  {'ops/s':>10}  {'p50 ms':>9}  {'p99 ms':>9}")
+    for name, metrics in results.items():
+        print(f"{name:<{width}}  {metrics['ops_per_sec']:>10}  {metrics['p50_ms']:>9}  {metrics['p99_ms']:>9}")
+
+    report = {
+        'meta': {
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'created_at': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'sizes': sizes,
+        },
+        'results': results,
+    }
+    with open(args.output, 'w') as output:
+        json.dump(report, output, indent=2)
+    print(f'Results written to {args.output}')
+
+    if args.baseline:
+        with open(args.baseline) as baseline_file:
+            baseline = json.load(baseline_file)['results']
+        regressions = compare(results, baseline, args.threshold)
+        if regressions:
+            print(f'{len(regressions)} regression(s) against {args.baseline}:')
+            for regression in regressions:
+                print(f'  {regression}')
+            return 1
+        print(f'No regressions against {args.baseline}')
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
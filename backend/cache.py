@@ -0,0 +1,48 @@
+"""
+SMS Platform - Response Cache
+Serialized responses keyed by request and data generation, with LRU eviction
+"""
+
+import hashlib
+import threading
+from collections import OrderedDict
+from typing import Hashable, Optional, Tuple
+
+
+def make_etag(body: bytes) -> str:
+    """Strong ETag derived from the response body"""
+    return hashlib.blake2b(body, digest_size=16).hexdigest()
+
+
+class ResponseCache:
+    """
+    Bounded LRU map from a request key to (body, etag).
+    Keys include the generation of every store a response was built from,
+    so a write makes old entries unreachable instead of invalidating them;
+    they age out as new entries arrive.
+    """
+    def __init__(self, max_entries: int = 1024):
+        self.max_entries = max_entries
+        self._entries: 'OrderedDict[Hashable, Tuple[bytes, str]]' = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def get(self, key: Hashable) -> Optional[Tuple[bytes, str]]:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+            return entry
+
+    def put(self, key: Hashable, body: bytes) -> Tuple[bytes, str]:
+        entry = (body, make_etag(body))
+        if self.max_entries <= 0:
+            return entry
+        with self._lock:
+            self._entries[key] = entry
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        return entry
@@ -22,17 +22,51 @@ class Config:
     # CORS
     CORS_ORIGINS = os.getenv('CORS_ORIGINS', '*')
     
-    # Rate Limiting
+    # Rate Limiting (per API key, or per IP without a key listed in API_KEYS)
+    API_KEYS = frozenset(key.strip() for key in os.getenv('API_KEYS', '').split(',') if key.strip())
+    RATE_LIMIT_ENABLED = os.getenv('RATE_LIMIT_ENABLED', 'true').lower() == 'true'
     RATE_LIMIT_PER_DAY = int(os.getenv('RATE_LIMIT_PER_DAY', 10000))
     RATE_LIMIT_PER_HOUR = int(os.getenv('RATE_LIMIT_PER_HOUR', 1000))
+    RATE_LIMIT_FILE = os.getenv('RATE_LIMIT_FILE', 'sms_platform.ratelimit')
+    RATE_LIMIT_SLOTS = int(os.getenv('RATE_LIMIT_SLOTS', 65536))
+    # Audience sends are charged per recipient against their own, larger budget
+    RECIPIENT_LIMIT_PER_DAY = int(os.getenv('RECIPIENT_LIMIT_PER_DAY', 1000000))
+    RECIPIENT_LIMIT_PER_HOUR = int(os.getenv('RECIPIENT_LIMIT_PER_HOUR', 100000))
+    RECIPIENT_LIMIT_FILE = os.getenv('RECIPIENT_LIMIT_FILE', 'sms_platform.recipients.ratelimit')
     
-    # SMS Provider (for future integration)
+    # SMS Provider ('twilio', or 'none' to accept messages without sending)
     TWILIO_ACCOUNT_SID = os.getenv('TWILIO_ACCOUNT_SID', '')
     TWILIO_AUTH_TOKEN = os.getenv('TWILIO_AUTH_TOKEN', '')
     TWILIO_PHONE_NUMBER = os.getenv('TWILIO_PHONE_NUMBER', '')
+    SMS_PROVIDER = os.getenv('SMS_PROVIDER', 'twilio' if TWILIO_ACCOUNT_SID else 'none')
+    SMS_PROVIDER_URL = os.getenv('SMS_PROVIDER_URL', 'https://api.twilio.com')
     
-    # Database (for future implementation)
+    # Delivery workers
+    DELIVERY_WORKERS = int(os.getenv('DELIVERY_WORKERS', 8))
+    DELIVERY_QUEUE_SIZE = int(os.getenv('DELIVERY_QUEUE_SIZE', 10000))
+    DELIVERY_MAX_RETRIES = int(os.getenv('DELIVERY_MAX_RETRIES', 5))
+    DELIVERY_RETRY_BACKOFF = float(os.getenv('DELIVERY_RETRY_BACKOFF', 1.0))
+    DELIVERY_TIMEOUT = float(os.getenv('DELIVERY_TIMEOUT', 10.0))
+    
+    # Delivery receipts (the webhook rejects every call until a token is set)
+    RECEIPT_WEBHOOK_TOKEN = os.getenv('RECEIPT_WEBHOOK_TOKEN', '')
+    RECEIPT_BATCH_SIZE = int(os.getenv('RECEIPT_BATCH_SIZE', 1000))
+    RECEIPT_FLUSH_INTERVAL = float(os.getenv('RECEIPT_FLUSH_INTERVAL', 0.2))
+    RECEIPT_MATCH_TTL = float(os.getenv('RECEIPT_MATCH_TTL', 60))
+    
+    # Database (sqlite:///path is persisted; other URLs keep data in memory only)
     DATABASE_URL = os.getenv('DATABASE_URL', 'sqlite:///sms_platform.db')
+    DATABASE_BATCH_SIZE = int(os.getenv('DATABASE_BATCH_SIZE', 100))
+    DATABASE_FLUSH_INTERVAL = float(os.getenv('DATABASE_FLUSH_INTERVAL', 1.0))
+    
+    # Snapshots of the in-memory stores for fast restarts (empty path disables them)
+    SNAPSHOT_PATH = os.getenv('SNAPSHOT_PATH', 'sms_platform.snapshot')
+    SNAPSHOT_INTERVAL = float(os.getenv('SNAPSHOT_INTERVAL', 300))
+    
+    # Write-ahead journal, fsynced before requests are acknowledged (empty directory disables it)
+    JOURNAL_DIR = os.getenv('JOURNAL_DIR', 'sms_platform.journal')
+    JOURNAL_COMMIT_WINDOW = float(os.getenv('JOURNAL_COMMIT_WINDOW', 0.0))
+    JOURNAL_COMPACT_INTERVAL = float(os.getenv('JOURNAL_COMPACT_INTERVAL', 60))
     
     # Application
     APP_NAME = 'SMS Platform'
@@ -41,10 +75,41 @@ class Config:
     # Message Settings
     MAX_MESSAGE_LENGTH = 1600
     MAX_RECIPIENTS_PER_REQUEST = 100
+    AUDIENCE_MAX_RECIPIENTS = int(os.getenv('AUDIENCE_MAX_RECIPIENTS', 100000))
+    
+    # Scheduler
+    SCHEDULER_ENABLED = os.getenv('SCHEDULER_ENABLED', 'true').lower() == 'true'
+    SCHEDULER_BATCH_SIZE = int(os.getenv('SCHEDULER_BATCH_SIZE', 100))
+    # A failed dispatch is retried after this delay, doubling per attempt up to the maximum
+    SCHEDULER_RETRY_DELAY = float(os.getenv('SCHEDULER_RETRY_DELAY', 5))
+    SCHEDULER_MAX_RETRY_DELAY = float(os.getenv('SCHEDULER_MAX_RETRY_DELAY', 300))
+    
+    # Analytics (per-minute counters are kept this many seconds)
+    ANALYTICS_MINUTE_RETENTION = int(os.getenv('ANALYTICS_MINUTE_RETENTION', 2 * 86400))
     
     # Pagination
     DEFAULT_PAGE_SIZE = 20
     MAX_PAGE_SIZE = 100
+    
+    # Response cache for polled list endpoints (serialized responses kept)
+    RESPONSE_CACHE_SIZE = int(os.getenv('RESPONSE_CACHE_SIZE', 1024))
+    
+    # Idempotency keys (responses kept IDEMPOTENCY_TTL seconds, persisted with the database)
+    IDEMPOTENCY_CACHE_SIZE = int(os.getenv('IDEMPOTENCY_CACHE_SIZE', 100000))
+    IDEMPOTENCY_CACHE_BYTES = int(os.getenv('IDEMPOTENCY_CACHE_BYTES', 64 * 1024 * 1024))
+    IDEMPOTENCY_TTL = float(os.getenv('IDEMPOTENCY_TTL', 86400))
+    IDEMPOTENCY_PERSIST = os.getenv('IDEMPOTENCY_PERSIST', 'true').lower() == 'true'
+    IDEMPOTENCY_WAIT_TIMEOUT = float(os.getenv('IDEMPOTENCY_WAIT_TIMEOUT', 30.0))
+    
+    # Metrics (set METRICS_DIR to an empty directory to aggregate gunicorn workers)
+    METRICS_DIR = os.getenv('METRICS_DIR', '')
+    METRICS_REFRESH_INTERVAL = float(os.getenv('METRICS_REFRESH_INTERVAL', 5.0))
+    
+    # Request profiling (requests sent with X-Admin-Token are always profiled)
+    PROFILER_ENABLED = os.getenv('PROFILER_ENABLED', 'false').lower() == 'true'
+    PROFILER_ADMIN_TOKEN = os.getenv('PROFILER_ADMIN_TOKEN', '')
+    PROFILER_SAMPLE_RATE = float(os.getenv('PROFILER_SAMPLE_RATE', 0.0))
+    PROFILER_INTERVAL = float(os.getenv('PROFILER_INTERVAL', 0.005))
 
 
 class DevelopmentConfig(Config):
@@ -61,6 +126,13 @@ class TestingConfig(Config):
     """Testing configuration"""
     TESTING = True
     DEBUG = True
+    DATABASE_URL = 'sqlite:///:memory:'
+    SMS_PROVIDER = 'none'
+    RATE_LIMIT_FILE = ''
+    RECIPIENT_LIMIT_FILE = ''
+    RECEIPT_WEBHOOK_TOKEN = 'test-webhook-token'
+    SNAPSHOT_PATH = ''
+    JOURNAL_DIR = ''
 
 
 # Configuration dictionary
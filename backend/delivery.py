@@ -0,0 +1,231 @@
+"""
+SMS Platform - Delivery
+Asynchronous outbound delivery to the SMS provider
+"""
+
+import base64
+import http.client
+import json
+import logging
+import queue
+import random
+import threading
+import time
+from typing import Callable, Optional, Tuple
+from urllib.parse import urlencode, urlsplit
+from uuid import uuid4
+
+from scheduler import Scheduler
+
+logger = logging.getLogger(__name__)
+
+
+class ProviderError(Exception):
+    """Provider request failed; `retryable` says whether another attempt may succeed"""
+    def __init__(self, message: str, retryable: bool = True):
+        super().__init__(message)
+        self.retryable = retryable
+
+
+class ConnectionPool:
+    """
+    Keep-alive HTTP(S) connections to one host.
+    Idle connections are reused most-recently-released first, so a busy
+    pool keeps a warm set of sockets instead of reconnecting per request.
+    """
+    def __init__(self, base_url: str, size: int = 8, timeout: float = 10.0):
+        parts = urlsplit(base_url)
+        self.scheme = parts.scheme
+        self.host = parts.hostname
+        self.port = parts.port
+        self.base_path = parts.path.rstrip('/')
+        self.timeout = timeout
+        self._idle = queue.LifoQueue(maxsize=size)
+
+    def _connect(self) -> http.client.HTTPConnection:
+        if self.scheme == 'https':
+            return http.client.HTTPSConnection(self.host, self.port, timeout=self.timeout)
+        return http.client.HTTPConnection(self.host, self.port, timeout=self.timeout)
+
+    def request(self, method: str, path: str, body: bytes = None, headers: dict = None) -> Tuple[int, bytes]:
+        """Send one request on a pooled connection; returns (status, body)"""
+        try:
+            conn = self._idle.get_nowait()
+        except queue.Empty:
+            conn = self._connect()
+        try:
+            conn.request(method, self.base_path + path, body=body, headers=headers or {})
+            response = conn.getresponse()
+            # The body must be drained before the connection can be reused
+            data = response.read()
+        except Exception:
+            conn.close()
+            raise
+        if response.will_close:
+            conn.close()
+        else:
+            try:
+                self._idle.put_nowait(conn)
+            except queue.Full:
+                conn.close()
+        return response.status, data
+
+    def close(self) -> None:
+        while True:
+            try:
+                self._idle.get_nowait().close()
+            except queue.Empty:
+                return
+
+
+class NullProvider:
+    """Accepts every message without sending it (no provider configured)"""
+    def send(self, phone: str, message: str) -> str:
+        return 'local-' + uuid4().hex
+
+
+class TwilioProvider:
+    """
+    Twilio Messages API client. The local stub provider speaks the same
+    protocol, so pointing `base_url` at it exercises the real client.
+    """
+    def __init__(self, account_sid: str, auth_token: str, from_number: str,
+                 base_url: str = 'https://api.twilio.com', pool_size: int = 8, timeout: float = 10.0):
+        self.from_number = from_number
+        self.path = f'/2010-04-01/Accounts/{account_sid}/Messages.json'
+        credentials = base64.b64encode(f'{account_sid}:{auth_token}'.encode()).decode()
+        self.headers = {
+            'Authorization': f'Basic {credentials}',
+            'Content-Type': 'application/x-www-form-urlencoded',
+            'Accept': 'application/json',
+        }
+        self.pool = ConnectionPool(base_url, size=pool_size, timeout=timeout)
+
+    def send(self, phone: str, message: str) -> str:
+        """Submit one message; returns the provider message ID"""
+        body = urlencode({'To': phone, 'From': self.from_number, 'Body': message}).encode()
+        try:
+            status, data = self.pool.request('POST', self.path, body=body, headers=self.headers)
+        except (OSError, http.client.HTTPException) as exc:
+            raise ProviderError(f'Connection error: {exc}') from exc
+
+        if status in (200, 201):
+            return json.loads(data)['sid']
+        # Throttling and server errors are worth retrying, other errors are not
+        retryable = status == 429 or status >= 500
+        raise ProviderError(f'Provider returned HTTP {status}', retryable=retryable)
+
+
+class DeliveryQueue:
+    """
+    Bounded queue drained by a pool of worker threads.
+    Each attempt calls `provider.send`; retryable failures are re-queued
+    after exponential backoff with jitter (held in a Scheduler heap, so no
+    worker sleeps), and `on_result(item, provider_message_id, error)` is
+    called once per item when it is accepted or finally gives up.
+    """
+    def __init__(self, provider, on_result: Callable, workers: int = 8, maxsize: int = 10000,
+                 max_retries: int = 5, backoff: float = 1.0, max_backoff: float = 60.0):
+        self.provider = provider
+        self.on_result = on_result
+        self.workers = workers
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self._queue = queue.Queue(maxsize=maxsize)
+        self._retries = Scheduler(self._requeue)
+        self._threads = []
+        self._in_flight = 0
+        self._lock = threading.Lock()
+        self._idle = threading.Condition(self._lock)
+
+    def available(self) -> int:
+        """Free slots in the queue"""
+        return self._queue.maxsize - self._queue.qsize()
+
+    def depth(self) -> int:
+        return self._queue.qsize()
+
+    def submit(self, item, phone: str, message: str, block: bool = False, timeout: float = None) -> bool:
+        """Queue an item for delivery; returns False if the queue is full"""
+        with self._lock:
+            self._in_flight += 1
+        try:
+            self._queue.put((item, phone, message, 0), block=block, timeout=timeout)
+        except queue.Full:
+            self._done()
+            return False
+        return True
+
+    def start(self) -> None:
+        if self._threads:
+            return
+        self._retries.start()
+        for number in range(self.workers):
+            thread = threading.Thread(target=self._work, name=f'sms-delivery-{number}', daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def join(self, timeout: float = None) -> bool:
+        """Wait until every submitted item has a final result"""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self._idle:
+            while self._in_flight:
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    return False
+                self._idle.wait(remaining)
+        return True
+
+    def _done(self) -> None:
+        with self._idle:
+            self._in_flight -= 1
+            if not self._in_flight:
+                self._idle.notify_all()
+
+    def _requeue(self, batch) -> None:
+        for job in batch:
+            # Retries were already counted against the queue bound once
+            self._queue.put(job)
+
+    def _work(self) -> None:
+        while True:
+            item, phone, message, attempt = self._queue.get()
+            provider_message_id: Optional[str] = None
+            error: Optional[str] = None
+            try:
+                provider_message_id = self.provider.send(phone, message)
+            except ProviderError as exc:
+                if exc.retryable and attempt < self.max_retries:
+                    delay = min(self.backoff * 2 ** attempt, self.max_backoff)
+                    delay *= random.uniform(0.5, 1.0)
+                    self._retries.schedule(time.time() + delay, (item, phone, message, attempt + 1))
+                    continue
+                error = str(exc)
+            except Exception as exc:
+                logger.exception('Delivery attempt failed')
+                error = str(exc)
+
+            try:
+                self.on_result(item, provider_message_id, error)
+            except Exception:
+                logger.exception('Delivery result handler failed')
+            finally:
+                self._done()
+
+
+def create_provider(config):
+    """Build the provider named by SMS_PROVIDER ('twilio' or 'none')"""
+    name = config['SMS_PROVIDER']
+    if name == 'none':
+        return NullProvider()
+    if name == 'twilio':
+        return TwilioProvider(
+            config['TWILIO_ACCOUNT_SID'],
+            config['TWILIO_AUTH_TOKEN'],
+            config['TWILIO_PHONE_NUMBER'],
+            base_url=config['SMS_PROVIDER_URL'],
+            pool_size=config['DELIVERY_WORKERS'],
+            timeout=config['DELIVERY_TIMEOUT']
+        )
+    raise ValueError(f'Unknown SMS_PROVIDER: {name}')
@@ -0,0 +1,158 @@
+"""
+SMS Platform - Idempotency Keys
+Replay stored responses to retried requests instead of executing them twice
+"""
+
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+from typing import Dict, Optional, Tuple
+
+# (request fingerprint, status code, response body)
+StoredResponse = Tuple[str, int, bytes]
+
+
+class IdempotencyConflict(Exception):
+    """The first request with the key is still running"""
+
+
+def fingerprint(*parts: bytes) -> str:
+    """Digest identifying a request, to refuse a key reused for another one"""
+    digest = hashlib.blake2b(digest_size=16)
+    for part in parts:
+        digest.update(part)
+        digest.update(b'\0')
+    return digest.hexdigest()
+
+
+class IdempotencyCache:
+    """
+    Responses by idempotency key, kept `ttl` seconds.
+    Every entry lives for the same TTL, so insertion order is expiry order:
+    an OrderedDict gives O(1) lookup and O(1) eviction from the front, by
+    age or once more than `max_entries` entries or `max_bytes` of response
+    bodies are held. A key whose first request
+    is still running is marked in flight, and duplicates wait for its
+    response instead of running the request again.
+
+    With `storage`, completed responses are also written to the database
+    and looked up there on a miss, so they survive restarts, outlive memory
+    eviction and are found by other workers once flushed. A `journal`
+    also gets them, so a response is durable before it is sent.
+    """
+    def __init__(self, max_entries: int = 100000, ttl: float = 86400, storage=None,
+                 purge_interval: float = 3600, journal=None, max_bytes: int = 64 * 1024 * 1024):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.storage = storage
+        self.journal = journal
+        self.purge_interval = purge_interval
+        self._entries: 'OrderedDict[str, Tuple[float, StoredResponse]]' = OrderedDict()
+        self._in_flight: Dict[str, threading.Event] = {}
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self._next_purge = time.time() + purge_interval
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def load(self, now: float = None) -> None:
+        """
+        Fill the cache with the newest unexpired responses in storage, as
+        many as fit; older ones are still found in storage on a miss.
+        """
+        if self.storage is None:
+            return
+        now = time.time() if now is None else now
+        self.storage.purge_idempotency(now)
+        entries = self._entries
+        with self._lock:
+            for key, stored_fingerprint, status, body, expires_at in self.storage.load_idempotency(
+                    now, self.max_entries):
+                if self._bytes + len(body) > self.max_bytes:
+                    break
+                # Rows come newest first; each goes in front of the newer ones
+                entries[key] = (expires_at, (stored_fingerprint, status, body))
+                entries.move_to_end(key, last=False)
+                self._bytes += len(body)
+
+    def _evict(self, now: float) -> None:
+        entries = self._entries
+        while entries:
+            expires_at = next(iter(entries.values()))[0]
+            if expires_at > now and len(entries) <= self.max_entries and self._bytes <= self.max_bytes:
+                break
+            _, (_, response) = entries.popitem(last=False)
+            self._bytes -= len(response[2])
+
+    def acquire(self, key: str, timeout: float = 30.0) -> Optional[StoredResponse]:
+        """
+        The stored response for `key`, or None if the caller now owns the
+        key and must `complete()` or `release()` it. Waits up to `timeout`
+        seconds for a request in flight with the same key, then raises
+        IdempotencyConflict.
+        """
+        deadline = time.monotonic() + timeout
+        while True:
+            now = time.time()
+            with self._lock:
+                self._evict(now)
+                entry = self._entries.get(key)
+                if entry is not None and entry[0] > now:
+                    return entry[1]
+                event = self._in_flight.get(key)
+                if event is None:
+                    self._in_flight[key] = threading.Event()
+                    break
+            if not event.wait(max(0.0, deadline - time.monotonic())):
+                raise IdempotencyConflict(key)
+
+        if self.storage is not None:
+            stored = self.storage.get_idempotency(key, now)
+            if stored is not None:
+                stored_fingerprint, status, body, expires_at = stored
+                response = (stored_fingerprint, status, body)
+                self._finish(key, response, expires_at)
+                return response
+        return None
+
+    def complete(self, key: str, response: StoredResponse) -> None:
+        """
+        Store the owner's response and wake requests waiting for it. With a
+        journal, the response is only stored once it is durable; JournalError
+        leaves the key in flight for the caller to release.
+        """
+        now = time.time()
+        expires_at = now + self.ttl
+        if self.storage is not None:
+            if self.journal is not None:
+                self.journal.append('idempotency_keys', [(key, *response, expires_at)])
+                # Also waits for the changes the request made, so no retry replays them undurable
+                self.journal.wait()
+            self.storage.save_idempotency(key, *response, expires_at)
+            if now >= self._next_purge:
+                self._next_purge = now + self.purge_interval
+                self.storage.purge_idempotency(now)
+        self._finish(key, response, expires_at)
+
+    def release(self, key: str) -> None:
+        """Give up the key without a response; the next waiter runs the request"""
+        with self._lock:
+            event = self._in_flight.pop(key, None)
+        if event is not None:
+            event.set()
+
+    def _finish(self, key: str, response: StoredResponse, expires_at: float) -> None:
+        with self._lock:
+            replaced = self._entries.get(key)
+            if replaced is not None:
+                self._bytes -= len(replaced[1][2])
+            self._entries[key] = (expires_at, response)
+            self._entries.move_to_end(key)
+            self._bytes += len(response[2])
+            self._evict(time.time())
+            event = self._in_flight.pop(key, None)
+        if event is not None:
+            event.set()
@@ -0,0 +1,510 @@
+"""
+SMS Platform - Message Indexes
+In-process secondary indexes over stored and scheduled messages
+"""
+
+import marshal
+import threading
+from array import array
+from bisect import bisect_left, bisect_right, insort
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple
+
+from models import PROVIDER_ID, STATUSES, US, MessageLog
+from utils import parse_timestamp
+
+# Below this many new rows a status array takes insertions, above it one merge
+MERGE_THRESHOLD = 32
+# Rows per entry of the latest-timestamp-so-far array that bounds time ranges
+TIME_BLOCK = 64
+
+
+def _insert_rows(rows: array, new_rows: List[int]) -> array:
+    """`rows` with the sorted `new_rows` added, keeping it sorted"""
+    if not rows or new_rows[0] > rows[-1]:
+        rows.extend(new_rows)
+        return rows
+    if len(new_rows) < MERGE_THRESHOLD:
+        for row in new_rows:
+            insort(rows, row)
+        return rows
+    # Timsort merges the two sorted runs in linear time
+    return array('q', sorted(rows + array('q', new_rows)))
+
+
+class MessageIndex:
+    """
+    Secondary indexes for keyset pagination over a MessageLog.
+    The log assigns rows in ID order, so every index is an array of rows
+    kept in ascending order (8 bytes an entry): a cursor is one bisection
+    and a page costs O(page size). Status arrays are updated lazily: a
+    message whose status changed stays in its old array until the array is
+    compacted, and queries re-check the field before returning it. Provider
+    message IDs map to rows only while a delivery receipt is still
+    expected, which bounds that map by the number of messages in flight.
+    An index restored from a snapshot serves each phone's rows from the
+    snapshot's buffer until that phone gets a new message, so restoring
+    does not build an array per phone.
+
+    Timestamps only roughly follow the rows: concurrent writers stamp a
+    message before they append it, and workers sharing a database take IDs
+    from different blocks. So time bounds are not bisected on timestamps
+    but on the latest timestamp up to each block of TIME_BLOCK rows, which
+    never decreases, widened by the largest step back in time seen (the
+    lag); the rows in between are checked one by one.
+    """
+    FIELDS = ('status', 'delivery_status')
+    PROVIDER_FIELD = 'provider_message_id'
+    # No receipt changes these, so their provider IDs are no longer looked up
+    FINAL_DELIVERY_STATUSES = ('delivered', 'failed')
+
+    def __init__(self, log: MessageLog):
+        self.log = log
+        self._by_phone: Dict[int, array] = {}
+        self._phone_starts = array('q', [0])
+        self._phone_base = memoryview(array('q'))
+        self._by_field: Dict[str, Dict[int, array]] = {field: {} for field in self.FIELDS}
+        self._columns = {'status': log.statuses, 'delivery_status': log.delivery_statuses}
+        self._stale: Dict[Tuple[str, int], int] = {}
+        self._by_provider: Dict[str, int] = {}
+        self._final_codes = {STATUSES.code(status) for status in self.FINAL_DELIVERY_STATUSES}
+        # Latest timestamp up to the end of each block of rows, and the largest step back
+        self._block_latest = array('q')
+        self._latest = -2 ** 63
+        self._lag = 0
+
+    def __len__(self) -> int:
+        return len(self.log)
+
+    def get(self, msg_id: int):
+        """The message with `msg_id`, or None"""
+        ids = self.log.ids
+        row = bisect_left(ids, msg_id, 0, len(self.log))
+        if row < len(self.log) and ids[row] == msg_id:
+            return self.log[row]
+        return None
+
+    def get_by_provider_id(self, provider_message_id: str):
+        """The in-flight message the provider knows as `provider_message_id`, or None"""
+        row = self._by_provider.get(provider_message_id)
+        return None if row is None else self.log[row]
+
+    def _track_provider_id(self, row: int) -> None:
+        provider_message_id = self.log.get(row, PROVIDER_ID)
+        if provider_message_id is not None and self.log.delivery_statuses[row] not in self._final_codes:
+            self._by_provider[provider_message_id] = row
+
+    def _phone_rows(self, code: Optional[int]):
+        """Rows of a phone code, ascending (read-only)"""
+        rows = self._by_phone.get(code)
+        if rows is None and code is not None and code < len(self._phone_starts) - 1:
+            return self._phone_base[self._phone_starts[code]:self._phone_starts[code + 1]]
+        return rows
+
+    def add(self, msg) -> None:
+        """Index a message just appended to the log"""
+        row = msg.row
+        code = self.log.phone_codes[row]
+        rows = self._by_phone.get(code)
+        if rows is None:
+            rows = array('q')
+            restored = self._phone_rows(code)
+            if restored is not None:
+                rows.frombytes(restored.cast('B'))
+            self._by_phone[code] = rows
+        rows.append(row)
+        for field in self.FIELDS:
+            self._by_field[field].setdefault(self._columns[field][row], array('q')).append(row)
+        self._track_provider_id(row)
+        self._add_timestamp(row, self.log.timestamps[row])
+
+    def _add_timestamp(self, row: int, timestamp: int) -> None:
+        if timestamp < self._latest:
+            self._lag = max(self._lag, self._latest - timestamp)
+        else:
+            self._latest = timestamp
+        if row // TIME_BLOCK < len(self._block_latest):
+            self._block_latest[-1] = self._latest
+        else:
+            self._block_latest.append(self._latest)
+
+    def update(self, msg, field: str, old_value: str) -> None:
+        """Re-index `msg` after `field` changed from `old_value`"""
+        self.update_many([(msg.row, field, old_value)])
+
+    def update_many(self, changes: Iterable[Tuple[int, str, str]]) -> None:
+        """
+        Re-index (row, field, old_value) changes. Rows joining one status
+        array are merged into it together.
+        """
+        joining: Dict[Tuple[str, int], List[int]] = {}
+        leaving: Dict[Tuple[str, int], int] = {}
+        for row, field, old_value in changes:
+            if field == self.PROVIDER_FIELD:
+                if old_value is not None:
+                    self._by_provider.pop(old_value, None)
+                self._track_provider_id(row)
+                continue
+            new_code = self._columns[field][row]
+            old_code = STATUSES.lookup(old_value)
+            if new_code == old_code:
+                continue
+            if field == 'delivery_status' and new_code in self._final_codes:
+                provider_message_id = self.log.get(row, PROVIDER_ID)
+                if provider_message_id is not None:
+                    self._by_provider.pop(provider_message_id, None)
+            joining.setdefault((field, new_code), []).append(row)
+            leaving[(field, old_code)] = leaving.get((field, old_code), 0) + 1
+
+        for (field, code), new_rows in joining.items():
+            lists = self._by_field[field]
+            rows = lists.get(code, array('q'))
+            # Rows can still be present from before (the status went away and came back)
+            new_rows = [row for row in sorted(set(new_rows)) if not _contains(rows, row)]
+            if new_rows:
+                lists[code] = _insert_rows(rows, new_rows)
+
+        for (field, code), count in leaving.items():
+            lists = self._by_field[field]
+            column = self._columns[field]
+            stale = self._stale.get((field, code), 0) + count
+            old_rows = lists.get(code, ())
+            if stale * 2 > len(old_rows):
+                lists[code] = array('q', (row for row in old_rows if column[row] == code))
+                stale = 0
+            self._stale[(field, code)] = stale
+
+    def dump(self) -> Dict:
+        """
+        Status and provider indexes as buffers, for a snapshot. Writers
+        must be held off while it runs; `dump_phones()` need not.
+        """
+        values = STATUSES.values
+        by_field = {field: {values[code]: rows.tobytes() for code, rows in lists.items()}
+                    for field, lists in self._by_field.items()}
+        stale = {(field, values[code]): count for (field, code), count in self._stale.items()}
+        return {
+            'by_field': marshal.dumps(by_field),
+            'stale': marshal.dumps(stale),
+            'by_provider': marshal.dumps(dict(self._by_provider)),
+            'block_latest': self._block_latest.tobytes(),
+            'lag': marshal.dumps((self._latest, self._lag)),
+        }
+
+    def dump_phones(self, length: int, phones: int) -> Dict:
+        """
+        Rows of the first `phones` phone codes below row `length`, for a
+        snapshot. Phone arrays only ever gain higher rows, so this reads a
+        consistent cut without blocking writers.
+        """
+        starts = array('q', [0])
+        parts = []
+        total = 0
+        for code in range(phones):
+            rows = self._by_phone.get(code)
+            if rows is not None:
+                rows = rows[:bisect_left(rows, length)]
+            else:
+                rows = self._phone_rows(code)
+            total += len(rows)
+            starts.append(total)
+            parts.append(rows)
+        return {'phone_starts': starts.tobytes(), 'phone_rows': b''.join(parts)}
+
+    def restore(self, sections) -> None:
+        """Load an empty index from a dump, over a log restored from the same one (startup only)"""
+        self._phone_starts = array('q')
+        self._phone_starts.frombytes(sections['phone_starts'])
+        self._phone_base = memoryview(sections['phone_rows']).cast('q')
+        for field, lists in marshal.loads(sections['by_field']).items():
+            for value, data in lists.items():
+                rows = self._by_field[field][STATUSES.code(value)] = array('q')
+                rows.frombytes(data)
+        self._stale = {(field, STATUSES.code(value)): count
+                       for (field, value), count in marshal.loads(sections['stale']).items()}
+        self._by_provider = marshal.loads(sections['by_provider'])
+        self._block_latest.frombytes(sections['block_latest'])
+        self._latest, self._lag = marshal.loads(sections['lag'])
+
+    def query(self, phone: str = None, status: str = None, delivery_status: str = None,
+              since: float = None, until: float = None, cursor: int = None,
+              limit: int = 20, descending: bool = False) -> Tuple[List, Optional[int]]:
+        """
+        Page through messages matching every given filter.
+        `since`/`until` are epoch seconds (inclusive); `cursor` is the last ID
+        of the previous page. Returns: (messages, next_cursor)
+        """
+        log = self.log
+        empty = array('q')
+        # Filters on values never stored match nothing
+        phone_code = status_code = delivery_code = None
+        candidates = [range(len(log))]
+        if phone is not None:
+            phone_code = log.phones.lookup(phone)
+            candidates.append(self._phone_rows(phone_code) or empty)
+        if status is not None:
+            status_code = STATUSES.lookup(status)
+            candidates.append(self._by_field['status'].get(status_code, empty))
+        if delivery_status is not None:
+            delivery_code = STATUSES.lookup(delivery_status)
+            candidates.append(self._by_field['delivery_status'].get(delivery_code, empty))
+        rows = min(candidates, key=len)
+
+        # IDs grow with the row, and so does the latest timestamp up to a row's block:
+        # rows of a block whose latest is before `since` are all before it, and
+        # rows after a block that is past `until` by more than the lag are all after it
+        block_latest = self._block_latest
+        lo, hi = 0, len(rows)
+        since_us = until_us = None
+        if since is not None:
+            since_us = since * US
+            lo = bisect_left(rows, since_us, key=lambda row: block_latest[row // TIME_BLOCK])
+        if until is not None:
+            until_us = until * US
+            hi = bisect_right(rows, until_us + self._lag,
+                              key=lambda row: block_latest[row // TIME_BLOCK - 1] if row >= TIME_BLOCK else -2 ** 63)
+        timestamps = log.timestamps
+        if cursor is not None:
+            if descending:
+                hi = min(hi, bisect_left(rows, cursor, lo, hi, key=log.ids.__getitem__))
+            else:
+                lo = max(lo, bisect_right(rows, cursor, lo, hi, key=log.ids.__getitem__))
+
+        page = []
+        positions = range(hi - 1, lo - 1, -1) if descending else range(lo, hi)
+        for position in positions:
+            row = rows[position]
+            if phone_code is not None and log.phone_codes[row] != phone_code:
+                continue
+            if status_code is not None and log.statuses[row] != status_code:
+                continue
+            if delivery_code is not None and log.delivery_statuses[row] != delivery_code:
+                continue
+            if since_us is not None and timestamps[row] < since_us:
+                continue
+            if until_us is not None and timestamps[row] > until_us:
+                continue
+            page.append(row)
+            if len(page) > limit:
+                break
+
+        # One extra row tells us whether another page exists
+        if len(page) > limit:
+            page = page[:limit]
+            return [log[row] for row in page], log.ids[page[-1]]
+        return [log[row] for row in page], None
+
+
+def _contains(rows: array, row: int) -> bool:
+    position = bisect_left(rows, row)
+    return position < len(rows) and rows[position] == row
+
+
+class SortedList:
+    """
+    Sorted keys held in chunks of at most 2 * `chunk_size`, with the
+    largest key of each chunk alongside. Finding a key bisects the maxima
+    and then one chunk, and an insert or removal shifts one chunk instead
+    of the whole list.
+    """
+    def __init__(self, chunk_size: int = 512):
+        self._chunk_size = chunk_size
+        self._chunks: List[list] = []
+        self._maxes: list = []
+        self._len = 0
+
+    def __len__(self) -> int:
+        return self._len
+
+    @classmethod
+    def from_sorted(cls, keys: list, chunk_size: int = 512) -> 'SortedList':
+        """A list holding `keys`, which are already sorted"""
+        instance = cls(chunk_size)
+        instance._chunks = [keys[start:start + chunk_size] for start in range(0, len(keys), chunk_size)]
+        instance._maxes = [chunk[-1] for chunk in instance._chunks]
+        instance._len = len(keys)
+        return instance
+
+    def add(self, key) -> None:
+        chunks, maxes = self._chunks, self._maxes
+        self._len += 1
+        if not chunks:
+            chunks.append([key])
+            maxes.append(key)
+            return
+        index = bisect_left(maxes, key)
+        if index == len(maxes):
+            index -= 1
+            chunk = chunks[index]
+            chunk.append(key)
+            maxes[index] = key
+        else:
+            chunk = chunks[index]
+            insort(chunk, key)
+        if len(chunk) > 2 * self._chunk_size:
+            half = len(chunk) // 2
+            chunks[index:index + 1] = [chunk[:half], chunk[half:]]
+            maxes[index:index + 1] = [chunk[half - 1], chunk[-1]]
+
+    def remove(self, key) -> bool:
+        """Remove `key`; returns whether it was present"""
+        chunks, maxes = self._chunks, self._maxes
+        index = bisect_left(maxes, key)
+        if index == len(maxes):
+            return False
+        chunk = chunks[index]
+        position = bisect_left(chunk, key)
+        if chunk[position] != key:
+            return False
+        del chunk[position]
+        self._len -= 1
+        if not chunk:
+            del chunks[index]
+            del maxes[index]
+        elif position == len(chunk):
+            maxes[index] = chunk[-1]
+        return True
+
+    def irange(self, start=None, stop=None, reverse: bool = False) -> Iterator:
+        """Keys from `start` (inclusive) to `stop` (exclusive), ascending or with `reverse` descending"""
+        chunks, maxes = self._chunks, self._maxes
+        if not chunks:
+            return
+        if not reverse:
+            index = 0 if start is None else bisect_left(maxes, start)
+            position = 0 if start is None or index == len(chunks) else bisect_left(chunks[index], start)
+            for index in range(index, len(chunks)):
+                chunk = chunks[index]
+                for position in range(position, len(chunk)):
+                    key = chunk[position]
+                    if stop is not None and key >= stop:
+                        return
+                    yield key
+                position = 0
+            return
+        index = len(chunks) - 1 if stop is None else min(bisect_left(maxes, stop), len(chunks) - 1)
+        position = len(chunks[index]) if stop is None else bisect_left(chunks[index], stop)
+        for index in range(index, -1, -1):
+            chunk = chunks[index]
+            for position in range(position - 1, -1, -1):
+                key = chunk[position]
+                if start is not None and key < start:
+                    return
+                yield key
+            if index:
+                position = len(chunks[index - 1])
+
+
+def scheduled_due_us(entry: Dict) -> int:
+    """When a scheduled entry is due, in epoch microseconds"""
+    # Entries stored before scheduled_at existed only have the submitted time
+    return round(parse_timestamp(entry.get('scheduled_at') or entry['scheduled_time']) * US)
+
+
+class ScheduledIndex:
+    """
+    Scheduled entries ordered by (due time, ID), overall and per status and
+    per phone, each in a SortedList. A range or "next N" query bisects to
+    its first key and reads one key per result, and a cursor is the last
+    key of the previous page. An entry changes place when its due time,
+    status or phone changes, so every list always holds exactly the
+    entries it describes. Reads and writes share one short lock.
+    """
+    def __init__(self):
+        self._entries: Dict[int, Dict] = {}
+        # ID -> (key, status, phone) the entry is indexed under
+        self._indexed: Dict[int, Tuple[Tuple[int, int], str, str]] = {}
+        self._all = SortedList()
+        self._by_status: Dict[str, SortedList] = {}
+        self._by_phone: Dict[str, SortedList] = {}
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def get(self, entry_id: int) -> Optional[Dict]:
+        return self._entries.get(entry_id)
+
+    def load(self, entries: Iterable[Dict]) -> None:
+        """Index entries into an empty index with a single sort (startup only)"""
+        indexed = self._indexed
+        for entry in entries:
+            self._entries[entry['id']] = entry
+            indexed[entry['id']] = ((scheduled_due_us(entry), entry['id']), entry['status'], entry['phone'])
+        keys = sorted(key for key, _, _ in indexed.values())
+        # Walking the sorted keys fills every other list already in order
+        by_status: Dict[str, list] = {}
+        by_phone: Dict[str, list] = {}
+        for key in keys:
+            _, status, phone = indexed[key[1]]
+            by_status.setdefault(status, []).append(key)
+            by_phone.setdefault(phone, []).append(key)
+        self._all = SortedList.from_sorted(keys)
+        self._by_status = {status: SortedList.from_sorted(found) for status, found in by_status.items()}
+        self._by_phone = {phone: SortedList.from_sorted(found) for phone, found in by_phone.items()}
+
+    def add(self, entry: Dict) -> None:
+        """Index a new entry, or re-index a known one after it changed"""
+        key = (scheduled_due_us(entry), entry['id'])
+        indexed = (key, entry['status'], entry['phone'])
+        with self._lock:
+            previous = self._indexed.get(entry['id'])
+            if previous == indexed:
+                return
+            if previous is not None:
+                self._unindex(*previous)
+            self._entries[entry['id']] = entry
+            self._indexed[entry['id']] = indexed
+            self._all.add(key)
+            self._by_status.setdefault(entry['status'], SortedList()).add(key)
+            self._by_phone.setdefault(entry['phone'], SortedList()).add(key)
+
+    update = add
+
+    def _unindex(self, key: Tuple[int, int], status: str, phone: str) -> None:
+        self._all.remove(key)
+        for lists, value in ((self._by_status, status), (self._by_phone, phone)):
+            keys = lists[value]
+            keys.remove(key)
+            if not keys:
+                del lists[value]
+
+    def query(self, phone: str = None, status: str = None, since: float = None, until: float = None,
+              cursor: Tuple[int, int] = None, limit: int = 20,
+              descending: bool = False) -> Tuple[List[Dict], Optional[Tuple[int, int]]]:
+        """
+        Page through entries matching every given filter, by due time.
+        `since`/`until` are epoch seconds (inclusive); `cursor` is the
+        (due, ID) key returned with the previous page.
+        Returns: (entries, next_cursor)
+        """
+        start = None if since is None else (round(since * US),)
+        stop = None if until is None else (round(until * US) + 1,)
+        if cursor is not None:
+            if descending:
+                stop = cursor if stop is None else min(stop, cursor)
+            else:
+                after = (cursor[0], cursor[1] + 1)
+                start = after if start is None else max(start, after)
+
+        page = []
+        with self._lock:
+            candidates = [self._all]
+            if phone is not None:
+                candidates.append(self._by_phone.get(phone, SortedList()))
+            if status is not None:
+                candidates.append(self._by_status.get(status, SortedList()))
+            keys = min(candidates, key=len)
+            for key in keys.irange(start, stop, reverse=descending):
+                _, entry_status, entry_phone = self._indexed[key[1]]
+                if status is not None and entry_status != status:
+                    continue
+                if phone is not None and entry_phone != phone:
+                    continue
+                page.append(key)
+                # One extra key tells us whether another page exists
+                if len(page) > limit:
+                    break
+            entries = [self._entries[key[1]] for key in page[:limit]]
+        if len(page) > limit:
+            return entries, page[limit - 1]
+        return entries, None
@@ -0,0 +1,309 @@
+"""
+SMS Platform - Journal
+Append-only log of store changes, made durable before a request is acknowledged
+"""
+
+import fcntl
+import glob
+import marshal
+import os
+import struct
+import threading
+import time
+import zlib
+from typing import Callable, Dict, Iterable, Iterator, List, Tuple
+
+# payload length, payload CRC-32
+FRAME = struct.Struct('<II')
+SEGMENT_SUFFIX = '.journal'
+LOCK_SUFFIX = '.lock'
+
+# fdatasync skips metadata a read does not need; not every platform has it
+_sync = getattr(os, 'fdatasync', os.fsync)
+
+
+class JournalError(Exception):
+    """A journal write failed, so changes can no longer be made durable"""
+
+
+def _fsync_directory(path: str) -> None:
+    directory_fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(directory_fd)
+    finally:
+        os.close(directory_fd)
+
+
+def _key(row):
+    # Store rows are dicts with an ID; idempotency rows are tuples keyed by their first field
+    return row['id'] if isinstance(row, dict) else row[0]
+
+
+def read_segment(path: str) -> Iterator[Tuple[str, list]]:
+    """
+    (table, rows) records of a segment file, in the order written. Reading
+    stops at the first incomplete or damaged frame: a crash during a write
+    leaves one at the end, and nothing after it was acknowledged.
+    """
+    with open(path, 'rb') as f:
+        data = memoryview(f.read())
+    offset = 0
+    while offset + FRAME.size <= len(data):
+        length, checksum = FRAME.unpack_from(data, offset)
+        start = offset + FRAME.size
+        payload = data[start:start + length]
+        if len(payload) != length or zlib.crc32(payload) != checksum:
+            return
+        try:
+            record = marshal.loads(payload)
+        except (EOFError, ValueError, TypeError):
+            return
+        yield record
+        offset = start + length
+
+
+class Journal:
+    """
+    Write-ahead journal of store changes, one per process.
+    `append()` encodes a record into a memory buffer and returns its
+    sequence number. A committer thread writes out and fsyncs whatever is
+    buffered, so every record appended during one fsync shares the next
+    (group commit); a `commit_window` makes it wait that many seconds for
+    more records first. `wait()` blocks until the calling thread's records
+    are durable.
+
+    Each process writes its own segment files in `directory` and holds a
+    lock on its lock file while it runs. `recover()` takes over the
+    segments of processes that are gone. `compact(checkpoint)` starts a new
+    segment, runs `checkpoint()` to make every earlier change durable
+    elsewhere (a synced database flush or a snapshot), then deletes the segments
+    before it.
+    """
+    def __init__(self, directory: str, commit_window: float = 0.0):
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.commit_window = commit_window
+        # Names sort by start time, so recovery applies older processes' rows first
+        self.name = f'{time.time_ns() // 1000:014x}-{os.getpid()}'
+        self.commits = 0
+        self.records = 0
+        self._lock_path = os.path.join(directory, self.name + LOCK_SUFFIX)
+        self._lock_file = open(self._lock_path, 'wb')
+        fcntl.flock(self._lock_file, fcntl.LOCK_EX)
+        self._segments: List[str] = []
+        self._segment_number = 0
+        self._fd = self._open_segment()
+        # (lock file, lock path, segments) of the processes recovered from
+        self._adopted: List[Tuple[object, str, List[str]]] = []
+
+        self._lock = threading.Lock()
+        self._pending = threading.Condition(self._lock)
+        self._committed = threading.Condition(self._lock)
+        self._write_lock = threading.Lock()
+        self._buffer = bytearray()
+        self._appended = 0
+        self._durable = 0
+        self._error = None
+        self._closed = False
+        self._stopped = False
+        self._local = threading.local()
+        self._stop = threading.Event()
+        self._committer = None
+        self._compactor = None
+
+    def _open_segment(self) -> int:
+        self._segment_number += 1
+        path = os.path.join(self.directory, f'{self.name}-{self._segment_number:06d}{SEGMENT_SUFFIX}')
+        fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o644)
+        # Make the new file itself durable, not only what is written to it
+        _fsync_directory(self.directory)
+        self._segments.append(path)
+        return fd
+
+    def append(self, table: str, records: Iterable, to_row: Callable = None) -> int:
+        """
+        Journal the current state of `records` of `table` as one record and
+        return its sequence number. Rows are read (through `to_row`) under
+        the journal's lock, so the last record holding a row has every change
+        to it that was journaled before.
+        """
+        with self._lock:
+            rows = [to_row(record) for record in records] if to_row is not None else list(records)
+            payload = marshal.dumps((table, rows))
+            if not self._buffer:
+                self._pending.notify()
+            self._buffer += FRAME.pack(len(payload), zlib.crc32(payload))
+            self._buffer += payload
+            self._appended += 1
+            lsn = self._appended
+        self._local.lsn = lsn
+        return lsn
+
+    def wait(self) -> None:
+        """Block until every record the calling thread appended is durable"""
+        lsn = getattr(self._local, 'lsn', 0)
+        if lsn <= self._durable:
+            return
+        with self._lock:
+            while self._durable < lsn:
+                if self._error is not None:
+                    raise JournalError(str(self._error)) from self._error
+                if self._stopped:
+                    raise JournalError('Journal is stopped')
+                self._committed.wait()
+
+    def commit(self) -> None:
+        """Write and fsync everything buffered, then wake the threads waiting for it"""
+        with self._write_lock:
+            with self._lock:
+                data, self._buffer = self._buffer, bytearray()
+                appended = self._appended
+            if data and self._error is None:
+                try:
+                    view = memoryview(data)
+                    while view:
+                        view = view[os.write(self._fd, view):]
+                    _sync(self._fd)
+                except OSError as exc:
+                    # What was written may end in a torn frame; later records
+                    # would be unreadable after it, so stop journaling
+                    with self._lock:
+                        self._error = exc
+                        self._committed.notify_all()
+                    return
+            with self._lock:
+                if self._error is None:
+                    self.records += appended - self._durable
+                    self.commits += 1 if data else 0
+                    self._durable = appended
+                self._committed.notify_all()
+
+    def recover(self) -> Dict[str, list]:
+        """
+        Rows journaled by processes that are no longer running, by table:
+        the last row journaled under each key, in key order. Their segments
+        are deleted by the next compact(), so a crash before then recovers
+        them again.
+        """
+        latest: Dict[str, dict] = {}
+        for lock_path in sorted(glob.glob(os.path.join(glob.escape(self.directory), '*' + LOCK_SUFFIX))):
+            name = os.path.basename(lock_path)[:-len(LOCK_SUFFIX)]
+            if name == self.name:
+                continue
+            try:
+                lock_file = os.fdopen(os.open(lock_path, os.O_WRONLY), 'wb')
+            except FileNotFoundError:
+                continue
+            try:
+                fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                # Its process is still running
+                lock_file.close()
+                continue
+            segments = sorted(glob.glob(os.path.join(glob.escape(self.directory),
+                                                     glob.escape(name) + '-*' + SEGMENT_SUFFIX)))
+            for segment in segments:
+                for table, rows in read_segment(segment):
+                    by_key = latest.setdefault(table, {})
+                    for row in rows:
+                        by_key[_key(row)] = row
+            self._adopted.append((lock_file, lock_path, segments))
+        return {table: [rows[key] for key in sorted(rows)] for table, rows in latest.items()}
+
+    def compact(self, checkpoint: Callable[[], None]) -> int:
+        """
+        Start a new segment, run `checkpoint()`, which must make every change
+        journaled so far durable elsewhere, then delete the older segments and
+        the recovered ones. Returns the number of segments deleted.
+        """
+        with self._write_lock:
+            old_segments, self._segments = self._segments, []
+            old_fd = self._fd
+            self._fd = self._open_segment()
+            os.close(old_fd)
+            adopted, self._adopted = self._adopted, []
+        try:
+            checkpoint()
+        except BaseException:
+            with self._write_lock:
+                self._segments[:0] = old_segments
+                self._adopted[:0] = adopted
+            raise
+
+        deleted = 0
+        for path in old_segments + [path for _, _, segments in adopted for path in segments]:
+            try:
+                os.remove(path)
+                deleted += 1
+            except FileNotFoundError:
+                pass
+        # Segments go before lock files: a lock file with no segments recovers nothing
+        for lock_file, lock_path, _ in adopted:
+            try:
+                os.remove(lock_path)
+            except FileNotFoundError:
+                pass
+            lock_file.close()
+        return deleted
+
+    def start(self, checkpoint: Callable[[], None] = None, compact_interval: float = 60.0) -> None:
+        """Start committing, and compacting every `compact_interval` seconds when there is a `checkpoint`"""
+        if self._committer is not None:
+            return
+        self._committer = threading.Thread(target=self._run_commits, name='sms-journal', daemon=True)
+        self._committer.start()
+        if checkpoint is not None and compact_interval > 0:
+            self._compactor = threading.Thread(target=self._run_compaction, args=(checkpoint, compact_interval),
+                                               name='sms-journal-compact', daemon=True)
+            self._compactor.start()
+
+    def stop(self, checkpoint: Callable[[], None] = None) -> None:
+        """
+        Commit what is buffered and stop. With `checkpoint`, the journal is
+        then compacted and its files removed, since a restart has nothing
+        to recover from it.
+        """
+        self._stop.set()
+        if self._compactor is not None:
+            self._compactor.join()
+            self._compactor = None
+        with self._lock:
+            self._closed = True
+            self._pending.notify()
+        if self._committer is not None:
+            self._committer.join()
+            self._committer = None
+        self.commit()
+        with self._lock:
+            self._stopped = True
+            self._committed.notify_all()
+        if checkpoint is None or self._error is not None:
+            return
+        self.compact(checkpoint)
+        with self._write_lock:
+            os.close(self._fd)
+            for path in self._segments:
+                os.remove(path)
+            self._segments = []
+        os.remove(self._lock_path)
+        self._lock_file.close()
+
+    def _run_commits(self) -> None:
+        while True:
+            with self._lock:
+                while not self._buffer and not self._closed:
+                    self._pending.wait()
+                if not self._buffer:
+                    return
+            if self.commit_window > 0:
+                # Let concurrent requests join this fsync
+                time.sleep(self.commit_window)
+            self.commit()
+
+    def _run_compaction(self, checkpoint: Callable[[], None], interval: float) -> None:
+        while not self._stop.wait(interval):
+            try:
+                self.compact(checkpoint)
+            except Exception:
+                # The segments stay; they are compacted on the next tick
+                pass
@@ -0,0 +1,284 @@
+"""
+SMS Platform - Metrics
+Request latency histograms, counters and gauges in Prometheus text format
+"""
+
+import glob
+import json
+import mmap
+import os
+import struct
+import threading
+from bisect import bisect_left
+from typing import Callable, Dict, Iterable, List, Optional, Tuple
+
+# Request latency buckets (seconds), upper bounds as in Prometheus' `le`
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+# File: bytes in use, then entries of (key length, value count), key padded to 8 bytes, values
+USED = struct.Struct('<Q')
+ENTRY = struct.Struct('<II')
+INITIAL_SIZE = 64 * 1024
+
+REQUESTS = 'sms_http_requests_total'
+ERRORS = 'sms_http_request_errors_total'
+DURATION = 'sms_http_request_duration_seconds'
+
+Labels = Tuple[Tuple[str, str], ...]
+
+
+def _pad(size: int) -> int:
+    return (size + 7) & ~7
+
+
+def _format_value(value: float) -> str:
+    if value == float('inf'):
+        return '+Inf'
+    return str(int(value)) if float(value).is_integer() else repr(value)
+
+
+def _format_labels(labels: Iterable[Tuple[str, str]]) -> str:
+    pairs = []
+    for name, value in labels:
+        value = str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+        pairs.append(f'{name}="{value}"')
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+def _pid_alive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def read_series(data: bytes) -> Dict[Tuple[str, Labels], List[float]]:
+    """Series stored in a metrics file: (name, labels) -> values"""
+    series = {}
+    used = USED.unpack_from(data, 0)[0] if len(data) >= USED.size else 0
+    offset = USED.size
+    while offset < used:
+        key_size, count = ENTRY.unpack_from(data, offset)
+        offset += ENTRY.size
+        name, labels = json.loads(data[offset:offset + key_size])
+        offset += _pad(key_size)
+        series[(name, tuple(map(tuple, labels)))] = list(struct.unpack_from(f'<{count}d', data, offset))
+        offset += 8 * count
+    return series
+
+
+class Metrics:
+    """
+    Counters, histograms and gauges of one process, kept as doubles in a
+    memory map. Each series is registered once (appended to the map) and
+    then updated in place, so recording a request costs a dict lookup, a
+    bisection and three additions under an uncontended lock.
+
+    With `directory` set every gunicorn worker writes its own
+    metrics-<pid>.db file there and a scrape of any worker adds up the
+    files of all of them. Counters and histograms of exited workers are
+    kept so totals never go backwards; gauges are read from live workers
+    only, summed or maxed as each one asks. The directory should be empty
+    when the server starts.
+    """
+    def __init__(self, directory: str = None, buckets: Iterable[float] = DEFAULT_BUCKETS):
+        self.buckets = tuple(buckets)
+        self.directory = directory or None
+        self._lock = threading.Lock()
+        self._slots: Dict[Tuple[str, Labels], int] = {}
+        self._request_slots: Dict[Tuple[str, str, int], Tuple[int, int]] = {}
+        self._types: Dict[str, Tuple[str, str, str]] = {}
+        self._gauges: Dict[str, Callable[[], float]] = {}
+        self._stop = threading.Event()
+        self._thread = None
+
+        self._fd = None
+        self.path = None
+        if self.directory:
+            os.makedirs(self.directory, exist_ok=True)
+            self.path = os.path.join(self.directory, f'metrics-{os.getpid()}.db')
+            self._fd = os.open(self.path, os.O_RDWR | os.O_CREAT | os.O_TRUNC, 0o600)
+        self._map = None
+        self._resize(INITIAL_SIZE)
+        self._used = USED.size
+        USED.pack_into(self._map, 0, self._used)
+
+        self.describe(REQUESTS, 'counter', 'HTTP requests by route, method and status')
+        self.describe(ERRORS, 'counter', 'HTTP requests answered with a 5xx status')
+        self.describe(DURATION, 'histogram', 'HTTP request latency in seconds')
+
+    def _resize(self, size: int) -> None:
+        if self._fd is not None:
+            os.ftruncate(self._fd, size)
+            new_map = mmap.mmap(self._fd, size)
+        else:
+            new_map = mmap.mmap(-1, size)
+        if self._map is not None:
+            new_map[:self._used] = self._map[:self._used]
+        self._map = new_map
+        # Doubles of the whole map, so a slot is an index into this view
+        self._values = memoryview(new_map).cast('d')
+
+    def describe(self, name: str, kind: str, help_text: str, aggregate: str = 'sum') -> None:
+        """Declare a metric: kind is counter, gauge or histogram; gauges aggregate by sum or max"""
+        self._types[name] = (kind, help_text, aggregate)
+
+    def _slot(self, name: str, labels: Labels, count: int) -> int:
+        """Index of the first value of a series, registering it if new"""
+        key = (name, labels)
+        slot = self._slots.get(key)
+        if slot is not None:
+            return slot
+        with self._lock:
+            slot = self._slots.get(key)
+            if slot is not None:
+                return slot
+            encoded = json.dumps([name, labels]).encode()
+            offset = self._used + ENTRY.size + _pad(len(encoded))
+            end = offset + 8 * count
+            if end > len(self._map):
+                size = len(self._map)
+                while size < end:
+                    size *= 2
+                self._resize(size)
+            ENTRY.pack_into(self._map, self._used, len(encoded), count)
+            self._map[self._used + ENTRY.size:self._used + ENTRY.size + len(encoded)] = encoded
+            # Readers in other processes trust everything below `used`, so it moves last
+            self._used = end
+            USED.pack_into(self._map, 0, end)
+            slot = self._slots[key] = offset // 8
+            return slot
+
+    def inc(self, name: str, amount: float = 1, **labels) -> None:
+        slot = self._slot(name, tuple(sorted(labels.items())), 1)
+        with self._lock:
+            self._values[slot] += amount
+
+    def set(self, name: str, value: float, **labels) -> None:
+        slot = self._slot(name, tuple(sorted(labels.items())), 1)
+        with self._lock:
+            self._values[slot] = value
+
+    def observe(self, name: str, seconds: float, **labels) -> None:
+        slot = self._slot(name, tuple(sorted(labels.items())), len(self.buckets) + 2)
+        bucket = bisect_left(self.buckets, seconds)
+        with self._lock:
+            values = self._values
+            values[slot + bucket] += 1
+            values[slot + len(self.buckets) + 1] += seconds
+
+    def observe_request(self, route: str, method: str, status: int, seconds: float) -> None:
+        """Count a request and add its latency to the route's histogram"""
+        slots = self._request_slots.get((route, method, status))
+        if slots is None:
+            slots = self._request_slots[(route, method, status)] = (
+                self._slot(REQUESTS, (('method', method), ('route', route), ('status', str(status))), 1),
+                self._slot(DURATION, (('method', method), ('route', route)), len(self.buckets) + 2)
+            )
+        counter, histogram = slots
+        bucket = bisect_left(self.buckets, seconds)
+        with self._lock:
+            values = self._values
+            values[counter] += 1
+            values[histogram + bucket] += 1
+            values[histogram + len(self.buckets) + 1] += seconds
+
+    def gauge(self, name: str, help_text: str, callback: Callable[[], float], aggregate: str = 'sum') -> None:
+        """Register a gauge read from `callback()` whenever gauges are collected"""
+        self.describe(name, 'gauge', help_text, aggregate)
+        self._gauges[name] = callback
+
+    def collect(self) -> None:
+        """Write the current value of every registered gauge"""
+        for name, callback in self._gauges.items():
+            self.set(name, callback())
+
+    def start(self, interval: float) -> None:
+        """Collect gauges every `interval` seconds, so idle workers stay current"""
+        if self._thread is not None or not self._gauges:
+            return
+        self._stop.clear()
+
+        def run():
+            while not self._stop.wait(interval):
+                self.collect()
+
+        self._thread = threading.Thread(target=run, name='sms-metrics', daemon=True)
+        self._thread.start()
+
+    def stop(self) -> None:
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def _files(self) -> List[Tuple[Optional[int], bytes]]:
+        """(pid, contents) of every process' metrics"""
+        if not self.directory:
+            return [(None, self._map[:self._used])]
+        files = []
+        for path in glob.glob(os.path.join(self.directory, 'metrics-*.db')):
+            try:
+                pid = int(os.path.basename(path)[len('metrics-'):-len('.db')])
+                with open(path, 'rb') as file:
+                    files.append((pid, file.read()))
+            except (ValueError, OSError):
+                continue
+        return files
+
+    def render(self) -> str:
+        """Every metric of every worker, in Prometheus text exposition format"""
+        self.collect()
+        merged: Dict[Tuple[str, Labels], List[float]] = {}
+        for pid, data in self._files():
+            live = pid is None or pid == os.getpid() or _pid_alive(pid)
+            for (name, labels), values in read_series(data).items():
+                kind, _, aggregate = self._types.get(name, ('untyped', '', 'sum'))
+                if kind == 'gauge' and not live:
+                    continue
+                current = merged.get((name, labels))
+                if current is None:
+                    merged[(name, labels)] = values
+                elif kind == 'gauge' and aggregate == 'max':
+                    merged[(name, labels)] = [max(a, b) for a, b in zip(current, values)]
+                else:
+                    merged[(name, labels)] = [a + b for a, b in zip(current, values)]
+
+        # Server errors are the 5xx share of the request counter
+        for (name, labels), values in list(merged.items()):
+            if name == REQUESTS and dict(labels)['status'].startswith('5'):
+                key = (ERRORS, tuple(pair for pair in labels if pair[0] != 'status'))
+                merged[key] = [merged.get(key, [0.0])[0] + values[0]]
+
+        by_name: Dict[str, List[Tuple[Labels, List[float]]]] = {}
+        for (name, labels), values in sorted(merged.items()):
+            by_name.setdefault(name, []).append((labels, values))
+
+        lines = []
+        for name, series in by_name.items():
+            kind, help_text, _ = self._types.get(name, ('untyped', '', 'sum'))
+            lines.append(f'# HELP {name} {help_text}')
+            lines.append(f'# TYPE {name} {kind}')
+            for labels, values in series:
+                if kind != 'histogram':
+                    lines.append(f'{name}{_format_labels(labels)} {_format_value(values[0])}')
+                    continue
+                cumulative = 0.0
+                for bound, count in zip(self.buckets + (float('inf'),), values):
+                    cumulative += count
+                    bucket_labels = labels + (('le', _format_value(bound)),)
+                    lines.append(f'{name}_bucket{_format_labels(bucket_labels)} {_format_value(cumulative)}')
+                lines.append(f'{name}_sum{_format_labels(labels)} {_format_value(values[-1])}')
+                lines.append(f'{name}_count{_format_labels(labels)} {_format_value(cumulative)}')
+        return '\n'.join(lines) + '\n'
+
+    def close(self) -> None:
+        self.stop()
+        self._values.release()
+        self._map.close()
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
@@ -3,27 +3,362 @@ SMS Platform - Database Models
 Simple in-memory data models (replace with SQLAlchemy for production)
 """
 
+import marshal
+import threading
+from array import array
 from datetime import datetime
-from typing import List, Dict, Optional
+from functools import lru_cache
+from typing import List, Dict, Optional, Sequence, Tuple
+
+US = 1_000_000
+
+
+def now_us() -> int:
+    """Current time as integer epoch microseconds"""
+    return to_epoch_us(datetime.now())
+
+
+def to_epoch_us(dt: datetime) -> int:
+    # Whole seconds and microseconds separately, so the round trip is exact
+    return int(dt.replace(microsecond=0).timestamp()) * US + dt.microsecond
+
+
+def from_iso(value: str) -> int:
+    """Local ISO timestamp to epoch microseconds"""
+    return to_epoch_us(datetime.fromisoformat(value))
+
+
+def to_iso(timestamp_us: Optional[int]) -> Optional[str]:
+    """Epoch microseconds to a local ISO timestamp"""
+    if timestamp_us is None:
+        return None
+    seconds, micros = divmod(timestamp_us, US)
+    if micros:
+        return f'{_iso_seconds(seconds)}.{micros:06d}'
+    return _iso_seconds(seconds)
+
+
+@lru_cache(maxsize=4096)
+def _iso_seconds(seconds: int) -> str:
+    # Messages cluster in time, so consecutive rows usually share a second
+    return datetime.fromtimestamp(seconds).isoformat()
+
+
+class StringTable:
+    """
+    Interned strings addressed by small integer codes.
+    Used for values that repeat across many messages (statuses, phones).
+    """
+    def __init__(self, values: Sequence[str] = ()):
+        self.values: List[str] = []
+        self._codes: Dict[str, int] = {}
+        self._lock = threading.Lock()
+        for value in values:
+            self.code(value)
+
+    def __len__(self) -> int:
+        return len(self.values)
+
+    def code(self, value: str) -> int:
+        """Code of `value`, adding it if it is new"""
+        code = self._codes.get(value)
+        if code is None:
+            with self._lock:
+                code = self._codes.get(value)
+                if code is None:
+                    code = len(self.values)
+                    self.values.append(value)
+                    self._codes[value] = code
+        return code
+
+    def lookup(self, value: str) -> Optional[int]:
+        """Code of `value` if it is already interned"""
+        return self._codes.get(value)
+
+    def restore(self, values: Sequence[str]) -> None:
+        """Replace the table with `values`, coded in order (startup only)"""
+        with self._lock:
+            self.values = list(values)
+            self._codes = dict(zip(self.values, range(len(self.values))))
+
+
+# Every status and delivery status shares one table; unknown values are added
+STATUSES = StringTable(('queued', 'sent', 'failed', 'pending', 'delivered', 'undelivered'))
+
+
+class BlobTable:
+    """
+    Append-only strings packed into one UTF-8 buffer with an offset per
+    entry (about 8 bytes of overhead per string instead of a str object).
+    A string equal to one of the recently added ones reuses its entry, so
+    a body sent to many recipients is stored once. A table restored from a
+    snapshot reads its old entries straight from the snapshot's buffer
+    (usually a memory map, paged in as entries are read) and keeps only
+    entries added since in its own buffer.
+    """
+    def __init__(self, recent: int = 0):
+        self._base = b''
+        self._base_size = 0
+        self._data = bytearray()
+        self._offsets = array('Q', [0])
+        self._recent: Dict[str, int] = {}
+        self._recent_size = recent
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._offsets) - 1
+
+    def add(self, value: str) -> int:
+        encoded = value.encode('utf-8')
+        with self._lock:
+            if self._recent_size:
+                code = self._recent.get(value)
+                if code is not None:
+                    return code
+            self._data += encoded
+            self._offsets.append(self._base_size + len(self._data))
+            code = len(self._offsets) - 2
+            if self._recent_size:
+                if len(self._recent) >= self._recent_size:
+                    self._recent.clear()
+                self._recent[value] = code
+        return code
+
+    def get(self, code: int) -> str:
+        start, end = self._offsets[code], self._offsets[code + 1]
+        base = self._base_size
+        if start < base:
+            return str(self._base[start:end], 'utf-8')
+        return self._data[start - base:end - base].decode('utf-8')
+
+    def dump(self) -> Tuple[tuple, bytes]:
+        """(data buffers, offsets) of every entry, for a snapshot"""
+        with self._lock:
+            return (self._base, bytes(self._data)), self._offsets.tobytes()
+
+    def restore(self, data, offsets) -> None:
+        """Take the entries of a dump; `data` is read in place (startup only)"""
+        with self._lock:
+            self._base = data
+            self._base_size = len(data)
+            self._data = bytearray()
+            self._offsets = array('Q')
+            self._offsets.frombytes(offsets)
+            self._recent.clear()
+
+
+# Slots of a message row, shared by detached messages and MessageLog columns
+ID, TIMESTAMP, PHONE, BODY, STATUS, DELIVERY_STATUS, PROVIDER_ID = range(7)
+NO_PROVIDER_ID = -1
+COLUMNS = ('ids', 'timestamps', 'phone_codes', 'body_codes', 'statuses', 'delivery_statuses',
+           'provider_codes')
+
+
+class MessageLog:
+    """
+    Append-only columnar message store.
+    Each field is a typed array indexed by row: IDs and epoch-microsecond
+    timestamps as 64-bit ints, phones and statuses as codes into interned
+    string tables, bodies and provider IDs as codes into packed blob
+    tables. Messages are materialised as `Message` views on demand.
+    Appends must be serialised by the caller; reads need no lock.
+    """
+    def __init__(self):
+        self.ids = array('q')
+        self.timestamps = array('q')
+        self.phone_codes = array('I')
+        self.body_codes = array('I')
+        self.statuses = array('B')
+        self.delivery_statuses = array('B')
+        self.provider_codes = array('q')
+        self.phones = StringTable()
+        self.bodies = BlobTable(recent=1024)
+        self.provider_ids = BlobTable()
+        self._length = 0
+
+    def __len__(self) -> int:
+        return self._length
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [Message.view(self, row) for row in range(*index.indices(self._length))]
+        if index < 0:
+            index += self._length
+        if not 0 <= index < self._length:
+            raise IndexError('message row out of range')
+        return Message.view(self, index)
+
+    def __iter__(self):
+        for row in range(self._length):
+            yield Message.view(self, row)
+
+    def append(self, msg: 'Message') -> int:
+        """Store a detached message; it becomes a view of the new row"""
+        if msg._log is not None:
+            raise ValueError('Message is already stored')
+        values = msg._row
+        row = self._length
+        if row and values[ID] <= self.ids[row - 1]:
+            raise ValueError('Message IDs must increase with every append')
+        self.ids.append(values[ID])
+        self.timestamps.append(values[TIMESTAMP])
+        self.phone_codes.append(self.phones.code(values[PHONE]))
+        self.body_codes.append(self.bodies.add(values[BODY]))
+        self.statuses.append(STATUSES.code(values[STATUS]))
+        self.delivery_statuses.append(STATUSES.code(values[DELIVERY_STATUS]))
+        provider_id = values[PROVIDER_ID]
+        self.provider_codes.append(NO_PROVIDER_ID if provider_id is None else self.provider_ids.add(provider_id))
+        # Publish the row only once every column has it
+        self._length = row + 1
+        msg._log, msg._row = self, row
+        return row
+
+    def dump(self) -> Dict:
+        """
+        Columns and tables as buffers, for a snapshot. Appends and status
+        changes must be held off while it runs.
+        """
+        sections = {name: getattr(self, name).tobytes() for name in COLUMNS}
+        sections['phones'] = marshal.dumps(self.phones.values[:])
+        sections['status_values'] = marshal.dumps(STATUSES.values[:])
+        sections['bodies'], sections['body_offsets'] = self.bodies.dump()
+        sections['provider_ids'], sections['provider_offsets'] = self.provider_ids.dump()
+        return sections
+
+    def restore(self, sections) -> None:
+        """Load an empty log from a dump; bodies stay in the dump's buffers (startup only)"""
+        # Status codes are per process; translate the dump's codes to ours
+        codes = bytearray(range(256))
+        for code, value in enumerate(marshal.loads(sections['status_values'])):
+            codes[code] = STATUSES.code(value)
+        for name in COLUMNS:
+            data = sections[name]
+            if name in ('statuses', 'delivery_statuses'):
+                data = bytes(data).translate(codes)
+            getattr(self, name).frombytes(data)
+        self.phones.restore(marshal.loads(sections['phones']))
+        self.bodies.restore(sections['bodies'], sections['body_offsets'])
+        self.provider_ids.restore(sections['provider_ids'], sections['provider_offsets'])
+        self._length = len(self.ids)
+
+    def get(self, row: int, slot: int):
+        if slot == ID:
+            return self.ids[row]
+        if slot == TIMESTAMP:
+            return self.timestamps[row]
+        if slot == PHONE:
+            return self.phones.values[self.phone_codes[row]]
+        if slot == BODY:
+            return self.bodies.get(self.body_codes[row])
+        if slot == STATUS:
+            return STATUSES.values[self.statuses[row]]
+        if slot == DELIVERY_STATUS:
+            return STATUSES.values[self.delivery_statuses[row]]
+        code = self.provider_codes[row]
+        return None if code == NO_PROVIDER_ID else self.provider_ids.get(code)
+
+    def to_dict(self, row: int) -> Dict:
+        # Reads the columns directly; serialising rows is the hot path of listings and exports
+        provider_code = self.provider_codes[row]
+        return {
+            'id': self.ids[row],
+            'phone': self.phones.values[self.phone_codes[row]],
+            'message': self.bodies.get(self.body_codes[row]),
+            'timestamp': to_iso(self.timestamps[row]),
+            'status': STATUSES.values[self.statuses[row]],
+            'delivery_status': STATUSES.values[self.delivery_statuses[row]],
+            'provider_message_id': None if provider_code == NO_PROVIDER_ID else self.provider_ids.get(provider_code)
+        }
+
+    def set(self, row: int, slot: int, value) -> None:
+        if slot == STATUS:
+            self.statuses[row] = STATUSES.code(value)
+        elif slot == DELIVERY_STATUS:
+            self.delivery_statuses[row] = STATUSES.code(value)
+        elif slot == PROVIDER_ID:
+            self.provider_codes[row] = NO_PROVIDER_ID if value is None else self.provider_ids.add(value)
+        elif slot == TIMESTAMP:
+            self.timestamps[row] = value
+        else:
+            raise AttributeError('Message ID, phone and body are immutable once stored')
+
+
+def _field(slot: int):
+    def get(self):
+        if self._log is None:
+            return self._row[slot]
+        return self._log.get(self._row, slot)
+
+    def set(self, value):
+        if self._log is None:
+            self._row[slot] = value
+        else:
+            self._log.set(self._row, slot, value)
+
+    return property(get, set)
+
 
 class Message:
-    """SMS Message Model"""
+    """
+    SMS Message Model.
+    A new message keeps its own fields until it is appended to a
+    MessageLog; from then on it is a view of its row there, and every
+    view of that row sees the same state.
+    """
+    __slots__ = ('_log', '_row')
+
     def __init__(self, phone: str, message: str, message_id: int = None):
-        self.id = message_id
-        self.phone = phone
-        self.message = message
-        self.timestamp = datetime.now().isoformat()
-        self.status = 'sent'
-        self.delivery_status = 'pending'
+        self._log = None
+        self._row = [message_id, now_us(), phone, message, 'sent', 'pending', None]
+
+    @classmethod
+    def view(cls, log: MessageLog, row: int) -> 'Message':
+        msg = cls.__new__(cls)
+        msg._log, msg._row = log, row
+        return msg
+
+    id = _field(ID)
+    timestamp_us = _field(TIMESTAMP)
+    phone = _field(PHONE)
+    message = _field(BODY)
+    status = _field(STATUS)
+    delivery_status = _field(DELIVERY_STATUS)
+    provider_message_id = _field(PROVIDER_ID)
+
+    @property
+    def row(self) -> Optional[int]:
+        """Row in the owning MessageLog, None while detached"""
+        return self._row if self._log is not None else None
+
+    @property
+    def timestamp(self) -> str:
+        return to_iso(self.timestamp_us)
+
+    @timestamp.setter
+    def timestamp(self, value: str) -> None:
+        self.timestamp_us = from_iso(value)
+
+    @classmethod
+    def from_dict(cls, data: Dict) -> 'Message':
+        msg = cls(data['phone'], data['message'], data.get('id'))
+        if data.get('timestamp'):
+            msg.timestamp = data['timestamp']
+        msg.status = data.get('status', msg.status)
+        msg.delivery_status = data.get('delivery_status', msg.delivery_status)
+        msg.provider_message_id = data.get('provider_message_id')
+        return msg
     
     def to_dict(self) -> Dict:
+        if self._log is not None:
+            return self._log.to_dict(self._row)
         return {
             'id': self.id,
             'phone': self.phone,
             'message': self.message,
             'timestamp': self.timestamp,
             'status': self.status,
-            'delivery_status': self.delivery_status
+            'delivery_status': self.delivery_status,
+            'provider_message_id': self.provider_message_id
         }
 
 
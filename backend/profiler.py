@@ -0,0 +1,127 @@
+"""
+SMS Platform - Request Profiler
+Sampled stack profiles of individual requests, as folded stacks for flamegraphs
+"""
+
+import os
+import sys
+import threading
+import time
+from typing import Dict
+
+# Stacks beyond this many distinct ones per endpoint are counted as one
+MAX_STACKS = 10000
+TRUNCATED = '[other stacks]'
+
+
+class SamplingProfiler:
+    """
+    Statistical profiler for chosen requests. A request thread registers
+    itself with `begin(endpoint)` and leaves with `end()`; while any thread
+    is registered, a sampler thread reads every registered thread's current
+    stack each `interval` seconds and counts it under the endpoint. Other
+    requests are never touched, and with nothing registered the sampler
+    sleeps. Stacks are kept collapsed (root first, frames joined by ';'),
+    which is what flamegraph.pl, speedscope and inferno read.
+    """
+    def __init__(self, interval: float = 0.005, max_stacks: int = MAX_STACKS):
+        self.interval = interval
+        self.max_stacks = max_stacks
+        self.samples = 0
+        self._active: Dict[int, str] = {}
+        self._stacks: Dict[str, Dict[str, int]] = {}
+        self._labels = {}
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def begin(self, endpoint: str) -> None:
+        """Profile the calling thread under `endpoint` until `end()`"""
+        self._active[threading.get_ident()] = endpoint
+        self._wake.set()
+
+    def end(self) -> None:
+        self._active.pop(threading.get_ident(), None)
+
+    def _label(self, code) -> str:
+        label = self._labels.get(code)
+        if label is None:
+            # The parent directory tells flask/app.py from backend/app.py
+            directory, filename = os.path.split(code.co_filename)
+            path = f'{os.path.basename(directory)}/{filename}' if directory else filename
+            label = f'{code.co_name} ({path}:{code.co_firstlineno})'
+            self._labels[code] = label
+        return label
+
+    def sample(self) -> None:
+        """Record the current stack of every profiled thread"""
+        active = list(self._active.items())
+        if not active:
+            return
+        frames = sys._current_frames()
+        collapsed = []
+        for thread_id, endpoint in active:
+            frame = frames.get(thread_id)
+            labels = []
+            while frame is not None:
+                labels.append(self._label(frame.f_code))
+                frame = frame.f_back
+            if labels:
+                collapsed.append((endpoint, ';'.join(reversed(labels))))
+        with self._lock:
+            for endpoint, stack in collapsed:
+                stacks = self._stacks.setdefault(endpoint, {})
+                if stack not in stacks and len(stacks) >= self.max_stacks:
+                    stack = TRUNCATED
+                stacks[stack] = stacks.get(stack, 0) + 1
+            self.samples += len(collapsed)
+
+    def folded(self, endpoint: str = None) -> str:
+        """
+        Folded stacks, one "frame;frame;... count" line each. Without an
+        endpoint every stack is rooted at the endpoint that produced it.
+        """
+        with self._lock:
+            if endpoint is not None:
+                items = sorted(self._stacks.get(endpoint, {}).items())
+            else:
+                items = sorted(
+                    (f'{name};{stack}', count)
+                    for name, stacks in self._stacks.items()
+                    for stack, count in stacks.items()
+                )
+        return ''.join(f'{stack} {count}\n' for stack, count in items)
+
+    def endpoints(self) -> Dict[str, int]:
+        """Samples recorded per endpoint"""
+        with self._lock:
+            return {name: sum(stacks.values()) for name, stacks in self._stacks.items()}
+
+    def reset(self) -> None:
+        with self._lock:
+            self._stacks.clear()
+            self.samples = 0
+
+    def start(self) -> None:
+        if self._thread is not None:
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name='sms-profiler', daemon=True)
+        self._thread.start()
+
+    def stop(self) -> None:
+        self._stop.set()
+        self._wake.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def _run(self) -> None:
+        while not self._stop.is_set():
+            if not self._active:
+                self._wake.wait()
+                self._wake.clear()
+                continue
+            self.sample()
+            time.sleep(self.interval)
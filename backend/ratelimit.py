@@ -0,0 +1,129 @@
+"""
+SMS Platform - Rate Limiting
+Token buckets shared between worker processes through a memory-mapped file
+"""
+
+import hashlib
+import math
+import mmap
+import os
+import struct
+import threading
+import time
+from typing import Sequence, Tuple
+
+try:
+    import fcntl
+except ImportError:  # Windows: a single process, the thread lock is enough
+    fcntl = None
+
+# Slot: key hash (0 = empty), last update time, then one token count per limit
+HEADER = struct.Struct('<Qd')
+TOKENS = struct.Struct('<d')
+PROBE_LIMIT = 16
+
+
+class SharedTokenBuckets:
+    """
+    Fixed-size open-addressing hash table of token buckets.
+    Every key has one bucket per (capacity, period) limit, all of which must
+    hold enough tokens for a request to pass. The table lives in a shared
+    memory map, so every gunicorn worker mapping the same file enforces the
+    same budget; an flock serialises the short read-modify-write of each
+    check. When a probe window is full the least recently used slot is
+    reclaimed, which resets that key's budget.
+    """
+    def __init__(self, limits: Sequence[Tuple[int, float]], path: str = None, slots: int = 65536):
+        self.limits = [(float(capacity), capacity / period) for capacity, period in limits]
+        self.slots = slots
+        self.slot_size = HEADER.size + TOKENS.size * len(self.limits)
+        self._lock = threading.Lock()
+        size = self.slot_size * slots
+
+        self._fd = None
+        if path:
+            self._fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+            self._flock()
+            try:
+                if os.fstat(self._fd).st_size != size:
+                    # New file or a different layout: start from empty buckets
+                    os.ftruncate(self._fd, 0)
+                    os.ftruncate(self._fd, size)
+            finally:
+                self._funlock()
+            self._map = mmap.mmap(self._fd, size)
+        else:
+            self._map = mmap.mmap(-1, size)
+
+    def _flock(self) -> None:
+        if fcntl is not None and self._fd is not None:
+            fcntl.flock(self._fd, fcntl.LOCK_EX)
+
+    def _funlock(self) -> None:
+        if fcntl is not None and self._fd is not None:
+            fcntl.flock(self._fd, fcntl.LOCK_UN)
+
+    def _find_slot(self, key_hash: int) -> Tuple[int, bool]:
+        """Offset of the key's slot and whether it already existed"""
+        buf = self._map
+        start = key_hash % self.slots
+        oldest_offset, oldest_time = None, math.inf
+        for probe in range(PROBE_LIMIT):
+            offset = ((start + probe) % self.slots) * self.slot_size
+            stored_hash, updated = HEADER.unpack_from(buf, offset)
+            if stored_hash == key_hash:
+                return offset, True
+            if stored_hash == 0:
+                return offset, False
+            if updated < oldest_time:
+                oldest_offset, oldest_time = offset, updated
+        return oldest_offset, False
+
+    def consume(self, key: str, cost: int = 1, now: float = None) -> Tuple[bool, float]:
+        """
+        Take `cost` tokens from every bucket of `key` if all of them can pay.
+        Returns: (allowed, retry_after_seconds)
+        """
+        if now is None:
+            now = time.time()
+        key_hash = int.from_bytes(hashlib.blake2b(key.encode(), digest_size=8).digest(), 'little') or 1
+        buf = self._map
+
+        with self._lock:
+            self._flock()
+            try:
+                offset, exists = self._find_slot(key_hash)
+                tokens = []
+                if exists:
+                    elapsed = max(0.0, now - HEADER.unpack_from(buf, offset)[1])
+                    position = offset + HEADER.size
+                    for capacity, rate in self.limits:
+                        stored = TOKENS.unpack_from(buf, position)[0]
+                        tokens.append(min(capacity, stored + elapsed * rate))
+                        position += TOKENS.size
+                else:
+                    tokens = [capacity for capacity, _ in self.limits]
+
+                retry_after = 0.0
+                for (capacity, rate), available in zip(self.limits, tokens):
+                    if available < cost:
+                        wait = (cost - available) / rate if cost <= capacity else math.inf
+                        retry_after = max(retry_after, wait)
+                allowed = retry_after == 0.0
+                if allowed:
+                    tokens = [available - cost for available in tokens]
+
+                HEADER.pack_into(buf, offset, key_hash, now)
+                position = offset + HEADER.size
+                for available in tokens:
+                    TOKENS.pack_into(buf, position, available)
+                    position += TOKENS.size
+            finally:
+                self._funlock()
+        return allowed, retry_after
+
+    def close(self) -> None:
+        self._map.close()
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
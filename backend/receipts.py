@@ -0,0 +1,113 @@
+"""
+SMS Platform - Delivery Receipts
+Batched ingestion of delivery reports (DLRs) from the SMS provider
+"""
+
+import logging
+import threading
+import time
+from collections import deque
+from typing import Callable, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+# Provider statuses that settle a message; others (queued, sending, sent) only report progress
+RECEIPT_STATUSES = {
+    'delivered': 'delivered',
+    'read': 'delivered',
+    'undelivered': 'failed',
+    'failed': 'failed',
+}
+
+# (provider_message_id, delivery_status, received_at)
+Receipt = Tuple[str, str, float]
+
+
+def receipt_status(provider_status: str) -> Optional[str]:
+    """Delivery status for a provider status, None if it settles nothing"""
+    return RECEIPT_STATUSES.get(provider_status.lower())
+
+
+class ReceiptProcessor:
+    """
+    Receipts are appended to a queue by the webhook, which costs O(1) and
+    takes no lock shared with the send path. A background thread drains
+    the queue every `flush_interval` seconds, or as soon as `batch_size`
+    receipts are waiting, and hands them to `apply(batch)` in batches.
+    `apply` returns the receipts whose message it could not find: a report
+    can arrive before the provider's API response has been recorded, so
+    those are retried on later flushes until `match_ttl` seconds old.
+    """
+    def __init__(self, apply: Callable[[List[Receipt]], List[Receipt]], batch_size: int = 1000,
+                 flush_interval: float = 0.2, match_ttl: float = 60.0):
+        self.apply = apply
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.match_ttl = match_ttl
+        self.expired = 0
+        self._pending = deque()
+        self._unmatched: List[Receipt] = []
+        self._wake = threading.Event()
+        self._flush_lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def __len__(self) -> int:
+        return len(self._pending) + len(self._unmatched)
+
+    def submit(self, provider_message_id: str, delivery_status: str, received_at: float = None) -> None:
+        # deque.append is atomic, so concurrent webhook requests need no lock
+        received_at = time.time() if received_at is None else received_at
+        self._pending.append((provider_message_id, delivery_status, received_at))
+        if len(self._pending) >= self.batch_size:
+            self._wake.set()
+
+    def unmatched(self) -> List[Receipt]:
+        """Receipts the last flush found no message for, still to be retried"""
+        return list(self._unmatched)
+
+    def flush(self) -> int:
+        """Apply every waiting receipt now; returns how many were applied"""
+        with self._flush_lock:
+            applied = 0
+            cutoff = time.time() - self.match_ttl
+            retry = [receipt for receipt in self._unmatched if receipt[2] >= cutoff]
+            self.expired += len(self._unmatched) - len(retry)
+            unmatched = []
+            batch = retry
+            while True:
+                while self._pending and len(batch) < self.batch_size:
+                    batch.append(self._pending.popleft())
+                if not batch:
+                    break
+                try:
+                    missed = self.apply(batch)
+                except Exception:
+                    logger.exception('Applying delivery receipts failed')
+                    missed = []
+                unmatched.extend(missed)
+                applied += len(batch) - len(missed)
+                batch = []
+            self._unmatched = unmatched
+            return applied
+
+    def start(self) -> None:
+        if self._thread is not None:
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name='sms-receipts', daemon=True)
+        self._thread.start()
+
+    def stop(self) -> None:
+        self._stop.set()
+        self._wake.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        self.flush()
+
+    def _run(self) -> None:
+        while not self._stop.is_set():
+            self._wake.wait(self.flush_interval)
+            self._wake.clear()
+            self.flush()
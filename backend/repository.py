@@ -0,0 +1,458 @@
+"""
+SMS Platform - Repository
+Thread-safe access to messages, contacts, scheduled messages and templates
+"""
+
+import gc
+import itertools
+import marshal
+import threading
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from indexes import MessageIndex, ScheduledIndex
+from models import Message, MessageLog
+from search import ContactIndex, phone_digits
+from tags import TagIndex
+
+TABLES = ('messages', 'contacts', 'scheduled_messages', 'templates')
+INDEXED_FIELDS = MessageIndex.FIELDS + (MessageIndex.PROVIDER_FIELD,)
+MESSAGE_FIELDS = ('status', 'delivery_status', 'provider_message_id')
+
+
+def _prefixed(prefix: str, sections: Dict) -> Dict:
+    return {prefix + name: value for name, value in sections.items()}
+
+
+def _unprefixed(prefix: str, sections: Dict) -> Dict:
+    return {name[len(prefix):]: value for name, value in sections.items() if name.startswith(prefix)}
+
+
+class StripedLock:
+    """A fixed set of locks; a key always maps to the same one"""
+    def __init__(self, stripes: int = 64):
+        self._locks = [threading.Lock() for _ in range(stripes)]
+
+    def __call__(self, key) -> threading.Lock:
+        return self._locks[hash(key) % len(self._locks)]
+
+
+class Repository:
+    """
+    Owns the in-memory stores, their indexes and their persistence.
+    IDs come from a per-store atomic counter (or from storage, which keeps
+    them unique across processes), never from len(). Writers to a store
+    serialise on that store's lock only for the list and index updates;
+    readers never lock and see either the old or the new state. Checks that
+    must be atomic with their write (duplicate phones, status transitions)
+    hold one lock stripe keyed by the phone or record ID, so unrelated
+    writers do not wait on each other. Message status changes take the
+    messages lock instead, since their columns and indexes must change
+    together for `dump()`.
+    With a `journal`, every change is journaled after it is applied and
+    saved, so a storage flush or a dump covers all that was journaled
+    before it started.
+    """
+    def __init__(self, storage=None, stripes: int = 64, journal=None):
+        self.storage = storage
+        self.journal = journal
+        self.messages = MessageLog()
+        self.contacts = []
+        self.scheduled = []
+        self.templates: Dict[int, Dict] = {}
+        self.message_index = MessageIndex(self.messages)
+        self.contact_index = ContactIndex()
+        self.tag_index = TagIndex()
+        self.scheduled_index = ScheduledIndex()
+        self._locks = {table: threading.Lock() for table in TABLES}
+        self._stripes = StripedLock(stripes)
+        self._counters = {table: itertools.count(1) for table in TABLES}
+        self._generations = dict.fromkeys(TABLES, 0)
+        self._generation_lock = threading.Lock()
+
+    def load(self, messages: Iterable = (), contacts: Iterable[Dict] = (),
+             scheduled: Iterable[Dict] = (), templates: Iterable[Dict] = ()) -> None:
+        """Bulk-load existing records (startup only)"""
+        for msg in messages:
+            self.messages.append(msg)
+            self.message_index.add(msg)
+        for contact in contacts:
+            self.contacts.append(contact)
+            self.contact_index.add(contact)
+            self.tag_index.add(contact)
+        self.scheduled.extend(scheduled)
+        self.scheduled_index.load(self.scheduled)
+        for template in templates:
+            self.templates[template['id']] = template
+        self._reset_counters()
+
+    def dump(self) -> Dict:
+        """
+        Every store and index as named buffers, for a snapshot. Each store
+        is read under its own lock, so the dump holds every write to it that
+        finished before the dump reached it.
+        """
+        sections = {}
+        with self._locks['messages']:
+            sections.update(_prefixed('messages.', self.messages.dump()))
+            sections.update(_prefixed('message_index.', self.message_index.dump()))
+            length, phones = len(self.messages), len(self.messages.phones)
+        sections.update(_prefixed('message_index.', self.message_index.dump_phones(length, phones)))
+        with self._locks['contacts']:
+            sections['contacts'] = marshal.dumps(self.contacts)
+            sections['contact_phones'], sections['contact_search'] = self.contact_index.dump()
+            sections['tag_index'] = self.tag_index.dump()
+        with self._locks['scheduled_messages']:
+            sections['scheduled_messages'] = marshal.dumps(self.scheduled)
+        sections['templates'] = marshal.dumps(list(self.templates.values()))
+        return sections
+
+    def restore(self, sections: Dict) -> None:
+        """Load empty stores and indexes from a dump (startup only)"""
+        # Millions of new objects would set off repeated collections that find nothing
+        collecting = gc.isenabled()
+        gc.disable()
+        try:
+            self.messages.restore(_unprefixed('messages.', sections))
+            self.message_index.restore(_unprefixed('message_index.', sections))
+            self.contacts.extend(marshal.loads(sections['contacts']))
+            self.contact_index.restore(self.contacts, sections['contact_phones'], sections['contact_search'])
+            self.tag_index.restore(sections['tag_index'])
+            self.scheduled.extend(marshal.loads(sections['scheduled_messages']))
+            self.scheduled_index.load(self.scheduled)
+            for template in marshal.loads(sections['templates']):
+                self.templates[template['id']] = template
+        finally:
+            if collecting:
+                gc.enable()
+        self._reset_counters()
+
+    def catch_up(self, messages: Iterable[Dict] = (), contacts: Iterable[Dict] = (),
+                 scheduled: Iterable[Dict] = (), templates: Iterable[Dict] = ()) -> Optional[Tuple[List, List]]:
+        """
+        Apply records stored since a restored dump was taken (startup
+        only): new records are added and changed ones updated in place,
+        without writing them back. Returns (new messages, [(message, previous
+        delivery status)]), or None without changing anything when a new
+        message would sort before the end of the log.
+        """
+        messages = list(messages)
+        last_id = self.messages.ids[-1] if len(self.messages) else 0
+        if any(row['id'] <= last_id and self.message_index.get(row['id']) is None for row in messages):
+            return None
+
+        added = []
+        updates = []
+        for row in messages:
+            msg = self.message_index.get(row['id'])
+            if msg is None:
+                msg = Message.from_dict(row)
+                self.messages.append(msg)
+                self.message_index.add(msg)
+                added.append(msg)
+                continue
+            changes = {field: row[field] for field in MESSAGE_FIELDS if getattr(msg, field) != row[field]}
+            if changes:
+                updates.append((msg, changes))
+        previous = self._update_messages(updates)
+        delivery_changes = [(msg, old['delivery_status']) for (msg, changes), old in zip(updates, previous)
+                            if 'delivery_status' in changes]
+
+        for row in contacts:
+            contact = self.contact_index.get(row['id'])
+            if contact is None:
+                self.contacts.append(row)
+                self.contact_index.add(row)
+                self.tag_index.add(row)
+            else:
+                self._update_contact(contact, {field: value for field, value in row.items()
+                                               if contact.get(field) != value})
+        for row in scheduled:
+            entry = self.scheduled_index.get(row['id'])
+            if entry is not None:
+                entry.update(row)
+            else:
+                entry = row
+                self.scheduled.append(entry)
+            self.scheduled_index.add(entry)
+        for template in templates:
+            self.templates[template['id']] = template
+
+        self._reset_counters()
+        for table in TABLES:
+            self._changed(table)
+        return added, delivery_changes
+
+    def _reset_counters(self) -> None:
+        # IDs grow with the log's rows
+        last_id = self.messages.ids[-1] if len(self.messages) else 0
+        self._counters['messages'] = itertools.count(last_id + 1)
+        for table, store in (('contacts', self.contacts), ('scheduled_messages', self.scheduled),
+                             ('templates', self.templates.values())):
+            self._counters[table] = itertools.count(max((record['id'] for record in store), default=0) + 1)
+
+    def next_id(self, table: str) -> int:
+        """Allocate a new, never reused ID for `table`"""
+        if self.storage is not None:
+            return self.storage.next_id(table)
+        # next() on itertools.count is atomic under the GIL
+        return next(self._counters[table])
+
+    def generation(self, *tables: str) -> Tuple[int, ...]:
+        """
+        Change counters of `tables`. A counter moves after every write to its
+        store completes, so data read after reading it is at least that new.
+        """
+        return tuple(self._generations[table] for table in tables)
+
+    def _changed(self, table: str) -> None:
+        with self._generation_lock:
+            self._generations[table] += 1
+
+    def _journal(self, table: str, records: List, to_row=None) -> None:
+        if self.journal is not None and records:
+            self.journal.append(table, records, to_row)
+
+    # Messages
+
+    def add_message(self, msg) -> None:
+        """Store a new message and count it on its contact; a missing ID is allocated"""
+        with self._locks['messages']:
+            # Allocated under the lock so IDs grow with the log's rows
+            if msg.id is None:
+                msg.id = self.next_id('messages')
+            self.messages.append(msg)
+            self.message_index.add(msg)
+        self._changed('messages')
+        if self.storage is not None:
+            self.storage.save_message(msg)
+        self._journal('messages', [msg], Message.to_dict)
+        self._count_message(msg)
+
+    def update_message(self, msg, **changes) -> Dict:
+        """Apply field changes atomically; returns the previous values"""
+        return self.update_messages([(msg, changes)])[0]
+
+    def update_messages(self, updates: Iterable[Tuple[object, Dict]]) -> List[Dict]:
+        """
+        Apply (msg, changes) pairs, each atomically for its message; only
+        the status fields of a stored message change.
+        Re-indexing for the whole batch takes the store lock once.
+        Returns the previous values for each pair.
+        """
+        updates = list(updates)
+        if not updates:
+            return []
+        previous_values = self._update_messages(updates)
+        self._changed('messages')
+        if self.storage is not None:
+            self.storage.save_message_statuses(msg for msg, _ in updates)
+        self._journal('messages', [msg for msg, _ in updates], Message.to_dict)
+        return previous_values
+
+    def _update_messages(self, updates: List[Tuple[object, Dict]]) -> List[Dict]:
+        previous_values = []
+        reindex = []
+        with self._locks['messages']:
+            for msg, changes in updates:
+                previous = {field: getattr(msg, field) for field in changes}
+                for field, value in changes.items():
+                    setattr(msg, field, value)
+                previous_values.append(previous)
+                reindex.extend((msg.row, field, previous[field]) for field, value in changes.items()
+                               if field in INDEXED_FIELDS and previous[field] != value)
+            if reindex:
+                self.message_index.update_many(reindex)
+        return previous_values
+
+    # Contacts
+
+    def add_contact(self, contact: Dict) -> Tuple[Dict, bool]:
+        """
+        Insert a contact unless its phone number is taken; a missing ID is allocated.
+        Returns: (stored_contact, created)
+        """
+        with self._stripes(('contacts', phone_digits(contact['phone']))):
+            existing = self.get_contact_by_phone(contact['phone'])
+            if existing is not None:
+                return existing, False
+            if contact.get('id') is None:
+                contact['id'] = self.next_id('contacts')
+            if self.storage is not None:
+                # Another process may have taken the number since the lookup; the database decides
+                stored = self.storage.insert_contact(contact)
+                if stored is not None:
+                    return self._adopt_contact(stored), False
+            with self._locks['contacts']:
+                self.contacts.append(contact)
+                self.contact_index.add(contact)
+                self.tag_index.add(contact)
+        self._changed('contacts')
+        self._journal('contacts', [contact])
+        return contact, True
+
+    def update_contact(self, contact: Dict, **changes) -> Dict:
+        """
+        Change a contact's name or tags and re-index it; returns the previous values.
+        With storage only those columns are written, and the contact is
+        refreshed from the stored row, counters included.
+        """
+        with self._stripes(('contacts', contact['id'])):
+            previous = self._update_contact(contact, changes)
+            if self.storage is not None:
+                self._refresh_contact(contact, self.storage.update_contact(contact['id'], changes))
+        self._changed('contacts')
+        self._journal('contacts', [contact])
+        return previous
+
+    def _count_message(self, msg) -> None:
+        # Counters move with each stored message, so nothing ever recounts the log
+        contact = self.get_contact_by_phone(msg.phone)
+        if contact is None:
+            return
+        with self._stripes(('contacts', contact['id'])):
+            counted = None
+            if self.storage is not None:
+                # Other processes count on the same row; the stored counters are the current ones
+                counted = self.storage.count_contact_message(contact['id'], msg.timestamp)
+            unstored = counted is None
+            if unstored:
+                counted = (contact.get('messages', 0) + 1,
+                           max(contact.get('last_message_at') or msg.timestamp, msg.timestamp))
+            self._update_contact(contact, {'messages': counted[0], 'last_message_at': counted[1]})
+            if self.storage is not None and unstored:
+                self.storage.save_contact(contact)
+        self._changed('contacts')
+        self._journal('contacts', [contact])
+
+    def _refresh_contact(self, contact: Dict, stored: Optional[Dict]) -> None:
+        if stored is None:
+            # Never stored (loaded without storage), so the whole row is written
+            self.storage.save_contact(contact)
+            return
+        self._update_contact(contact, {field: value for field, value in stored.items()
+                                       if contact.get(field) != value})
+
+    def _update_contact(self, contact: Dict, changes: Dict) -> Dict:
+        previous = {field: contact.get(field) for field in changes}
+        reindex = 'name' in changes or 'phone' in changes
+        with self._locks['contacts']:
+            if reindex:
+                # The search index reads the name and phone it was built with
+                self.contact_index.remove(contact)
+            contact.update(changes)
+            if reindex:
+                self.contact_index.add(contact)
+            if 'tags' in changes:
+                self.tag_index.update(contact, previous['tags'])
+        return previous
+
+    def get_contact(self, contact_id: int) -> Optional[Dict]:
+        """The contact with `contact_id`; one only another process has is loaded from storage"""
+        contact = self.contact_index.get(contact_id)
+        if contact is None and self.storage is not None:
+            contact = self._adopt_contact(self.storage.get_contact(contact_id))
+        return contact
+
+    def get_contact_by_phone(self, phone: str) -> Optional[Dict]:
+        contact = self.contact_index.get_by_phone(phone)
+        if contact is None and self.storage is not None:
+            contact = self._adopt_contact(self.storage.get_contact(phone=phone))
+        return contact
+
+    def _adopt_contact(self, stored: Optional[Dict]) -> Optional[Dict]:
+        # Held from now on like the contacts loaded at startup, so later lookups stay in memory
+        if stored is None:
+            return None
+        with self._locks['contacts']:
+            contact = self.contact_index.get(stored['id'])
+            if contact is not None:
+                return contact
+            self.contacts.append(stored)
+            self.contact_index.add(stored)
+            self.tag_index.add(stored)
+        self._changed('contacts')
+        return stored
+
+    # Scheduled messages
+
+    def add_scheduled(self, entry: Dict) -> None:
+        if entry.get('id') is None:
+            entry['id'] = self.next_id('scheduled_messages')
+        with self._locks['scheduled_messages']:
+            self.scheduled.append(entry)
+            self.scheduled_index.add(entry)
+        self._changed('scheduled_messages')
+        if self.storage is not None:
+            self.storage.save_scheduled(entry)
+        self._journal('scheduled_messages', [entry])
+
+    def update_scheduled(self, entry: Dict, expected_status: str = None, expected_scheduled_at: str = None,
+                         **changes) -> bool:
+        """
+        Apply changes to a scheduled entry, optionally only if its status is
+        still `expected_status` and its due time `expected_scheduled_at`.
+        With storage the condition is checked against the stored entry too,
+        since other processes change it; when one did, the entry is
+        refreshed from storage instead. Returns whether the changes were applied.
+        """
+        expected = {}
+        if expected_status is not None:
+            expected['status'] = expected_status
+        if expected_scheduled_at is not None:
+            expected['scheduled_at'] = expected_scheduled_at
+        conditional = self.storage is not None and bool(expected)
+        with self._stripes(('scheduled_messages', entry['id'])):
+            if any(entry.get(field) != value for field, value in expected.items()):
+                return False
+            applied = not conditional or self.storage.update_scheduled_if(entry['id'], expected, changes)
+            if applied:
+                entry.update(changes)
+            else:
+                stored = self.storage.get_scheduled(entry['id'])
+                if stored is None:
+                    return False
+                entry.update(stored)
+            self.scheduled_index.update(entry)
+        self._changed('scheduled_messages')
+        if applied:
+            if self.storage is not None and not conditional:
+                self.storage.save_scheduled(entry)
+            self._journal('scheduled_messages', [entry])
+        return applied
+
+    def get_scheduled(self, entry_id: int) -> Optional[Dict]:
+        """The scheduled entry with `entry_id`; one only another process has is loaded from storage"""
+        entry = self.scheduled_index.get(entry_id)
+        if entry is None and self.storage is not None:
+            stored = self.storage.get_scheduled(entry_id)
+            if stored is None:
+                return None
+            with self._locks['scheduled_messages']:
+                entry = self.scheduled_index.get(entry_id)
+                if entry is None:
+                    entry = stored
+                    self.scheduled.append(entry)
+                    self.scheduled_index.add(entry)
+            self._changed('scheduled_messages')
+        return entry
+
+    # Templates
+
+    def get_template(self, template_id: int) -> Optional[Dict]:
+        """The template with `template_id`; one only another process has is loaded from storage"""
+        template = self.templates.get(template_id)
+        if template is None and self.storage is not None:
+            stored = self.storage.get_template(template_id)
+            if stored is not None:
+                template = self.templates.setdefault(template_id, stored)
+                self._changed('templates')
+        return template
+
+    def add_template(self, template: Dict) -> None:
+        if template.get('id') is None:
+            template['id'] = self.next_id('templates')
+        self.templates[template['id']] = template
+        self._changed('templates')
+        if self.storage is not None:
+            self.storage.save_template(template)
+        self._journal('templates', [template])
@@ -0,0 +1,123 @@
+"""
+SMS Platform - Scheduler
+Background dispatch engine for scheduled messages
+"""
+
+import heapq
+import itertools
+import logging
+import threading
+import time
+from typing import Any, Callable, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+
+class Scheduler:
+    """
+    Min-heap of pending items keyed by due time (epoch seconds).
+    Insert is O(log n), the next due item is always heap[0], and the
+    dispatch thread sleeps until that item is due instead of polling.
+    `dispatch(batch)` returns the items it could not send; those, or the
+    whole batch when it raises, are due again after `retry_delay` seconds,
+    doubling with each attempt up to `max_retry_delay`.
+    """
+    def __init__(self, dispatch: Callable[[List[Any]], Optional[List[Any]]], batch_size: int = 100,
+                 retry_delay: float = 5.0, max_retry_delay: float = 300.0):
+        self._dispatch = dispatch
+        self._batch_size = batch_size
+        self.retry_delay = retry_delay
+        self.max_retry_delay = max_retry_delay
+        self._heap = []
+        self._counter = itertools.count()
+        self._cond = threading.Condition()
+        self._thread = None
+        self._running = False
+
+    def __len__(self) -> int:
+        return len(self._heap)
+
+    def schedule(self, due: float, item: Any) -> None:
+        """Add an item to be dispatched at `due`"""
+        with self._cond:
+            heapq.heappush(self._heap, (due, next(self._counter), item, 0))
+            # Only wake the dispatcher when the earliest deadline moved
+            if self._heap[0][2] is item:
+                self._cond.notify()
+
+    def next_due(self) -> Optional[float]:
+        """Due time of the earliest pending item, or None if empty"""
+        heap = self._heap
+        return heap[0][0] if heap else None
+
+    def _pop_due(self, now: float) -> List[Tuple[Any, int]]:
+        heap = self._heap
+        batch = []
+        while heap and heap[0][0] <= now and len(batch) < self._batch_size:
+            batch.append(heapq.heappop(heap)[2:])
+        return batch
+
+    def _dispatch_due(self, due: List[Tuple[Any, int]], now: float) -> int:
+        # (item, attempts) pairs; returns how many items were dispatched
+        batch = [item for item, _ in due]
+        try:
+            failed = self._dispatch(batch) or []
+        except Exception:
+            # A failing batch must not kill the dispatcher, nor lose its items
+            logger.exception('Scheduled dispatch failed')
+            failed = batch
+        if failed:
+            attempts = {id(item): count for item, count in due}
+            with self._cond:
+                for item in failed:
+                    count = attempts.get(id(item), 0)
+                    delay = min(self.retry_delay * 2 ** count, self.max_retry_delay)
+                    heapq.heappush(self._heap, (now + delay, next(self._counter), item, count + 1))
+        return len(batch) - len(failed)
+
+    def run_pending(self, now: float = None) -> int:
+        """Dispatch everything due at `now` in batches; returns the number dispatched"""
+        if now is None:
+            now = time.time()
+        dispatched = 0
+        while True:
+            with self._cond:
+                due = self._pop_due(now)
+            if not due:
+                return dispatched
+            dispatched += self._dispatch_due(due, now)
+
+    def start(self) -> None:
+        """Start the background dispatch thread"""
+        with self._cond:
+            if self._running:
+                return
+            self._running = True
+        self._thread = threading.Thread(target=self._run, name='sms-scheduler', daemon=True)
+        self._thread.start()
+
+    def stop(self, timeout: float = None) -> None:
+        """Stop the background dispatch thread"""
+        with self._cond:
+            self._running = False
+            self._cond.notify()
+        if self._thread is not None:
+            self._thread.join(timeout)
+            self._thread = None
+
+    def _run(self) -> None:
+        while True:
+            with self._cond:
+                while self._running:
+                    if not self._heap:
+                        self._cond.wait()
+                        continue
+                    delay = self._heap[0][0] - time.time()
+                    if delay <= 0:
+                        break
+                    self._cond.wait(delay)
+                if not self._running:
+                    return
+                now = time.time()
+                due = self._pop_due(now)
+            self._dispatch_due(due, now)
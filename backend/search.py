@@ -0,0 +1,313 @@
+"""
+SMS Platform - Contact Search
+In-memory search index over contact names and phone numbers
+"""
+
+import heapq
+import marshal
+import re
+import threading
+from bisect import bisect_left
+from typing import Dict, Iterator, List, Optional, Set, Tuple
+
+TOKEN_RE = re.compile(r'\w+')
+NON_DIGIT_RE = re.compile(r'\D')
+PHONE_QUERY_RE = re.compile(r'^[\d+\-().\s]+$')
+
+# Match quality for a single query term, higher is better
+EXACT, PREFIX, SUBSTRING = 3, 2, 1
+
+# Below this many candidates, remaining query terms are checked against
+# the candidates' names instead of being looked up in the index
+VERIFY_LIMIT = 1000
+
+
+class SortedKeys:
+    """
+    Sorted (key, value) pairs supporting prefix scans by bisection.
+    New pairs land in an unsorted buffer. Lookups scan a small buffer
+    directly and merge it in once it grows past `merge_threshold`, so bulk
+    loads pay for one sort instead of one insertion per pair. A merge
+    builds new lists and swaps them in, so scans already in progress keep
+    reading the lists they started with.
+    """
+    def __init__(self, merge_threshold: int = 512):
+        self._items: List[Tuple[str, object]] = []
+        self._pending: List[Tuple[str, object]] = []
+        self._merge_threshold = merge_threshold
+        self._lock = threading.Lock()
+
+    def add(self, key: str, value) -> None:
+        with self._lock:
+            self._pending.append((key, value))
+
+    def discard(self, key: str, value) -> None:
+        pair = (key, value)
+        with self._lock:
+            if pair in self._pending:
+                self._pending = [item for item in self._pending if item != pair]
+                return
+            index = bisect_left(self._items, pair)
+            if index < len(self._items) and self._items[index] == pair:
+                self._items = self._items[:index] + self._items[index + 1:]
+
+    def _merge(self) -> None:
+        with self._lock:
+            if len(self._pending) <= self._merge_threshold:
+                return
+            # Timsort merges the two sorted runs in linear time
+            items = self._items + sorted(self._pending)
+            items.sort()
+            self._items, self._pending = items, []
+
+    def items(self) -> List[Tuple[str, object]]:
+        """Every pair, sorted"""
+        with self._lock:
+            return sorted(self._items + self._pending) if self._pending else self._items[:]
+
+    def restore(self, items: List[Tuple[str, object]]) -> None:
+        """Replace the pairs with `items`, already sorted"""
+        with self._lock:
+            self._items, self._pending = items, []
+
+    def prefix(self, prefix: str) -> Iterator[Tuple[str, object]]:
+        """Yield every pair whose key starts with `prefix`"""
+        if len(self._pending) > self._merge_threshold:
+            self._merge()
+        with self._lock:
+            items, pending = self._items, self._pending
+        index = bisect_left(items, (prefix,))
+        while index < len(items) and items[index][0].startswith(prefix):
+            yield items[index]
+            index += 1
+        for pair in pending:
+            if pair[0].startswith(prefix):
+                yield pair
+
+
+def tokenize(text: str) -> List[str]:
+    return TOKEN_RE.findall(text.lower())
+
+
+def trigrams(token: str) -> Set[str]:
+    return {token[i:i + 3] for i in range(len(token) - 2)}
+
+
+def phone_digits(phone: str) -> str:
+    return NON_DIGIT_RE.sub('', phone or '')
+
+
+class ContactIndex:
+    """
+    Search index for contacts.
+    Names are split into tokens; each distinct token has a posting set of
+    contact IDs, a sorted vocabulary answers prefix lookups and a trigram
+    index over the vocabulary answers substring lookups. Phone numbers are
+    reduced to digits and kept sorted both forwards and reversed, so digit
+    prefixes ("+1234...") and suffixes ("...8901") are bisection lookups.
+    Writers must be serialised by the caller; searches may run alongside a
+    writer and read posting sets through snapshots. An index restored from
+    a dump keeps its search structures packed until the first search or
+    write needs them.
+    """
+    def __init__(self):
+        self._contacts: Dict[int, Dict] = {}
+        self._by_phone: Dict[str, Dict] = {}
+        self._postings: Dict[str, Set[int]] = {}
+        self._vocabulary = SortedKeys()
+        self._trigrams: Dict[str, Set[str]] = {}
+        self._phones = SortedKeys()
+        self._phones_reversed = SortedKeys()
+        self._packed = None
+        self._unpack_lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._contacts)
+
+    def get(self, contact_id: int) -> Optional[Dict]:
+        return self._contacts.get(contact_id)
+
+    def get_by_phone(self, phone: str) -> Optional[Dict]:
+        """O(1) lookup of the contact owning a phone number (any formatting)"""
+        return self._by_phone.get(phone_digits(phone))
+
+    def add(self, contact: Dict) -> None:
+        """Index a contact (re-adding an indexed ID replaces it)"""
+        self._unpack()
+        contact_id = contact['id']
+        if contact_id in self._contacts:
+            self.remove(self._contacts[contact_id])
+        self._contacts[contact_id] = contact
+
+        for token in set(tokenize(contact.get('name', ''))):
+            posting = self._postings.get(token)
+            if posting is None:
+                posting = self._postings[token] = set()
+                self._vocabulary.add(token, token)
+                for gram in trigrams(token):
+                    self._trigrams.setdefault(gram, set()).add(token)
+            posting.add(contact_id)
+
+        digits = phone_digits(contact.get('phone', ''))
+        if digits:
+            self._by_phone.setdefault(digits, contact)
+            self._phones.add(digits, contact_id)
+            self._phones_reversed.add(digits[::-1], contact_id)
+
+    def remove(self, contact: Dict) -> None:
+        """Remove a contact from the index"""
+        self._unpack()
+        contact_id = contact['id']
+        if self._contacts.pop(contact_id, None) is None:
+            return
+
+        for token in set(tokenize(contact.get('name', ''))):
+            posting = self._postings.get(token)
+            if posting is None:
+                continue
+            posting.discard(contact_id)
+            if not posting:
+                del self._postings[token]
+                self._vocabulary.discard(token, token)
+                for gram in trigrams(token):
+                    grams = self._trigrams.get(gram)
+                    if grams is not None:
+                        grams.discard(token)
+                        if not grams:
+                            del self._trigrams[gram]
+
+        digits = phone_digits(contact.get('phone', ''))
+        if digits:
+            owner = self._by_phone.get(digits)
+            if owner is not None and owner['id'] == contact_id:
+                del self._by_phone[digits]
+            self._phones.discard(digits, contact_id)
+            self._phones_reversed.discard(digits[::-1], contact_id)
+
+    def dump(self) -> Tuple[bytes, bytes]:
+        """
+        The index as two marshalled blobs, for a snapshot: the phone map and
+        the search structures. Writers must be held off.
+        """
+        self._unpack()
+        by_phone = {digits: contact['id'] for digits, contact in self._by_phone.items()}
+        search = (self._postings, self._vocabulary.items(), self._trigrams,
+                  self._phones.items(), self._phones_reversed.items())
+        return marshal.dumps(by_phone), marshal.dumps(search)
+
+    def restore(self, contacts: List[Dict], by_phone, search) -> None:
+        """
+        Load an empty index from a dump of the index over `contacts` (startup
+        only). The search structures are unpacked on first use.
+        """
+        self._contacts = {contact['id']: contact for contact in contacts}
+        self._by_phone = {digits: self._contacts[contact_id]
+                          for digits, contact_id in marshal.loads(by_phone).items()}
+        self._packed = search
+
+    def _unpack(self) -> None:
+        if self._packed is None:
+            return
+        with self._unpack_lock:
+            if self._packed is None:
+                return
+            self._postings, vocabulary, self._trigrams, phones, phones_reversed = marshal.loads(self._packed)
+            self._vocabulary.restore(vocabulary)
+            self._phones.restore(phones)
+            self._phones_reversed.restore(phones_reversed)
+            self._packed = None
+
+    def _match_term(self, term: str) -> Dict[int, int]:
+        """Best match quality per contact ID for one name term"""
+        scores: Dict[int, int] = {}
+
+        if len(term) >= 3:
+            # Substring candidates: vocabulary tokens containing every trigram of the term
+            candidates = None
+            for gram in trigrams(term):
+                tokens = self._trigrams.get(gram)
+                if not tokens:
+                    return scores
+                candidates = set(tokens) if candidates is None else candidates & tokens
+            for token in candidates:
+                if term in token:
+                    for contact_id in tuple(self._postings.get(token, ())):
+                        scores[contact_id] = SUBSTRING
+
+        for token, _ in self._vocabulary.prefix(term):
+            quality = EXACT if token == term else PREFIX
+            for contact_id in tuple(self._postings.get(token, ())):
+                if scores.get(contact_id, 0) < quality:
+                    scores[contact_id] = quality
+        return scores
+
+    @staticmethod
+    def _term_quality(term: str, tokens: List[str]) -> int:
+        best = 0
+        for token in tokens:
+            if token == term:
+                return EXACT
+            if token.startswith(term):
+                best = PREFIX
+            elif best < SUBSTRING and len(term) >= 3 and term in token:
+                best = SUBSTRING
+        return best
+
+    def _search_names(self, query: str) -> Dict[int, int]:
+        # Longer terms are usually more selective, so they go first
+        terms = sorted(set(tokenize(query)), key=len, reverse=True)
+        if not terms:
+            return {}
+        scores = self._match_term(terms[0])
+        for term in terms[1:]:
+            if not scores:
+                break
+            if len(scores) <= VERIFY_LIMIT:
+                contacts = self._contacts
+                narrowed = {}
+                for contact_id, score in scores.items():
+                    quality = self._term_quality(term, tokenize(contacts[contact_id].get('name', '')))
+                    if quality:
+                        narrowed[contact_id] = score + quality
+                scores = narrowed
+            else:
+                term_scores = self._match_term(term)
+                scores = {
+                    contact_id: score + term_scores[contact_id]
+                    for contact_id, score in scores.items()
+                    if contact_id in term_scores
+                }
+        return scores
+
+    def _search_phones(self, query: str) -> Dict[int, int]:
+        digits = phone_digits(query)
+        scores: Dict[int, int] = {}
+        for _, contact_id in self._phones_reversed.prefix(digits[::-1]):
+            scores[contact_id] = SUBSTRING
+        for key, contact_id in self._phones.prefix(digits):
+            scores[contact_id] = EXACT if key == digits else PREFIX
+        return scores
+
+    def search(self, query: str, limit: int = None, offset: int = 0) -> Tuple[int, List[Dict]]:
+        """
+        Ranked search over names, or phone numbers for digit-only queries.
+        Returns: (total_matches, contacts) where contacts is the requested page
+        """
+        query = query.strip()
+        if not query:
+            return 0, []
+        self._unpack()
+
+        if PHONE_QUERY_RE.match(query) and phone_digits(query):
+            scores = self._search_phones(query)
+        else:
+            scores = self._search_names(query)
+
+        rank = lambda contact_id: (-scores[contact_id], contact_id)
+        if limit is None:
+            ranked = sorted(scores, key=rank)[offset:]
+        else:
+            # Only the requested page needs ordering
+            ranked = heapq.nsmallest(offset + limit, scores, key=rank)[offset:]
+        contacts = self._contacts
+        return len(scores), [contacts[contact_id] for contact_id in ranked]
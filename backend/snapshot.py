@@ -0,0 +1,174 @@
+"""
+SMS Platform - Snapshots
+Point-in-time images of the in-memory stores, mapped back in for a fast warm restart
+"""
+
+import marshal
+import mmap
+import os
+import struct
+import sys
+import threading
+import time
+import zlib
+from typing import Callable, Dict, Optional, Tuple
+
+MAGIC = b'SMSSNAP\0'
+VERSION = 2
+# magic, format version, directory length, directory CRC-32
+HEADER = struct.Struct('<8sIII')
+ALIGNMENT = 8
+# Arrays and marshal data are only readable by the same layout and Python
+PLATFORM = (sys.byteorder, sys.version_info[:2])
+
+
+class SnapshotError(Exception):
+    """The file is not a usable snapshot"""
+
+
+def _padding(size: int) -> int:
+    return -size % ALIGNMENT
+
+
+def _parts(section) -> tuple:
+    return section if isinstance(section, tuple) else (section,)
+
+
+def write_snapshot(path: str, sections: Dict[str, object], meta: Dict = None) -> int:
+    """
+    Write named binary sections to `path` atomically. A section is a
+    bytes-like object, or a tuple of them stored back to back. The file is
+    written and fsynced beside `path` and then renamed over it, so a crash
+    leaves either the previous snapshot or the new one, never a torn one.
+    Returns the size of the file.
+    """
+    entries = {}
+    offset = 0
+    for name, section in sections.items():
+        length = sum(memoryview(part).nbytes for part in _parts(section))
+        entries[name] = (offset, length)
+        offset += length + _padding(length)
+    directory = marshal.dumps({'platform': PLATFORM, 'meta': meta or {}, 'sections': entries})
+    header = HEADER.pack(MAGIC, VERSION, len(directory), zlib.crc32(directory))
+    start = HEADER.size + len(directory)
+
+    temporary = f'{path}.{os.getpid()}.tmp'
+    try:
+        with open(temporary, 'wb') as f:
+            f.write(header)
+            f.write(directory)
+            f.write(bytes(_padding(start)))
+            for section in sections.values():
+                for part in _parts(section):
+                    f.write(part)
+                f.write(bytes(_padding(f.tell())))
+            size = f.tell()
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temporary, path)
+    except BaseException:
+        if os.path.exists(temporary):
+            os.remove(temporary)
+        raise
+    # Make the rename itself durable
+    directory_fd = os.open(os.path.dirname(os.path.abspath(path)), os.O_RDONLY)
+    try:
+        os.fsync(directory_fd)
+    finally:
+        os.close(directory_fd)
+    return size
+
+
+class Snapshot:
+    """
+    A snapshot file mapped read-only. Sections are memoryviews into the
+    map, so opening costs one read of the directory and section data is
+    paged in from the file only as it is used. The map stays open while
+    any section is referenced; a newer snapshot renamed over the file does
+    not disturb it.
+    """
+    def __init__(self, path: str):
+        with open(path, 'rb') as f:
+            try:
+                self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            except ValueError:
+                raise SnapshotError('Snapshot is empty')
+        view = memoryview(self._map)
+        if len(view) < HEADER.size:
+            raise SnapshotError('Snapshot is truncated')
+        magic, version, directory_size, checksum = HEADER.unpack_from(view)
+        if magic != MAGIC or version != VERSION:
+            raise SnapshotError('Not a snapshot of this format version')
+        directory = view[HEADER.size:HEADER.size + directory_size]
+        if len(directory) != directory_size or zlib.crc32(directory) != checksum:
+            raise SnapshotError('Snapshot directory is corrupt')
+        directory = marshal.loads(directory)
+        if tuple(directory['platform']) != PLATFORM:
+            raise SnapshotError('Snapshot was written by another platform or Python version')
+
+        start = HEADER.size + directory_size
+        start += _padding(start)
+        self.meta: Dict = directory['meta']
+        self.sections: Dict[str, memoryview] = {}
+        for name, (offset, length) in directory['sections'].items():
+            if start + offset + length > len(view):
+                raise SnapshotError('Snapshot is truncated')
+            self.sections[name] = view[start + offset:start + offset + length]
+
+
+def open_snapshot(path: str) -> Optional[Snapshot]:
+    """The snapshot at `path`, or None if there is none or it cannot be used"""
+    try:
+        return Snapshot(path)
+    except FileNotFoundError:
+        return None
+    except (OSError, EOFError, ValueError, TypeError, KeyError, SnapshotError):
+        # The caller rebuilds from its slower source and overwrites the file later
+        return None
+
+
+class SnapshotWriter:
+    """
+    Writes `capture()` -> (sections, meta) to `path` every `interval`
+    seconds, and once more on `stop()`.
+    """
+    def __init__(self, path: str, capture: Callable[[], Tuple[Dict, Dict]], interval: float = 300.0):
+        self.path = path
+        self.capture = capture
+        self.interval = interval
+        self.written_at: Optional[float] = None
+        self.size = 0
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def write(self) -> int:
+        """Write a snapshot now; returns its size"""
+        with self._lock:
+            sections, meta = self.capture()
+            self.size = write_snapshot(self.path, sections, meta)
+            self.written_at = time.time()
+            return self.size
+
+    def start(self) -> None:
+        if self._thread is not None or self.interval <= 0:
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name='sms-snapshot', daemon=True)
+        self._thread.start()
+
+    def stop(self) -> None:
+        """Stop the periodic writes and write a final snapshot"""
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        self.write()
+
+    def _run(self) -> None:
+        while not self._stop.wait(self.interval):
+            try:
+                self.write()
+            except (OSError, ValueError):
+                # The previous snapshot stays in place; retried on the next tick
+                pass
@@ -0,0 +1,679 @@
+"""
+SMS Platform - Storage
+SQLite persistence for messages, contacts, scheduled messages, templates and idempotency keys
+"""
+
+import atexit
+import fcntl
+import json
+import os
+import sqlite3
+import threading
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple
+
+from search import phone_digits
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS messages (
+    id INTEGER PRIMARY KEY,
+    phone TEXT NOT NULL,
+    message TEXT NOT NULL,
+    timestamp TEXT NOT NULL,
+    status TEXT NOT NULL,
+    delivery_status TEXT NOT NULL,
+    provider_message_id TEXT,
+    seq INTEGER NOT NULL DEFAULT 0
+);
+CREATE INDEX IF NOT EXISTS idx_messages_phone ON messages (phone);
+CREATE INDEX IF NOT EXISTS idx_messages_timestamp ON messages (timestamp);
+CREATE INDEX IF NOT EXISTS idx_messages_status ON messages (status, delivery_status);
+
+CREATE TABLE IF NOT EXISTS contacts (
+    id INTEGER PRIMARY KEY,
+    name TEXT NOT NULL,
+    phone TEXT NOT NULL,
+    messages INTEGER NOT NULL DEFAULT 0,
+    created_at TEXT,
+    tags TEXT NOT NULL DEFAULT '[]',
+    seq INTEGER NOT NULL DEFAULT 0,
+    last_message_at TEXT
+);
+CREATE INDEX IF NOT EXISTS idx_contacts_phone ON contacts (phone);
+
+CREATE TABLE IF NOT EXISTS scheduled_messages (
+    id INTEGER PRIMARY KEY,
+    phone TEXT NOT NULL,
+    message TEXT NOT NULL,
+    scheduled_time TEXT NOT NULL,
+    created_at TEXT NOT NULL,
+    status TEXT NOT NULL,
+    sent_at TEXT,
+    message_id INTEGER,
+    seq INTEGER NOT NULL DEFAULT 0,
+    scheduled_at TEXT
+);
+CREATE INDEX IF NOT EXISTS idx_scheduled_phone ON scheduled_messages (phone);
+CREATE INDEX IF NOT EXISTS idx_scheduled_time ON scheduled_messages (scheduled_time);
+CREATE INDEX IF NOT EXISTS idx_scheduled_status ON scheduled_messages (status);
+
+CREATE TABLE IF NOT EXISTS templates (
+    id INTEGER PRIMARY KEY,
+    name TEXT NOT NULL,
+    body TEXT NOT NULL,
+    created_at TEXT NOT NULL,
+    seq INTEGER NOT NULL DEFAULT 0
+);
+
+CREATE TABLE IF NOT EXISTS idempotency_keys (
+    key TEXT PRIMARY KEY,
+    fingerprint TEXT NOT NULL,
+    status INTEGER NOT NULL,
+    body BLOB NOT NULL,
+    expires_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_idempotency_expires ON idempotency_keys (expires_at);
+
+CREATE TABLE IF NOT EXISTS id_blocks (
+    name TEXT PRIMARY KEY,
+    next_id INTEGER NOT NULL
+);
+
+CREATE TABLE IF NOT EXISTS counters (
+    name TEXT PRIMARY KEY,
+    value INTEGER NOT NULL
+);
+"""
+
+# Created once the migrations have added the columns they cover
+INDEXES = """
+CREATE INDEX IF NOT EXISTS idx_messages_seq ON messages (seq);
+CREATE INDEX IF NOT EXISTS idx_contacts_seq ON contacts (seq);
+CREATE INDEX IF NOT EXISTS idx_scheduled_seq ON scheduled_messages (seq);
+CREATE INDEX IF NOT EXISTS idx_templates_seq ON templates (seq);
+CREATE INDEX IF NOT EXISTS idx_messages_provider ON messages (provider_message_id);
+CREATE UNIQUE INDEX IF NOT EXISTS idx_contacts_phone_digits ON contacts (phone_digits);
+"""
+
+# Columns added after the first release: (table, column, definition)
+MIGRATIONS = (
+    ('messages', 'provider_message_id', 'TEXT'),
+    ('messages', 'seq', 'INTEGER NOT NULL DEFAULT 0'),
+    ('contacts', 'seq', 'INTEGER NOT NULL DEFAULT 0'),
+    ('scheduled_messages', 'seq', 'INTEGER NOT NULL DEFAULT 0'),
+    ('templates', 'seq', 'INTEGER NOT NULL DEFAULT 0'),
+    ('scheduled_messages', 'scheduled_at', 'TEXT'),
+    ('contacts', 'last_message_at', 'TEXT'),
+    ('contacts', 'phone_digits', 'TEXT'),
+)
+
+# Statements are constant strings so sqlite3's statement cache keeps them prepared
+# (the last value of messages, contacts, scheduled and template rows is the change sequence)
+UPSERT_MESSAGE = (
+    'INSERT OR REPLACE INTO messages '
+    '(id, phone, message, timestamp, status, delivery_status, provider_message_id, seq) '
+    'VALUES (?, ?, ?, ?, ?, ?, ?, ?)'
+)
+UPSERT_CONTACT = (
+    'INSERT OR REPLACE INTO contacts (id, name, phone, messages, created_at, tags, last_message_at, phone_digits, '
+    'seq) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)'
+)
+# New contacts are inserted right away, so a phone number another process took is refused at once
+INSERT_CONTACT = (
+    'INSERT INTO contacts (id, name, phone, messages, created_at, tags, last_message_at, phone_digits, seq) '
+    'VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?) ON CONFLICT (phone_digits) DO NOTHING'
+)
+UPSERT_SCHEDULED = (
+    'INSERT OR REPLACE INTO scheduled_messages '
+    '(id, phone, message, scheduled_time, created_at, status, sent_at, message_id, scheduled_at, seq) '
+    'VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)'
+)
+UPSERT_TEMPLATE = (
+    'INSERT OR REPLACE INTO templates (id, name, body, created_at, seq) VALUES (?, ?, ?, ?, ?)'
+)
+UPSERT_IDEMPOTENCY = (
+    'INSERT OR REPLACE INTO idempotency_keys (key, fingerprint, status, body, expires_at) '
+    'VALUES (?, ?, ?, ?, ?)'
+)
+# Status changes of stored messages only rewrite the columns that change
+UPDATE_MESSAGE_STATUS = (
+    'UPDATE messages SET status = ?1, delivery_status = ?2, provider_message_id = ?3, seq = ?5 WHERE id = ?4'
+)
+# A sent message counts on its contact without reading it first, so no process's increment is lost
+COUNT_CONTACT_MESSAGE = (
+    'UPDATE contacts SET messages = messages + 1, last_message_at = MAX(COALESCE(last_message_at, ?1), ?1), '
+    'seq = ?2 WHERE id = ?3 RETURNING messages, last_message_at'
+)
+# Every flush takes the next change sequence number
+NEXT_CHANGE = (
+    "INSERT INTO counters (name, value) VALUES ('changes', 1) "
+    'ON CONFLICT (name) DO UPDATE SET value = value + 1 RETURNING value'
+)
+TABLES = (
+    ('messages', UPSERT_MESSAGE),
+    ('contacts', UPSERT_CONTACT),
+    ('scheduled_messages', UPSERT_SCHEDULED),
+    ('templates', UPSERT_TEMPLATE),
+    ('idempotency_keys', UPSERT_IDEMPOTENCY),
+)
+SEQUENCED = ('messages', 'contacts', 'scheduled_messages', 'templates')
+SCHEDULED_COLUMNS = ('phone', 'message', 'scheduled_time', 'created_at', 'status', 'sent_at', 'message_id',
+                     'scheduled_at')
+
+
+def _contact(row: tuple) -> Dict:
+    contact = {'id': row[0], 'name': row[1], 'phone': row[2], 'messages': row[3]}
+    if row[4] is not None:
+        contact['created_at'] = row[4]
+        contact['tags'] = json.loads(row[5])
+    if row[6] is not None:
+        contact['last_message_at'] = row[6]
+    return contact
+
+
+def _contact_row(contact: Dict) -> tuple:
+    return (contact['id'], contact['name'], contact['phone'], contact.get('messages', 0),
+            contact.get('created_at'), json.dumps(contact.get('tags', [])), contact.get('last_message_at'),
+            phone_digits(contact['phone']) or None)
+
+
+def _scheduled_entry(row: tuple) -> Dict:
+    entry = {'id': row[0], 'phone': row[1], 'message': row[2], 'scheduled_time': row[3],
+             'created_at': row[4], 'status': row[5], 'sent_at': row[6]}
+    if row[7] is not None:
+        entry['message_id'] = row[7]
+    if row[8] is not None:
+        entry['scheduled_at'] = row[8]
+    return entry
+
+
+def _fsync_file(path: str) -> None:
+    try:
+        fd = os.open(path, os.O_RDONLY)
+    except FileNotFoundError:
+        return
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def sqlite_path(database_url: str) -> Optional[str]:
+    """Extract the file path from a sqlite:/// URL, or None for other databases"""
+    prefix = 'sqlite:///'
+    if not database_url or not database_url.startswith(prefix):
+        return None
+    return database_url[len(prefix):] or ':memory:'
+
+
+class Storage:
+    """
+    Write-behind SQLite store.
+    Writes are buffered per table (repeated saves of the same row coalesce)
+    and committed together once `batch_size` rows are pending or every
+    `flush_interval` seconds, whichever comes first.
+
+    Each flush stamps its rows with the next number of a change sequence
+    shared by every process (rows from before it existed have 0), so
+    `load_*(since)` returns what changed after a point. `synced` is the sequence number up to which this process holds
+    every stored change in memory: the caller sets it after loading, and
+    flushes advance it while no other process has flushed in between.
+
+    Every process holds a shared lock on the database's `-processes` file
+    while its storage is open. `first_process` says whether this process
+    found no other holder, i.e. every process that used the database
+    before has exited and the work they left unfinished is its to take over.
+    """
+    def __init__(self, path: str, batch_size: int = 100, flush_interval: float = 1.0,
+                 id_block_size: int = 1000):
+        self.path = path
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.id_block_size = id_block_size
+        self._lock = threading.Lock()
+        self._pending = {name: {} for name, _ in TABLES}
+        self._pending_status: Dict[int, tuple] = {}
+        self._pending_count = 0
+        self._id_blocks = {}
+        self._closed = threading.Event()
+        self.synced = 0
+
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None,
+                                     cached_statements=64)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute('PRAGMA synchronous=NORMAL')
+        self._conn.execute('PRAGMA busy_timeout=5000')
+        self._conn.executescript(SCHEMA)
+        self._migrate()
+        self._fill_phone_digits()
+        self._conn.executescript(INDEXES)
+        self._process_lock = None
+        self.first_process = self._attach()
+
+        self._flusher = threading.Thread(target=self._flush_loop, name='sms-storage', daemon=True)
+        self._flusher.start()
+        atexit.register(self.close)
+
+    def _migrate(self) -> None:
+        for table, column, definition in MIGRATIONS:
+            columns = {row[1] for row in self._conn.execute(f'PRAGMA table_info({table})')}
+            if column not in columns:
+                self._conn.execute(f'ALTER TABLE {table} ADD COLUMN {column} {definition}')
+
+    def _fill_phone_digits(self) -> None:
+        # Rows from before the column existed; a number held twice keeps it on the first row only
+        conn = self._conn
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            rows = conn.execute('SELECT id, phone FROM contacts WHERE phone_digits IS NULL ORDER BY id').fetchall()
+            if rows:
+                taken = {row[0] for row in conn.execute(
+                    'SELECT phone_digits FROM contacts WHERE phone_digits IS NOT NULL')}
+                updates = []
+                for contact_id, phone in rows:
+                    digits = phone_digits(phone)
+                    if digits and digits not in taken:
+                        taken.add(digits)
+                        updates.append((digits, contact_id))
+                conn.executemany('UPDATE contacts SET phone_digits = ? WHERE id = ?', updates)
+            conn.execute('COMMIT')
+        except Exception:
+            conn.execute('ROLLBACK')
+            raise
+
+    def _attach(self) -> bool:
+        if self.path == ':memory:':
+            return True
+        self._process_lock = open(self.path + '-processes', 'wb')
+        # The write transaction keeps other processes from checking while this one holds the lock exclusively
+        self._conn.execute('BEGIN IMMEDIATE')
+        try:
+            try:
+                fcntl.flock(self._process_lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                first = True
+            except BlockingIOError:
+                first = False
+            fcntl.flock(self._process_lock, fcntl.LOCK_SH)
+        finally:
+            self._conn.execute('COMMIT')
+        return first
+
+    # Loading
+
+    def change_sequence(self) -> int:
+        """Number of the latest flush by any process"""
+        row = self._conn.execute("SELECT value FROM counters WHERE name = 'changes'").fetchone()
+        return row[0] if row else 0
+
+    def load_messages(self, since: int = -1) -> List[Dict]:
+        """Stored messages, or only those changed by flushes after `since`"""
+        cursor = self._conn.execute(
+            'SELECT id, phone, message, timestamp, status, delivery_status, provider_message_id '
+            'FROM messages WHERE seq > ? ORDER BY id', (since,)
+        )
+        return [
+            {'id': row[0], 'phone': row[1], 'message': row[2], 'timestamp': row[3],
+             'status': row[4], 'delivery_status': row[5], 'provider_message_id': row[6]}
+            for row in cursor
+        ]
+
+    def load_contacts(self, since: int = -1) -> List[Dict]:
+        cursor = self._conn.execute(
+            'SELECT id, name, phone, messages, created_at, tags, last_message_at FROM contacts '
+            'WHERE seq > ? ORDER BY id',
+            (since,)
+        )
+        return [_contact(row) for row in cursor]
+
+    def get_contact(self, contact_id: int = None, phone: str = None) -> Optional[Dict]:
+        """The stored contact with `contact_id` (or `phone`), as last flushed by any process"""
+        column, value = ('id', contact_id) if phone is None else ('phone_digits', phone_digits(phone))
+        with self._lock:
+            row = self._conn.execute(
+                'SELECT id, name, phone, messages, created_at, tags, last_message_at FROM contacts '
+                f'WHERE {column} = ?', (value,)
+            ).fetchone()
+        return _contact(row) if row is not None else None
+
+    def load_scheduled(self, since: int = -1) -> List[Dict]:
+        cursor = self._conn.execute(
+            'SELECT id, phone, message, scheduled_time, created_at, status, sent_at, message_id, scheduled_at '
+            'FROM scheduled_messages WHERE seq > ? ORDER BY id', (since,)
+        )
+        return [_scheduled_entry(row) for row in cursor]
+
+    def get_scheduled(self, entry_id: int) -> Optional[Dict]:
+        """The stored scheduled entry with `entry_id`, as last flushed by any process"""
+        with self._lock:
+            row = self._conn.execute(
+                'SELECT id, phone, message, scheduled_time, created_at, status, sent_at, message_id, scheduled_at '
+                'FROM scheduled_messages WHERE id = ?', (entry_id,)
+            ).fetchone()
+        return _scheduled_entry(row) if row is not None else None
+
+    def load_templates(self, since: int = -1) -> List[Dict]:
+        cursor = self._conn.execute(
+            'SELECT id, name, body, created_at FROM templates WHERE seq > ? ORDER BY id', (since,)
+        )
+        return [{'id': row[0], 'name': row[1], 'body': row[2], 'created_at': row[3]} for row in cursor]
+
+    def get_template(self, template_id: int) -> Optional[Dict]:
+        """The stored template with `template_id`, as last flushed by any process"""
+        with self._lock:
+            row = self._conn.execute(
+                'SELECT id, name, body, created_at FROM templates WHERE id = ?', (template_id,)
+            ).fetchone()
+        return {'id': row[0], 'name': row[1], 'body': row[2], 'created_at': row[3]} if row is not None else None
+
+    def load_idempotency(self, now: float, limit: int) -> Iterator[tuple]:
+        """Up to `limit` unexpired (key, fingerprint, status, body, expires_at) rows, newest first"""
+        # Rows are read as they are consumed, so a caller that stops early never holds the rest
+        yield from self._conn.execute(
+            'SELECT key, fingerprint, status, body, expires_at FROM idempotency_keys '
+            'WHERE expires_at > ? ORDER BY expires_at DESC LIMIT ?', (now, limit)
+        )
+
+    def get_idempotency(self, key: str, now: float) -> Optional[tuple]:
+        """(fingerprint, status, body, expires_at) stored for `key`, or None"""
+        with self._lock:
+            row = self._pending['idempotency_keys'].get(key)
+            if row is None:
+                row = self._conn.execute(
+                    'SELECT key, fingerprint, status, body, expires_at FROM idempotency_keys WHERE key = ?',
+                    (key,)
+                ).fetchone()
+        if row is None or row[4] <= now:
+            return None
+        return tuple(row[1:])
+
+    def purge_idempotency(self, now: float) -> None:
+        """Delete expired idempotency keys"""
+        with self._lock:
+            self._conn.execute('DELETE FROM idempotency_keys WHERE expires_at <= ?', (now,))
+
+    # ID allocation
+
+    def next_id(self, name: str) -> int:
+        """
+        Allocate an ID unique across every process sharing the database.
+        IDs are reserved from SQLite in blocks of `id_block_size`, so the
+        database is only touched once per block.
+        """
+        with self._lock:
+            block = self._id_blocks.get(name)
+            if block is None or block[0] >= block[1]:
+                block = self._reserve_block(name)
+                self._id_blocks[name] = block
+            allocated = block[0]
+            block[0] += 1
+            return allocated
+
+    def _reserve_block(self, name: str) -> List[int]:
+        conn = self._conn
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            row = conn.execute('SELECT next_id FROM id_blocks WHERE name = ?', (name,)).fetchone()
+            if row is None:
+                # First reservation starts after any rows already stored
+                start = conn.execute(f'SELECT COALESCE(MAX(id), 0) + 1 FROM {name}').fetchone()[0]
+            else:
+                start = row[0]
+            end = start + self.id_block_size
+            conn.execute('INSERT OR REPLACE INTO id_blocks (name, next_id) VALUES (?, ?)', (name, end))
+            conn.execute('COMMIT')
+        except Exception:
+            conn.execute('ROLLBACK')
+            raise
+        return [start, end]
+
+    # Writing
+
+    def save_message(self, msg) -> None:
+        self._save('messages', msg.id, (
+            msg.id, msg.phone, msg.message, msg.timestamp, msg.status, msg.delivery_status,
+            msg.provider_message_id
+        ))
+
+    def save_message_statuses(self, msgs) -> None:
+        """Persist the status, delivery status and provider ID of already saved messages"""
+        rows = [(msg.status, msg.delivery_status, msg.provider_message_id, msg.id) for msg in msgs]
+        with self._lock:
+            pending = self._pending['messages']
+            statuses = self._pending_status
+            for row in rows:
+                key = row[3]
+                full = pending.get(key)
+                if full is not None:
+                    # The message itself is not written yet; update the buffered row
+                    pending[key] = full[:4] + row[:3]
+                    continue
+                if key not in statuses:
+                    self._pending_count += 1
+                statuses[key] = row
+            if self._pending_count >= self.batch_size:
+                self._flush_locked()
+
+    def update_delivery_statuses(self, receipts: Iterable[Tuple[str, str]]) -> List[Dict]:
+        """
+        Set the delivery status of stored messages from (provider message
+        ID, delivery status) receipts, for messages other processes sent.
+        Returns the updated rows; a receipt whose message is not stored
+        (yet) changes nothing.
+        """
+        with self._lock:
+            conn = self._conn
+            # Reads do not block writers, so only receipts that match take the write lock
+            found = [(delivery_status, provider_message_id) for provider_message_id, delivery_status in receipts
+                     if conn.execute('SELECT 1 FROM messages WHERE provider_message_id = ?',
+                                     (provider_message_id,)).fetchone()]
+            if not found:
+                return []
+            rows = self._change(lambda conn, seq: [
+                row for delivery_status, provider_message_id in found for row in conn.execute(
+                    'UPDATE messages SET delivery_status = ?, seq = ? WHERE provider_message_id = ? '
+                    'RETURNING id, phone, message, timestamp, status, delivery_status, provider_message_id',
+                    (delivery_status, seq, provider_message_id)
+                )
+            ])
+        return [
+            {'id': row[0], 'phone': row[1], 'message': row[2], 'timestamp': row[3],
+             'status': row[4], 'delivery_status': row[5], 'provider_message_id': row[6]}
+            for row in rows
+        ]
+
+    def save_contact(self, contact: Dict) -> None:
+        self._save('contacts', contact['id'], _contact_row(contact))
+
+    def insert_contact(self, contact: Dict) -> Optional[Dict]:
+        """
+        Insert a new contact now unless a stored contact has its phone number
+        (compared by digits; the database enforces it). Returns that stored
+        contact, or None once inserted.
+        """
+        row = _contact_row(contact)
+        with self._lock:
+            # A buffered row may hold the number too
+            self._flush_locked()
+            inserted = self._change(lambda conn, seq: conn.execute(INSERT_CONTACT, row + (seq,)).rowcount)
+        return None if inserted else self.get_contact(phone=contact['phone'])
+
+    def count_contact_message(self, contact_id: int, timestamp: str) -> Optional[Tuple[int, str]]:
+        """
+        Count one more message sent to a contact at `timestamp`, in one
+        statement so concurrent processes all count. Returns the stored
+        (messages, last_message_at), or None if the contact is not stored.
+        """
+        with self._lock:
+            pending = self._pending['contacts']
+            row = pending.get(contact_id)
+            if row is not None:
+                # The contact itself is not written yet; count on the buffered row
+                row = row[:3] + (row[3] + 1,) + row[4:6] + (max(row[6] or timestamp, timestamp),) + row[7:]
+                pending[contact_id] = row
+                return row[3], row[6]
+            counted = self._change(lambda conn, seq: (conn.execute(
+                COUNT_CONTACT_MESSAGE, (timestamp, seq, contact_id)).fetchall() or [None])[0])
+        return tuple(counted) if counted is not None else None
+
+    def update_contact(self, contact_id: int, changes: Dict) -> Optional[Dict]:
+        """
+        Write only the changed name or tags of a stored contact, leaving the
+        counters other processes keep moving alone. Returns the stored contact
+        after the change, or None if it is not stored.
+        """
+        columns = {column: json.dumps(value) if column == 'tags' else value for column, value in changes.items()}
+        if any(column not in ('name', 'tags') for column in columns):
+            raise ValueError('Only name and tags of a contact can be updated')
+        with self._lock:
+            pending = self._pending['contacts']
+            row = pending.get(contact_id)
+            if row is not None:
+                row = (row[0], columns.get('name', row[1]), *row[2:5], columns.get('tags', row[5]), *row[6:])
+                pending[contact_id] = row
+            else:
+                statement = 'UPDATE contacts SET {}, seq = ? WHERE id = ? RETURNING {}'.format(
+                    ', '.join(f'{column} = ?' for column in columns),
+                    'id, name, phone, messages, created_at, tags, last_message_at'
+                )
+                row = self._change(lambda conn, seq: (conn.execute(
+                    statement, (*columns.values(), seq, contact_id)).fetchall() or [None])[0])
+        return _contact(row) if row is not None else None
+
+    def save_scheduled(self, entry: Dict) -> None:
+        self._save('scheduled_messages', entry['id'], (
+            entry['id'], entry['phone'], entry['message'], entry['scheduled_time'],
+            entry['created_at'], entry['status'], entry.get('sent_at'), entry.get('message_id'),
+            entry.get('scheduled_at')
+        ))
+
+    def update_scheduled_if(self, entry_id: int, expected: Dict, changes: Dict) -> bool:
+        """
+        Apply `changes` to a stored scheduled entry only while its columns
+        hold the `expected` values. The check and the write are one
+        statement, so when several processes make the same transition
+        (claiming a due entry, cancelling it) exactly one succeeds.
+        Buffered writes are flushed first. Returns whether the entry changed.
+        """
+        if any(column not in SCHEDULED_COLUMNS for column in (*expected, *changes)):
+            raise ValueError('Unknown scheduled_messages column')
+        statement = 'UPDATE scheduled_messages SET {}, seq = ? WHERE id = ? AND {}'.format(
+            ', '.join(f'{column} = ?' for column in changes),
+            ' AND '.join(f'{column} IS ?' for column in expected)
+        )
+        with self._lock:
+            self._flush_locked()
+            changed = self._change(lambda conn, seq: conn.execute(
+                statement, (*changes.values(), seq, entry_id, *expected.values())).rowcount)
+        return changed == 1
+
+    def save_template(self, template: Dict) -> None:
+        self._save('templates', template['id'], (
+            template['id'], template['name'], template['body'], template['created_at']
+        ))
+
+    def save_idempotency(self, key: str, fingerprint: str, status: int, body: bytes,
+                         expires_at: float) -> None:
+        self._save('idempotency_keys', key, (key, fingerprint, status, body, expires_at))
+
+    def _save(self, table: str, key, row: tuple) -> None:
+        with self._lock:
+            pending = self._pending[table]
+            if key not in pending:
+                self._pending_count += 1
+            pending[key] = row
+            # A full row supersedes a buffered status update of the same message
+            if table == 'messages' and self._pending_status.pop(key, None) is not None:
+                self._pending_count -= 1
+            if self._pending_count >= self.batch_size:
+                self._flush_locked()
+
+    def _change(self, work):
+        # One write transaction with its own change sequence number; the caller holds _lock
+        conn = self._conn
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            seq = conn.execute(NEXT_CHANGE).fetchone()[0]
+            result = work(conn, seq)
+            conn.execute('COMMIT')
+        except Exception:
+            conn.execute('ROLLBACK')
+            raise
+        if seq == self.synced + 1:
+            self.synced = seq
+        return result
+
+    def flush(self) -> None:
+        """Commit all buffered writes in one transaction"""
+        with self._lock:
+            self._flush_locked()
+
+    def sync(self) -> None:
+        """
+        Commit all buffered writes and make every commit so far durable.
+        With synchronous=NORMAL a WAL commit is not fsynced, so a power loss
+        could still undo it; the database and its WAL are fsynced here.
+        """
+        with self._lock:
+            self._flush_locked()
+            if self.path == ':memory:':
+                return
+            for path in (self.path + '-wal', self.path):
+                _fsync_file(path)
+
+    def _flush_locked(self) -> None:
+        if not self._pending_count:
+            return
+        conn = self._conn
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            seq = conn.execute(NEXT_CHANGE).fetchone()[0]
+            for table, statement in TABLES:
+                rows = self._pending[table]
+                if rows and table in SEQUENCED:
+                    conn.executemany(statement, [row + (seq,) for row in rows.values()])
+                elif rows:
+                    conn.executemany(statement, rows.values())
+            if self._pending_status:
+                conn.executemany(UPDATE_MESSAGE_STATUS, [row + (seq,) for row in self._pending_status.values()])
+            conn.execute('COMMIT')
+        except Exception:
+            conn.execute('ROLLBACK')
+            raise
+        if seq == self.synced + 1:
+            self.synced = seq
+        for table, _ in TABLES:
+            self._pending[table] = {}
+        self._pending_status = {}
+        self._pending_count = 0
+
+    def _flush_loop(self) -> None:
+        while not self._closed.wait(self.flush_interval):
+            try:
+                self.flush()
+            except sqlite3.Error:
+                # Rows stay buffered and are retried on the next tick
+                pass
+
+    def close(self) -> None:
+        """Flush pending writes and close the connection"""
+        if self._closed.is_set():
+            return
+        self._closed.set()
+        with self._lock:
+            self._flush_locked()
+            # Hand back unused IDs if no other process reserved after us
+            for name, (start, end) in self._id_blocks.items():
+                self._conn.execute(
+                    'UPDATE id_blocks SET next_id = ? WHERE name = ? AND next_id = ?',
+                    (start, name, end)
+                )
+            self._conn.close()
+        if self._process_lock is not None:
+            self._process_lock.close()
+
+
+def open_storage(database_url: str, **kwargs) -> Optional[Storage]:
+    """Open a Storage for a sqlite:/// DATABASE_URL; other URLs are not supported yet"""
+    path = sqlite_path(database_url)
+    if path is None:
+        return None
+    return Storage(path, **kwargs)
@@ -0,0 +1,96 @@
+"""
+SMS Platform - Stub Provider
+Local HTTP server speaking the Twilio Messages API, for tests and development
+Run with: python stub_provider.py [port]
+"""
+
+import json
+import random
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs
+from uuid import uuid4
+
+
+class StubProvider:
+    """
+    Accepts POST /2010-04-01/Accounts/<sid>/Messages.json and answers like
+    Twilio. `latency` (seconds) delays every response and `failure_rate`
+    answers that fraction of requests with HTTP 500, to exercise retries.
+    """
+    def __init__(self, host: str = '127.0.0.1', port: int = 0,
+                 latency: float = 0.0, failure_rate: float = 0.0):
+        self.latency = latency
+        self.failure_rate = failure_rate
+        self.received = []
+        self.connections = set()
+        self._lock = threading.Lock()
+        self._server = ThreadingHTTPServer((host, port), self._handler())
+        self._server.daemon_threads = True
+        self._thread = None
+
+    @property
+    def url(self) -> str:
+        host, port = self._server.server_address[:2]
+        return f'http://{host}:{port}'
+
+    def _handler(self):
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            # HTTP/1.1 keeps connections open between requests
+            protocol_version = 'HTTP/1.1'
+
+            def log_message(self, format, *args):
+                pass
+
+            def _reply(self, status: int, payload: dict) -> None:
+                body = json.dumps(payload).encode()
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def do_POST(self):
+                length = int(self.headers.get('Content-Length', 0))
+                form = {key: values[0] for key, values in parse_qs(self.rfile.read(length).decode()).items()}
+                with stub._lock:
+                    stub.connections.add(self.client_address)
+                if stub.latency:
+                    time.sleep(stub.latency)
+
+                if not self.path.endswith('/Messages.json'):
+                    self._reply(404, {'message': 'Not found'})
+                    return
+                if 'To' not in form or 'Body' not in form:
+                    self._reply(400, {'message': 'To and Body are required'})
+                    return
+                if stub.failure_rate and random.random() < stub.failure_rate:
+                    self._reply(500, {'message': 'Simulated failure'})
+                    return
+
+                sid = 'SM' + uuid4().hex
+                with stub._lock:
+                    stub.received.append({'sid': sid, **form})
+                self._reply(201, {'sid': sid, 'status': 'queued', 'to': form['To'], 'body': form['Body']})
+
+        return Handler
+
+    def start(self) -> 'StubProvider':
+        self._thread = threading.Thread(target=self._server.serve_forever, name='sms-stub-provider', daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self) -> None:
+        self._server.shutdown()
+        self._server.server_close()
+
+
+if __name__ == '__main__':
+    port = int(sys.argv[1]) if len(sys.argv) > 1 else 5050
+    stub = StubProvider(port=port)
+    print(f'📡 Stub SMS provider listening on {stub.url}')
+    stub._server.serve_forever()
@@ -0,0 +1,210 @@
+"""
+SMS Platform - Tag Index
+Contact tags as bitmaps, queried with AND / OR / NOT expressions
+"""
+
+import marshal
+import re
+from typing import Callable, Dict, Iterable, List
+
+TOKEN_RE = re.compile(r'\s*(?:(\()|(\))|([^\s()]+))')
+OPERATORS = ('AND', 'OR', 'NOT')
+
+
+def normalize_tag(tag) -> str:
+    return str(tag).strip().lower()
+
+
+def contact_tags(contact: Dict) -> set:
+    """Normalized tags of a contact"""
+    tags = contact.get('tags') or ()
+    if isinstance(tags, str):
+        tags = (tags,)
+    return {normalize_tag(tag) for tag in tags if normalize_tag(tag)}
+
+
+class TagIndex:
+    """
+    Inverted index from tag to the contacts carrying it.
+    Each tag is a bitmap with bit N set for contact ID N, kept in a
+    bytearray so tagging a contact flips one bit in place. A query turns
+    the bitmaps it names into Python ints, and AND, OR and NOT become
+    single &, | and & ~ operations in C over the whole set (a million
+    contacts is 125 KB per tag). Writers must be serialised by the caller.
+    """
+    def __init__(self):
+        self._bitmaps: Dict[str, bytearray] = {}
+        self._counts: Dict[str, int] = {}
+        self._all = bytearray()
+
+    @staticmethod
+    def _set(bitmap: bytearray, bit: int, value: bool) -> None:
+        index = bit >> 3
+        if index >= len(bitmap):
+            if not value:
+                return
+            # Grow geometrically so a bulk load does not reallocate per contact
+            bitmap.extend(bytes(max(index + 1 - len(bitmap), len(bitmap))))
+        if value:
+            bitmap[index] |= 1 << (bit & 7)
+        else:
+            bitmap[index] &= ~(1 << (bit & 7)) & 0xFF
+
+    @staticmethod
+    def _has(bitmap: bytearray, bit: int) -> bool:
+        index = bit >> 3
+        return index < len(bitmap) and bool(bitmap[index] & (1 << (bit & 7)))
+
+    def add(self, contact: Dict) -> None:
+        contact_id = contact['id']
+        self._set(self._all, contact_id, True)
+        self._tag(contact_id, contact_tags(contact), True)
+
+    def remove(self, contact: Dict) -> None:
+        contact_id = contact['id']
+        self._set(self._all, contact_id, False)
+        self._tag(contact_id, contact_tags(contact), False)
+
+    def update(self, contact: Dict, old_tags: Iterable) -> None:
+        """Re-index a contact whose tags changed from `old_tags`"""
+        old = contact_tags({'tags': old_tags})
+        new = contact_tags(contact)
+        self._tag(contact['id'], old - new, False)
+        self._tag(contact['id'], new - old, True)
+
+    def _tag(self, contact_id: int, tags: Iterable[str], value: bool) -> None:
+        for tag in tags:
+            bitmap = self._bitmaps.get(tag)
+            if bitmap is None:
+                if not value:
+                    continue
+                bitmap = self._bitmaps[tag] = bytearray()
+            if self._has(bitmap, contact_id) == value:
+                continue
+            self._set(bitmap, contact_id, value)
+            self._counts[tag] = self._counts.get(tag, 0) + (1 if value else -1)
+
+    def dump(self) -> bytes:
+        """The bitmaps as one marshalled blob, for a snapshot; writers must be held off"""
+        return marshal.dumps((bytes(self._all), {tag: bytes(bitmap) for tag, bitmap in self._bitmaps.items()},
+                              self._counts))
+
+    def restore(self, data) -> None:
+        """Load an empty index from a dump (startup only)"""
+        everyone, bitmaps, self._counts = marshal.loads(data)
+        self._all = bytearray(everyone)
+        self._bitmaps = {tag: bytearray(bitmap) for tag, bitmap in bitmaps.items()}
+
+    def tags(self) -> Dict[str, int]:
+        """Contacts per tag"""
+        return {tag: count for tag, count in sorted(self._counts.items()) if count}
+
+    def bitmap(self, tag: str) -> int:
+        bitmap = self._bitmaps.get(normalize_tag(tag))
+        return int.from_bytes(bitmap, 'little') if bitmap else 0
+
+    def query(self, expression: str) -> int:
+        """
+        Bitmap of the contacts matching `expression`, e.g.
+        "vip AND (us-east OR us-west) AND NOT churned". NOT binds tighter
+        than AND, which binds tighter than OR. Raises ValueError if the
+        expression cannot be parsed.
+        """
+        tokens = []
+        position = 0
+        expression = expression.strip()
+        while position < len(expression):
+            match = TOKEN_RE.match(expression, position)
+            if match is None:
+                break
+            opening, closing, word = match.groups()
+            if word is not None and word.upper() in OPERATORS:
+                tokens.append(word.upper())
+            else:
+                tokens.append(opening or closing or ('tag', normalize_tag(word)))
+            position = match.end()
+        if not tokens:
+            raise ValueError('Tag expression is empty')
+
+        universe = int.from_bytes(self._all, 'little')
+        bitmaps = {}
+        position = 0
+
+        def peek():
+            return tokens[position] if position < len(tokens) else None
+
+        def take():
+            nonlocal position
+            position += 1
+            return tokens[position - 1]
+
+        def parse_or():
+            result = parse_and()
+            while peek() == 'OR':
+                take()
+                result |= parse_and()
+            return result
+
+        def parse_and():
+            result = parse_not()
+            while peek() == 'AND':
+                take()
+                result &= parse_not()
+            return result
+
+        def parse_not():
+            if peek() == 'NOT':
+                take()
+                return universe & ~parse_not()
+            return parse_term()
+
+        def parse_term():
+            token = take() if peek() is not None else None
+            if token == '(':
+                result = parse_or()
+                if peek() != ')':
+                    raise ValueError('Missing ) in tag expression')
+                take()
+                return result
+            if isinstance(token, tuple):
+                tag = token[1]
+                if tag not in bitmaps:
+                    bitmaps[tag] = self.bitmap(tag)
+                return bitmaps[tag]
+            raise ValueError(f'Expected a tag in tag expression, found {token or "the end"}')
+
+        result = parse_or()
+        if position < len(tokens):
+            token = tokens[position]
+            raise ValueError(f'Unexpected {token[1] if isinstance(token, tuple) else token} in tag expression')
+        return result
+
+
+def bitmap_ids(bitmap: int, limit: int = None) -> List[int]:
+    """IDs of the set bits, ascending (the first `limit` of them)"""
+    if not bitmap:
+        return []
+    data = bitmap.to_bytes((bitmap.bit_length() + 63) // 64 * 8, 'little')
+    ids = []
+    # Zero words are skipped in bulk; set bits are peeled off lowest first
+    for index, word in enumerate(memoryview(data).cast('Q')):
+        if not word:
+            continue
+        base = index * 64
+        while word:
+            low = word & -word
+            ids.append(base + low.bit_length() - 1)
+            word ^= low
+        if limit is not None and len(ids) >= limit:
+            return ids[:limit]
+    return ids
+
+
+def bitmap_contains(bitmap: int) -> Callable[[int], bool]:
+    """Membership test of IDs in `bitmap`, O(1) per ID (shifting the int is O(size))"""
+    data = bitmap.to_bytes((bitmap.bit_length() + 7) // 8, 'little')
+
+    def contains(contact_id: int) -> bool:
+        index = contact_id >> 3
+        return index < len(data) and bool(data[index] >> (contact_id & 7) & 1)
+    return contains
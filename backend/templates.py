@@ -0,0 +1,138 @@
+"""
+SMS Platform - Message Templates
+Message bodies with contact placeholders, compiled once and rendered in bulk
+"""
+
+import re
+from functools import lru_cache
+from typing import Callable, Dict, Iterable, List, Tuple
+
+from utils import GSM7, GSM7_DELETE_TABLE, GSM7_EXTENSION_DELETE_TABLE, UCS2, analyze_message, count_segments
+
+# Contact fields a template can use, as {name}
+FIELDS = ('name', 'first_name', 'phone', 'tags')
+# {{ and }} are literal braces; {field} is a placeholder; a lone brace is an error
+TOKEN_RE = re.compile(r'\{\{|\}\}|\{([^{}]*)\}|[{}]')
+
+
+def _first_name(contact: Dict) -> str:
+    name = contact.get('name') or ''
+    return name.split(maxsplit=1)[0] if name.strip() else ''
+
+
+FIELD_GETTERS: Dict[str, Callable[[Dict], str]] = {
+    'name': lambda contact: contact.get('name') or '',
+    'first_name': _first_name,
+    'phone': lambda contact: contact.get('phone') or '',
+    'tags': lambda contact: ', '.join(map(str, contact.get('tags') or ())),
+}
+
+
+def _measure(value: str) -> Tuple[bool, int, int]:
+    """(fits GSM-7, GSM-7 septets, UCS-2 units) of a text fragment"""
+    encoding, units, _ = analyze_message(value)
+    if encoding == GSM7:
+        # Every GSM-7 character is one UCS-2 unit
+        return True, units, len(value)
+    return False, 0, units
+
+
+def _basic_gsm(text: str) -> bool:
+    """Whether every character is in the GSM-7 basic table (one septet each)"""
+    return not text.translate(GSM7_DELETE_TABLE) and \
+        len(text.translate(GSM7_EXTENSION_DELETE_TABLE)) == len(text)
+
+
+def _measure_all(values: Iterable[str]) -> Dict[str, Tuple[bool, int, int]]:
+    """_measure() of many values; ASCII ones are usually checked in one pass"""
+    values = list(values)
+    ascii_values = [value for value in values if value.isascii()]
+    measured = {}
+    rest = values
+    if _basic_gsm(''.join(ascii_values)):
+        measured = {value: (True, len(value), len(value)) for value in ascii_values}
+        rest = [value for value in values if not value.isascii()]
+    for value in rest:
+        if value.translate(GSM7_DELETE_TABLE):
+            measured[value] = (False, 0, len(value.encode('utf-16-le')) // 2)
+        else:
+            septets = 2 * len(value) - len(value.translate(GSM7_EXTENSION_DELETE_TABLE))
+            measured[value] = (True, septets, len(value))
+    return measured
+
+
+class Template:
+    """
+    A message body with {field} placeholders, parsed once into a render
+    plan: the literal text becomes a %-format string and each placeholder
+    a field getter, so rendering is one string format in C. The literal
+    text is also measured once for the segmenter. A bulk render checks all
+    bodies for plain ASCII GSM-7 in one pass, where a body's length is its
+    septet count; otherwise it measures each distinct field value once and
+    adds the lengths up, instead of re-analysing every rendered body.
+    """
+    __slots__ = ('body', 'fields', '_format', '_getters', '_literal')
+
+    def __init__(self, body: str):
+        self.body = body
+        fields = []
+        formats = []
+        literals = []
+        position = 0
+        for match in TOKEN_RE.finditer(body):
+            text = body[position:match.start()]
+            token = match.group(0)
+            if token in ('{{', '}}'):
+                text += token[0]
+            elif match.group(1) is not None:
+                field = match.group(1).strip()
+                if field not in FIELD_GETTERS:
+                    raise ValueError(f'Unknown template field {{{field}}}; use one of: {", ".join(FIELDS)}')
+                fields.append(field)
+            else:
+                raise ValueError('Unmatched brace in template; write {{ or }} for a literal brace')
+            formats.append(text.replace('%', '%%'))
+            literals.append(text)
+            if match.group(1) is not None:
+                formats.append('%s')
+            position = match.end()
+        formats.append(body[position:].replace('%', '%%'))
+        literals.append(body[position:])
+
+        self.fields = tuple(fields)
+        self._format = ''.join(formats)
+        self._getters = tuple(FIELD_GETTERS[field] for field in fields)
+        self._literal = _measure(''.join(literals))
+
+    def render(self, contact: Dict) -> str:
+        return self._format % tuple(getter(contact) for getter in self._getters)
+
+    def render_many(self, contacts: Iterable[Dict]) -> Tuple[List[str], List[int]]:
+        """Rendered bodies and their segment counts, in contact order"""
+        template = self._format
+        getters = self._getters
+        rows = [[getter(contact) for getter in getters] for contact in contacts]
+        bodies = [template % tuple(values) for values in rows]
+        # Usually every body is plain ASCII GSM-7, where septets are characters
+        joined = ''.join(bodies)
+        if joined.isascii() and _basic_gsm(joined):
+            return bodies, [count_segments(GSM7, len(body)) for body in bodies]
+
+        literal_gsm, literal_septets, literal_units = self._literal
+        measured = _measure_all({value for values in rows for value in values})
+        segments = []
+        for values in rows:
+            gsm, septets, units = literal_gsm, literal_septets, literal_units
+            for value in values:
+                size = measured[value]
+                gsm = gsm and size[0]
+                septets += size[1]
+                units += size[2]
+            segments.append(count_segments(GSM7, septets) if gsm else count_segments(UCS2, units))
+        return bodies, segments
+
+
+@lru_cache(maxsize=256)
+def compile_template(body: str) -> Template:
+    """The render plan for `body`, parsed once per distinct body"""
+    return Template(body)
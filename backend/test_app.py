@@ -3,9 +3,30 @@ SMS Platform API Tests
 Run with: pytest test_app.py
 """
 
+import os
+os.environ.setdefault('FLASK_ENV', 'testing')
+
 import pytest
+import csv
+import io
 import json
-from app import app
+import app as app_module
+from app import app, scheduler, scheduled_messages
+from models import Message, MessageLog
+from delivery import DeliveryQueue, TwilioProvider
+from indexes import MessageIndex
+from ratelimit import SharedTokenBuckets
+from repository import Repository
+from search import ContactIndex
+from storage import Storage
+from stub_provider import StubProvider
+from utils import (
+    analyze_message,
+    calculate_segments_batch,
+    parse_timestamp,
+    split_message_segments
+)
+
 
 @pytest.fixture
 def client():
@@ -33,10 +54,10 @@ def test_send_sms_success(client):
     response = client.post('/api/sms/send',
                           data=json.dumps(payload),
                           content_type='application/json')
-    assert response.status_code == 200
+    assert response.status_code == 202
     data = json.loads(response.data)
     assert data['success'] == True
-    assert 'data' in data
+    assert data['data']['status'] == 'queued'
 
 
 def test_send_sms_invalid_phone(client):
@@ -65,6 +86,164 @@ def test_send_sms_empty_message(client):
     assert response.status_code == 400
 
 
+def test_message_segments_gsm7_and_ucs2():
+    """Test encoding-aware segment counting and splitting"""
+    assert analyze_message('é£' * 80) == ('GSM-7', 160, 1)
+    assert analyze_message('€' * 81) == ('GSM-7', 162, 2)
+    assert analyze_message('a' * 161) == ('GSM-7', 161, 2)
+    assert analyze_message('`') == ('UCS-2', 1, 1)
+    assert analyze_message('中' * 71) == ('UCS-2', 71, 2)
+    assert split_message_segments('a' * 307) == [(0, 153), (153, 306), (306, 307)]
+    # An extension character never straddles two segments
+    assert split_message_segments('a' * 152 + '{' + 'a' * 10) == [(0, 152), (152, 163)]
+    assert calculate_segments_batch(['hi', 'a' * 200, 'hi', '']) == [1, 2, 1, 0]
+
+
+def test_send_sms_delivered_by_workers(client):
+    """Test queued messages are handed to the provider in the background"""
+    response = client.post('/api/sms/send',
+                          data=json.dumps({'phone': '+1234567890', 'message': 'Async'}),
+                          content_type='application/json')
+    assert app_module.delivery.join(timeout=5)
+    msg = app_module.message_index.get(json.loads(response.data)['data']['id'])
+    assert msg.status == 'sent'
+    assert msg.provider_message_id is not None
+
+
+WEBHOOK_HEADERS = {'X-Webhook-Token': 'test-webhook-token'}
+
+
+def test_delivery_receipts_update_status_and_analytics(client, monkeypatch):
+    """Test batched receipts settle messages and feed analytics"""
+    response = client.post('/api/sms/send',
+                          data=json.dumps({'phone': '+1234567890', 'message': 'Receipt me'}),
+                          content_type='application/json')
+    assert app_module.delivery.join(timeout=5)
+    msg = app_module.message_index.get(json.loads(response.data)['data']['id'])
+    before = json.loads(client.get('/api/analytics').data)['analytics']
+    
+    response = client.post('/api/sms/receipts', data=json.dumps({'receipts': [
+        {'provider_message_id': msg.provider_message_id, 'status': 'sent'},
+        {'provider_message_id': msg.provider_message_id, 'status': 'delivered'},
+        {'provider_message_id': 'SM-not-yet-known', 'status': 'failed'},
+        {'status': 'delivered'}
+    ]}), content_type='application/json', headers=WEBHOOK_HEADERS)
+    assert response.status_code == 202
+    data = json.loads(response.data)
+    assert (data['accepted'], data['ignored'], data['invalid']) == (2, 1, 1)
+    
+    app_module.receipts.flush()
+    assert msg.delivery_status == 'delivered'
+    # Settled messages leave the provider ID index
+    assert app_module.message_index.get_by_provider_id(msg.provider_message_id) is None
+    after = json.loads(client.get('/api/analytics').data)['analytics']
+    assert after['total_delivered'] == before['total_delivered'] + 1
+    
+    # Twilio-style form callback
+    response = client.post('/api/sms/receipts', data={'MessageSid': 'SM1', 'MessageStatus': 'undelivered'},
+                           headers=WEBHOOK_HEADERS)
+    assert json.loads(response.data)['accepted'] == 1
+    
+    # A message another worker sent is only in the database
+    elsewhere = Message(phone='+1234567890', message='Sent elsewhere', message_id=10 ** 9)
+    elsewhere.provider_message_id = 'SM-other-worker'
+    app_module.storage.save_message(elsewhere)
+    app_module.storage.flush()
+    generation = app_module.repository.generation('messages')
+    client.post('/api/sms/receipts', data={'MessageSid': 'SM-other-worker', 'MessageStatus': 'delivered'},
+                headers=WEBHOOK_HEADERS)
+    app_module.receipts.flush()
+    stored = [row for row in app_module.storage.load_messages() if row['id'] == 10 ** 9]
+    assert stored[0]['delivery_status'] == 'delivered'
+    # Nothing in memory changed, so cached listings stay valid
+    assert app_module.repository.generation('messages') == generation
+    
+    response = client.post('/api/sms/receipts', data={'MessageSid': 'SM1', 'MessageStatus': 'delivered'},
+                           headers={'X-Webhook-Token': 'wrong'})
+    assert response.status_code == 401
+    # Without a configured token the webhook is closed
+    monkeypatch.setitem(app.config, 'RECEIPT_WEBHOOK_TOKEN', '')
+    response = client.post('/api/sms/receipts', data={'MessageSid': 'SM1', 'MessageStatus': 'delivered'},
+                           headers={'X-Webhook-Token': ''})
+    assert response.status_code == 403
+
+
+def test_delivery_queue_with_stub_provider():
+    """Test delivery retries, results and keep-alive against the stub provider"""
+    stub = StubProvider(failure_rate=0.3).start()
+    provider = TwilioProvider('AC123', 'token', '+15550001111', base_url=stub.url, pool_size=4)
+    results = {}
+    queue = DeliveryQueue(provider, lambda item, sid, error: results.__setitem__(item, (sid, error)),
+                          workers=4, max_retries=10, backoff=0.001)
+    queue.start()
+    try:
+        for i in range(50):
+            assert queue.submit(i, '+1234567890', f'Stub {i}')
+        assert queue.join(timeout=10)
+    finally:
+        stub.stop()
+    
+    assert len(results) == 50
+    assert all(sid and error is None for sid, error in results.values())
+    assert len(stub.received) == 50
+    # Pooled keep-alive connections, not one connection per message
+    assert len(stub.connections) <= 8
+
+
+def test_rate_limit_shared_between_processes(tmp_path):
+    """Test two bucket tables mapping one file share the same budget"""
+    path = str(tmp_path / 'buckets')
+    worker_a = SharedTokenBuckets([(3, 3600), (5, 86400)], path=path, slots=64)
+    worker_b = SharedTokenBuckets([(3, 3600), (5, 86400)], path=path, slots=64)
+    now = 1000.0
+    assert worker_a.consume('ip:1', now=now)[0]
+    assert worker_b.consume('ip:1', now=now)[0]
+    assert worker_a.consume('ip:1', now=now)[0]
+    allowed, retry_after = worker_b.consume('ip:1', now=now)
+    assert not allowed and retry_after == pytest.approx(1200)
+    assert worker_b.consume('ip:2', now=now)[0]
+    # Refilled after an hour, but the daily bucket still holds only two tokens
+    assert worker_a.consume('ip:1', cost=2, now=now + 3600)[0]
+    assert not worker_a.consume('ip:1', now=now + 3600)[0]
+    worker_a.close()
+    worker_b.close()
+
+
+def test_rate_limit_returns_429(client, monkeypatch):
+    """Test rate limited endpoints answer 429 with Retry-After"""
+    monkeypatch.setattr(app_module, 'rate_limiter', SharedTokenBuckets([(2, 3600)], slots=16))
+    monkeypatch.setitem(app.config, 'API_KEYS', frozenset({'test-key'}))
+    payload = {'recipients': ['+1234567890', '+1234567891'], 'message': 'Limited'}
+    response = client.post('/api/sms/send/batch',
+                          data=json.dumps(payload),
+                          content_type='application/json',
+                          headers={'X-API-Key': 'test-key'})
+    assert response.status_code == 202
+    response = client.post('/api/sms/send',
+                          data=json.dumps({'phone': '+1234567890', 'message': 'Limited'}),
+                          content_type='application/json',
+                          headers={'X-API-Key': 'test-key'})
+    assert response.status_code == 429
+    assert int(response.headers['Retry-After']) >= 1
+    
+    # Other callers have their own buckets
+    response = client.post('/api/sms/send',
+                          data=json.dumps({'phone': '+1234567890', 'message': 'Limited'}),
+                          content_type='application/json')
+    assert response.status_code == 202
+    # Keys that are not configured share the IP's bucket instead of getting a new one each
+    response = client.post('/api/sms/send',
+                          data=json.dumps({'phone': '+1234567890', 'message': 'Limited'}),
+                          content_type='application/json',
+                          headers={'X-API-Key': 'made-up-key'})
+    assert response.status_code == 202
+    response = client.post('/api/sms/send',
+                          data=json.dumps({'phone': '+1234567890', 'message': 'Limited'}),
+                          content_type='application/json',
+                          headers={'X-API-Key': 'another-made-up-key'})
+    assert response.status_code == 429
+
+
 def test_get_messages(client):
     """Test getting messages"""
     response = client.get('/api/sms/messages')
@@ -74,6 +253,116 @@ def test_get_messages(client):
     assert 'count' in data
 
 
+def test_get_messages_cursor_and_filters(client):
+    """Test keyset pagination with a phone filter"""
+    for i in range(5):
+        client.post('/api/sms/send',
+                    data=json.dumps({'phone': '+1 555 010 0000', 'message': f'Cursor {i}'}),
+                    content_type='application/json')
+    
+    response = client.get('/api/sms/messages?phone=%2B15550100000&per_page=2')
+    data = json.loads(response.data)
+    assert [m['message'] for m in data['messages']] == ['Cursor 0', 'Cursor 1']
+    
+    seen = [m['message'] for m in data['messages']]
+    while data['next_cursor'] is not None:
+        response = client.get(f"/api/sms/messages?phone=%2B15550100000&per_page=2&cursor={data['next_cursor']}")
+        data = json.loads(response.data)
+        seen += [m['message'] for m in data['messages']]
+    assert seen == [f'Cursor {i}' for i in range(5)]
+    
+    assert app_module.delivery.join(timeout=5)
+    response = client.get('/api/sms/messages?phone=%2B15550100000&order=desc&per_page=1&status=sent')
+    data = json.loads(response.data)
+    assert data['messages'][0]['message'] == 'Cursor 4'
+    
+    response = client.get('/api/sms/messages?phone=%2B15550100000&until=2000-01-01T00:00:00')
+    assert json.loads(response.data)['messages'] == []
+
+
+def test_export_messages_ndjson_and_csv(client):
+    """Test message history streams as NDJSON and CSV with filters"""
+    for i in range(3):
+        client.post('/api/sms/send',
+                    data=json.dumps({'phone': '+1 555 010 4242', 'message': f'Export, {i}'}),
+                    content_type='application/json')
+    
+    response = client.get('/api/sms/messages/export?phone=%2B15550104242')
+    assert response.status_code == 200
+    assert response.mimetype == 'application/x-ndjson'
+    rows = [json.loads(line) for line in response.data.decode().splitlines()]
+    assert [row['message'] for row in rows] == ['Export, 0', 'Export, 1', 'Export, 2']
+    
+    response = client.get('/api/sms/messages/export?format=csv&phone=%2B15550104242')
+    lines = list(csv.reader(io.StringIO(response.data.decode())))
+    assert lines[0][:3] == ['id', 'phone', 'message']
+    assert [line[2] for line in lines[1:]] == ['Export, 0', 'Export, 1', 'Export, 2']
+    
+    response = client.get('/api/sms/messages/export?phone=%2B15550104242&until=2000-01-01T00:00:00')
+    assert response.data == b''
+    assert client.get('/api/sms/messages/export?format=xml').status_code == 400
+
+
+def test_message_index_status_update():
+    """Test status changes move messages between filtered views"""
+    log = MessageLog()
+    index = MessageIndex(log)
+    batch = [Message(phone='+1234567890', message=str(i), message_id=i) for i in range(1, 11)]
+    for msg in batch:
+        log.append(msg)
+        index.add(msg)
+    for msg in batch[:6]:
+        msg.delivery_status = 'delivered'
+        index.update(msg, 'delivery_status', 'pending')
+    
+    delivered, _ = index.query(delivery_status='delivered', limit=100)
+    pending, _ = index.query(delivery_status='pending', limit=100)
+    assert [m.id for m in delivered] == [1, 2, 3, 4, 5, 6]
+    assert [m.id for m in pending] == [7, 8, 9, 10]
+    
+    page, cursor = index.query(delivery_status='pending', limit=3, descending=True)
+    assert [m.id for m in page] == [10, 9, 8] and cursor == 8
+
+
+def test_message_index_time_range_out_of_order():
+    """Test time ranges find every message when timestamps do not follow IDs"""
+    from models import US
+    log = MessageLog()
+    index = MessageIndex(log)
+    # Two workers' ID blocks interleave in time, as after loading a shared database
+    for msg_id in range(1, 301):
+        msg = Message(phone='+1234567890', message=str(msg_id), message_id=msg_id)
+        msg.timestamp_us = (1_700_000_000 + (msg_id if msg_id <= 150 else msg_id - 150)) * US
+        log.append(msg)
+        index.add(msg)
+    
+    expected = [msg.id for msg in log if 1_700_000_100 * US <= msg.timestamp_us <= 1_700_000_110 * US]
+    assert len(expected) == 22
+    page, _ = index.query(since=1_700_000_100, until=1_700_000_110, limit=100)
+    assert [msg.id for msg in page] == expected
+    page, _ = index.query(since=1_700_000_100, until=1_700_000_110, limit=100, descending=True)
+    assert [msg.id for msg in page] == expected[::-1]
+
+
+def test_message_log_views():
+    """Test stored messages round-trip through the columnar log"""
+    log = MessageLog()
+    first = Message(phone='+1234567890', message='Same body ✓', message_id=1)
+    expected = first.to_dict()
+    log.append(first)
+    log.append(Message(phone='+1234567890', message='Same body ✓', message_id=2))
+    assert log[0].to_dict() == expected
+    assert Message.from_dict(expected).timestamp == expected['timestamp']
+    
+    first.status = 'failed'
+    first.provider_message_id = 'SM1'
+    assert log[0].status == 'failed' and log[0].provider_message_id == 'SM1'
+    assert log[1].provider_message_id is None
+    # Repeated bodies and phones are stored once
+    assert len(log.bodies) == 1 and len(log.phones) == 1
+    assert [msg.id for msg in log[-2:]] == [1, 2]
+
+
 def test_get_contacts(client):
     """Test getting contacts"""
     response = client.get('/api/contacts')
@@ -82,6 +371,25 @@ def test_get_contacts(client):
     assert 'contacts' in data
 
 
+def test_list_etag_and_not_modified(client):
+    """Test unchanged lists answer 304 and writes change the ETag"""
+    response = client.get('/api/contacts?search=doe')
+    etag = response.headers['ETag']
+    assert response.status_code == 200 and etag
+    
+    response = client.get('/api/contacts?search=doe', headers={'If-None-Match': etag})
+    assert response.status_code == 304
+    assert response.data == b''
+    
+    client.post('/api/contacts/add',
+                data=json.dumps({'name': 'Etag Doe', 'phone': '+1 555 010 7777'}),
+                content_type='application/json')
+    response = client.get('/api/contacts?search=doe', headers={'If-None-Match': etag})
+    assert response.status_code == 200
+    assert response.headers['ETag'] != etag
+    assert 'Etag Doe' in [c['name'] for c in json.loads(response.data)['contacts']]
+
+
 def test_add_contact_success(client):
     """Test adding a contact"""
     payload = {
@@ -107,12 +415,55 @@ def test_add_contact_missing_data(client):
     assert response.status_code == 400
 
 
+def test_add_contact_duplicate(client):
+    """Test duplicate phone numbers are rejected whatever the formatting"""
+    response = client.post('/api/contacts/add',
+                          data=json.dumps({'name': 'Dup', 'phone': '+12345678901'}),
+                          content_type='application/json')
+    assert response.status_code == 409
+
+
+def test_import_contacts_csv(client):
+    """Test streaming CSV contact import"""
+    body = (
+        'name,phone,tags\n'
+        'Csv One,+15550000001,vip;us-east\n'
+        'Csv Dup,+1 555 000 0001,\n'
+        'Csv Bad,12,\n'
+        'Csv Two,+15550000002,\n'
+    )
+    response = client.post('/api/contacts/import', data=body, content_type='text/csv')
+    assert response.status_code == 200
+    data = json.loads(response.data)
+    assert data['summary'] == {'inserted': 2, 'duplicates': 1, 'invalid': 1, 'total': 4}
+    assert data['errors'][0]['line'] == 4
+    
+    response = client.get('/api/contacts?search=5550000001')
+    contact = json.loads(response.data)['contacts'][0]
+    assert contact['tags'] == ['vip', 'us-east']
+
+
+def test_import_contacts_ndjson(client):
+    """Test streaming NDJSON contact import"""
+    body = (
+        '{"name": "Json One", "phone": "+15550000101"}\n'
+        'not json\n'
+        '{"name": "Json One Again", "phone": "+15550000101"}\n'
+    )
+    response = client.post('/api/contacts/import', data=body, content_type='application/x-ndjson')
+    assert response.status_code == 200
+    data = json.loads(response.data)
+    assert data['summary']['inserted'] == 1
+    assert data['summary']['duplicates'] == 1
+    assert data['summary']['invalid'] == 1
+
+
 def test_schedule_message_success(client):
     """Test scheduling a message"""
     payload = {
         'phone': '+1234567890',
         'message': 'Scheduled test',
-        'scheduled_time': '2026-01-01T10:00:00'
+        'scheduled_time': '2099-01-01T10:00:00'
     }
     response = client.post('/api/sms/schedule',
                           data=json.dumps(payload),
@@ -153,6 +504,25 @@ def test_get_analytics(client):
     assert 'delivery_rate' in data['analytics']
 
 
+def test_analytics_rollups(client):
+    """Test analytics counts deliveries and answers time windows"""
+    before = json.loads(client.get('/api/analytics').data)['analytics']
+    response = client.post('/api/sms/send',
+                          data=json.dumps({'phone': '+1234567890', 'message': 'Rollup'}),
+                          content_type='application/json')
+    msg = app_module.message_index.get(json.loads(response.data)['data']['id'])
+    app_module.set_delivery_status(msg, 'delivered')
+    
+    after = json.loads(client.get('/api/analytics').data)['analytics']
+    assert after['total_delivered'] == before['total_delivered'] + 1
+    assert after['active_today'] == before['active_today'] + 1
+    assert after['delivery_rate'] > 0
+    
+    response = client.get('/api/analytics?since=2000-01-01T00:00:00&until=2000-01-02T00:00:00&interval=hour')
+    window = json.loads(response.data)['analytics']['window']
+    assert window['sent'] == 0 and window['series'] == []
+
+
 def test_search_contacts(client):
     """Test contact search"""
     response = client.get('/api/contacts?search=john')
@@ -161,6 +531,33 @@ def test_search_contacts(client):
     assert 'contacts' in data
 
 
+def test_search_contacts_ranked(client):
+    """Test contact search ranks exact and prefix matches first"""
+    response = client.get('/api/contacts?search=jo&per_page=10')
+    data = json.loads(response.data)
+    names = [c['name'] for c in data['contacts']]
+    assert names[:2] == ['John Doe', 'Bob Johnson']
+    assert data['per_page'] == 10
+
+
+def test_contact_index_phone_and_substring():
+    """Test contact index phone prefix/suffix and substring lookups"""
+    index = ContactIndex()
+    for i in range(2000):
+        index.add({'id': i, 'name': f'User{i} Smithson', 'phone': f'+1555{i:07d}'})
+    
+    count, results = index.search('+1 555 000 1999')
+    assert count == 1 and results[0]['id'] == 1999
+    count, _ = index.search('0001999')
+    assert count == 1
+    count, results = index.search('mithso', limit=5, offset=5)
+    assert count == 2000 and len(results) == 5
+    assert index.search('user42 smith')[1][0]['id'] == 42
+    
+    index.remove(index.get(42))
+    assert all(c['id'] != 42 for c in index.search('user42')[1])
+
+
 def test_pagination(client):
     """Test message pagination"""
     response = client.get('/api/sms/messages?page=1&per_page=5')
@@ -172,5 +569,860 @@ def test_pagination(client):
     assert data['per_page'] == 5
 
 
+def test_send_sms_batch_recipients(client):
+    """Test batch sending one body to many recipients"""
+    payload = {
+        'recipients': ['+1234567890', '+1 234 567 8901', 'invalid'],
+        'message': 'Batch message'
+    }
+    response = client.post('/api/sms/send/batch',
+                          data=json.dumps(payload),
+                          content_type='application/json')
+    assert response.status_code == 202
+    data = json.loads(response.data)
+    assert data['summary']['queued'] == 2
+    assert data['summary']['failed'] == 1
+    assert data['summary']['estimated_cost'] == 0.02
+    assert data['results'][1]['data']['phone'] == '+12345678901'
+    assert data['results'][2]['success'] == False
+
+
+def test_send_sms_batch_pairs(client):
+    """Test batch sending explicit (phone, message) pairs"""
+    payload = {
+        'messages': [
+            {'phone': '+1234567890', 'message': 'First'},
+            {'phone': '+1234567891', 'message': ''}
+        ]
+    }
+    response = client.post('/api/sms/send/batch',
+                          data=json.dumps(payload),
+                          content_type='application/json')
+    assert response.status_code == 202
+    data = json.loads(response.data)
+    assert data['results'][0]['success'] == True
+    assert 'error' in data['results'][1]
+
+
+def test_send_sms_batch_too_many_recipients(client):
+    """Test batch sending above MAX_RECIPIENTS_PER_REQUEST"""
+    limit = app.config['MAX_RECIPIENTS_PER_REQUEST']
+    payload = {
+        'recipients': ['+1234567890'] * (limit + 1),
+        'message': 'Too many'
+    }
+    response = client.post('/api/sms/send/batch',
+                          data=json.dumps(payload),
+                          content_type='application/json')
+    assert response.status_code == 400
+
+
+def test_send_sms_queue_filled_after_check(client, monkeypatch):
+    """Test a message the full queue refused is reported as failed, not queued"""
+    monkeypatch.setattr(app_module.delivery, 'submit', lambda *args, **kwargs: False)
+    response = client.post('/api/sms/send',
+                          data=json.dumps({'phone': '+1234567890', 'message': 'Refused'}),
+                          content_type='application/json')
+    assert response.status_code == 503
+    assert response.headers['Retry-After'] == '1'
+    assert app_module.messages[-1].status == 'failed'
+    
+    response = client.post('/api/sms/send/batch',
+                          data=json.dumps({'recipients': ['+1234567890'], 'message': 'Refused'}),
+                          content_type='application/json')
+    data = json.loads(response.data)
+    assert data['summary']['queued'] == 0
+    assert data['results'][0]['success'] == False
+    assert data['results'][0]['data']['status'] == 'failed'
+
+
+def test_scheduler_dispatches_due_messages(client):
+    """Test scheduled messages are sent once due"""
+    payload = {
+        'phone': '+1234567890',
+        'message': 'Dispatch me',
+        'scheduled_time': '2099-06-01T10:00:00Z'
+    }
+    response = client.post('/api/sms/schedule',
+                          data=json.dumps(payload),
+                          content_type='application/json')
+    assert response.status_code == 201
+    entry_id = json.loads(response.data)['data']['id']
+    
+    entry = next(e for e in scheduled_messages if e['id'] == entry_id)
+    due = parse_timestamp(payload['scheduled_time'])
+    scheduler.run_pending(now=due - 1)
+    assert entry['status'] == 'scheduled'
+    
+    assert scheduler.run_pending(now=due) >= 1
+    assert entry['status'] == 'sent'
+    assert entry['sent_at'] is not None
+
+
+def test_scheduler_retries_failed_dispatch(client, monkeypatch):
+    """A scheduled message whose dispatch fails is released and sent on a later attempt"""
+    from scheduler import Scheduler
+    calls = []
+    
+    def flaky(batch):
+        calls.append(list(batch))
+        if len(calls) == 1:
+            raise RuntimeError('provider down')
+        return batch if len(calls) == 2 else []
+    
+    retrying = Scheduler(flaky, retry_delay=10)
+    retrying.schedule(100, 'a')
+    assert retrying.run_pending(now=100) == 0 and retrying.next_due() == 110
+    assert retrying.run_pending(now=110) == 0 and retrying.next_due() == 130
+    assert retrying.run_pending(now=130) == 1
+    assert calls == [['a']] * 3 and len(retrying) == 0
+    
+    response = client.post('/api/sms/schedule', json={'phone': '+1234567890', 'message': 'Retry me',
+                                                      'scheduled_time': '2099-07-01T10:00:00Z'})
+    entry = app_module.repository.get_scheduled(response.get_json()['data']['id'])
+    due = parse_timestamp('2099-07-01T10:00:00Z')
+    store_message = app_module.store_message
+    
+    def failing_store(*args):
+        monkeypatch.setattr(app_module, 'store_message', store_message)
+        raise RuntimeError('storage down')
+    
+    monkeypatch.setattr(app_module, 'store_message', failing_store)
+    scheduler.run_pending(now=due)
+    assert entry['status'] == 'scheduled'
+    scheduler.run_pending(now=due + scheduler.retry_delay)
+    assert entry['status'] == 'sent'
+
+
+def test_scheduled_range_queries_reschedule_and_cancel(client):
+    """Test scheduled messages page in due order and update in place"""
+    ids = []
+    for day in (3, 1, 2):
+        response = client.post('/api/sms/schedule', json={
+            'phone': '+15557770001', 'message': f'Day {day}', 'scheduled_time': f'2098-01-0{day}T10:00:00Z'
+        })
+        assert response.status_code == 201
+        assert response.get_json()['data']['scheduled_at'] == f'2098-01-0{day}T10:00:00Z'
+        ids.append(response.get_json()['data']['id'])
+    
+    def query(**params):
+        return client.get('/api/sms/scheduled', query_string={'phone': '+15557770001', **params}).get_json()
+    
+    first = query(per_page=2)
+    assert [entry['message'] for entry in first['scheduled_messages']] == ['Day 1', 'Day 2']
+    second = query(per_page=2, cursor=first['next_cursor'])
+    assert [entry['message'] for entry in second['scheduled_messages']] == ['Day 3']
+    assert second['next_cursor'] is None
+    window = query(since='2098-01-02T00:00:00Z', until='2098-01-03T10:00:00Z', order='desc')
+    assert [entry['message'] for entry in window['scheduled_messages']] == ['Day 3', 'Day 2']
+    
+    # Day 3 moves first; its old due time no longer sends it
+    response = client.patch(f'/api/sms/scheduled/{ids[0]}', json={'scheduled_time': '2097-12-31T10:00:00Z'})
+    assert response.status_code == 200
+    assert [entry['message'] for entry in query()['scheduled_messages']] == ['Day 3', 'Day 1', 'Day 2']
+    assert client.post(f'/api/sms/scheduled/{ids[1]}/cancel').status_code == 200
+    assert client.post(f'/api/sms/scheduled/{ids[1]}/cancel').status_code == 409
+    assert [entry['message'] for entry in query(status='scheduled')['scheduled_messages']] == ['Day 3', 'Day 2']
+    
+    scheduler.run_pending(now=parse_timestamp('2098-01-03T10:00:00Z'))
+    assert [entry['status'] for entry in query()['scheduled_messages']] == ['sent', 'cancelled', 'sent']
+    assert client.get('/api/sms/scheduled?cursor=bad').status_code == 400
+    assert client.patch('/api/sms/scheduled/999999', json={'scheduled_time': '2098-01-01T10:00:00Z'}).status_code == 404
+
+
+def test_reschedule_and_cancel_entries_of_other_workers(client):
+    """Entries another worker scheduled are loaded from storage to be rescheduled or cancelled"""
+    storage = app_module.storage
+    ids = [storage.next_id('scheduled_messages') for _ in range(2)]
+    for entry_id in ids:
+        storage.save_scheduled({'id': entry_id, 'phone': '+1234567890', 'message': 'Elsewhere',
+                                'scheduled_time': '2099-08-01T10:00:00Z', 'created_at': '2025-01-01T00:00:00',
+                                'status': 'scheduled', 'scheduled_at': '2099-08-01T10:00:00Z'})
+    storage.flush()
+    assert app_module.repository.scheduled_index.get(ids[0]) is None
+    
+    response = client.patch(f'/api/sms/scheduled/{ids[0]}', json={'scheduled_time': '2099-08-02T10:00:00Z'})
+    assert response.status_code == 200
+    assert storage.get_scheduled(ids[0])['scheduled_at'] == '2099-08-02T10:00:00Z'
+    assert client.post(f'/api/sms/scheduled/{ids[1]}/cancel').status_code == 200
+    assert storage.get_scheduled(ids[1])['status'] == 'cancelled'
+    assert client.post(f'/api/sms/scheduled/{ids[1]}/cancel').status_code == 409
+
+
+def test_storage_round_trip(tmp_path):
+    """Test SQLite storage persists all stores across reopen"""
+    path = str(tmp_path / 'sms.db')
+    store = Storage(path, batch_size=2)
+    msg = Message(phone='+1234567890', message='Persist me', message_id=store.next_id('messages'))
+    store.save_message(msg)
+    store.save_contact({'id': 1, 'name': 'Ann', 'phone': '+1234567890', 'messages': 0,
+                        'created_at': '2025-01-01T00:00:00', 'tags': ['vip']})
+    store.save_scheduled({'id': 1, 'phone': '+1234567890', 'message': 'Later',
+                          'scheduled_time': '2099-01-01T10:00:00',
+                          'created_at': '2025-01-01T00:00:00', 'status': 'scheduled'})
+    store.save_template({'id': 1, 'name': 'Hello', 'body': 'Hi {name}', 'created_at': '2025-01-01T00:00:00'})
+    store.close()
+    
+    reopened = Storage(path)
+    assert reopened.load_messages()[0]['message'] == 'Persist me'
+    assert reopened.load_contacts()[0]['tags'] == ['vip']
+    assert reopened.load_scheduled()[0]['status'] == 'scheduled'
+    assert reopened.load_templates()[0]['body'] == 'Hi {name}'
+    assert reopened.next_id('messages') > msg.id
+    reopened.close()
+
+
+def test_storage_ids_unique_across_processes(tmp_path):
+    """Test ID blocks never overlap between stores sharing a database"""
+    path = str(tmp_path / 'sms.db')
+    first = Storage(path, id_block_size=10)
+    second = Storage(path, id_block_size=10)
+    ids = [first.next_id('messages') for _ in range(25)]
+    ids += [second.next_id('messages') for _ in range(25)]
+    assert len(set(ids)) == 50
+    first.close()
+    second.close()
+
+
+def test_storage_first_process(tmp_path):
+    """Test only a store opened while no other has the database open is the first process"""
+    path = str(tmp_path / 'sms.db')
+    first = Storage(path)
+    second = Storage(path)
+    assert first.first_process and not second.first_process
+    first.close()
+    # A process still running keeps later ones from taking over
+    third = Storage(path)
+    assert not third.first_process
+    second.close()
+    third.close()
+    fourth = Storage(path)
+    assert fourth.first_process
+    fourth.close()
+
+
+def test_repository_reads_other_processes_writes(tmp_path):
+    """Contacts and templates another process stored are found through storage"""
+    from tags import bitmap_ids
+    path = str(tmp_path / 'sms.db')
+    first = Repository(Storage(path))
+    second = Repository(Storage(path))
+    contact, _ = first.add_contact({'name': 'Ann', 'phone': '+1234567890', 'messages': 0,
+                                    'created_at': '2025-01-01T00:00:00', 'tags': ['vip']})
+    first.add_template({'name': 'Hello', 'body': 'Hi {name}', 'created_at': '2025-01-01T00:00:00'})
+    first.storage.flush()
+    
+    assert second.get_contact(contact['id'])['name'] == 'Ann'
+    # Found once, the contact is held in memory and indexed like the others
+    assert second.contact_index.get(contact['id']) is not None
+    assert bitmap_ids(second.tag_index.query('vip')) == [contact['id']]
+    assert second.add_contact({'name': 'Ann again', 'phone': '+1234567890', 'messages': 0})[1] is False
+    template_id = next(iter(first.templates))
+    assert second.get_template(template_id)['body'] == 'Hi {name}'
+    assert second.get_contact(999999) is None
+    first.storage.close()
+    second.storage.close()
+
+
+def test_contact_phone_unique_across_processes(tmp_path, monkeypatch):
+    """The database refuses a second contact with the same phone digits, whichever process adds it"""
+    import sqlite3
+    path = str(tmp_path / 'sms.db')
+    first = Repository(Storage(path))
+    second = Repository(Storage(path))
+    contact, created = first.add_contact({'name': 'Ann', 'phone': '+1 234 567 8901', 'messages': 0})
+    assert created
+    # As if both processes checked before either inserted
+    monkeypatch.setattr(second, 'get_contact_by_phone', lambda phone: None)
+    existing, created = second.add_contact({'name': 'Ann again', 'phone': '+12345678901', 'messages': 0})
+    assert not created and existing['id'] == contact['id']
+    assert second.contact_index.get(contact['id']) is existing
+    first.storage.close()
+    second.storage.close()
+    
+    # Rows stored before the constraint: a number held twice keeps it on the first row only
+    conn = sqlite3.connect(path)
+    conn.execute('DROP INDEX idx_contacts_phone_digits')
+    conn.execute("INSERT INTO contacts (id, name, phone, messages) VALUES (5000, 'Old', '+1-234-567-8901', 0)")
+    conn.execute('UPDATE contacts SET phone_digits = NULL')
+    conn.commit()
+    conn.close()
+    reopened = Storage(path)
+    assert reopened.get_contact(phone='12345678901')['id'] == contact['id']
+    assert reopened.insert_contact({'id': 5001, 'name': 'New', 'phone': '+1 (234) 567-8901'})['id'] == contact['id']
+    reopened.close()
+
+def test_contact_counters_shared_between_processes(tmp_path):
+    """Messages counted by several processes all land, and counting keeps other workers' edits"""
+    path = str(tmp_path / 'sms.db')
+    first = Repository(Storage(path))
+    second = Repository(Storage(path))
+    contact, _ = first.add_contact({'name': 'Ann', 'phone': '+1234567890', 'messages': 0,
+                                    'created_at': '2025-01-01T00:00:00', 'tags': []})
+    first.add_message(Message(phone='+1234567890', message='Before it is stored'))
+    first.storage.flush()
+    second.update_contact(second.get_contact(contact['id']), name='Renamed')
+    for repo in (first, second, first, second):
+        repo.add_message(Message(phone='+1234567890', message='Counted'))
+    
+    stored = first.storage.get_contact(contact['id'])
+    assert (stored['messages'], stored['name']) == (5, 'Renamed')
+    assert second.get_contact(contact['id'])['messages'] == 5
+    assert second.get_contact(contact['id'])['last_message_at'] == stored['last_message_at']
+    first.storage.close()
+    second.storage.close()
+
+
+def test_repository_concurrent_writers():
+    """Test concurrent inserts get unique IDs and duplicate phones insert once"""
+    import threading
+    repo = Repository()
+    repo.load(contacts=[{'id': 1, 'name': 'Seed', 'phone': '+10000000000', 'messages': 0}])
+    created = []
+    errors = []
+    start = threading.Barrier(8)
+
+    def worker(number):
+        try:
+            start.wait()
+            for i in range(200):
+                msg = Message(phone='+1234567890', message=f'{number}-{i}')
+                repo.add_message(msg)
+                repo.update_message(msg, status='sent')
+                # Every worker races for the same 100 phone numbers
+                contact, was_created = repo.add_contact({'id': None, 'name': f'Racer {i}',
+                                                         'phone': f'+1555000{i:04d}', 'messages': 0})
+                if was_created:
+                    created.append(contact['id'])
+                repo.contact_index.search('racer', limit=5)
+                repo.message_index.query(status='sent', limit=5)
+        except Exception as exc:
+            errors.append(exc)
+
+    threads = [threading.Thread(target=worker, args=(n,)) for n in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert not errors
+    assert len(repo.messages) == 1600
+    assert len({msg.id for msg in repo.messages}) == 1600
+    assert len(created) == 200 and len(set(created)) == 200
+    assert 1 not in created
+    assert len(repo.contacts) == 201
+    assert repo.contact_index.search('racer')[0] == 200
+    page, _ = repo.message_index.query(status='queued', limit=10)
+    assert page == []
+
+
+def test_benchmark_compare_flags_regressions():
+    """Slower p50 or lower throughput beyond the threshold is a regression"""
+    from benchmark import compare
+    baseline = {
+        'flask/list': {'ops_per_sec': 1000.0, 'p50_ms': 1.0},
+        'flask/send': {'ops_per_sec': 500.0, 'p50_ms': 2.0},
+        'flask/gone': {'ops_per_sec': 10.0, 'p50_ms': 9.0},
+    }
+    results = {
+        'flask/list': {'ops_per_sec': 900.0, 'p50_ms': 1.1},
+        'flask/send': {'ops_per_sec': 300.0, 'p50_ms': 3.0},
+    }
+    regressions = compare(results, baseline, threshold=1.25)
+    assert len(regressions) == 2
+    assert all(line.startswith('flask/send') for line in regressions)
+    assert compare(results, baseline, threshold=2.0) == []
+
+
+def test_metrics_endpoint(client):
+    """Requests are counted per route and status and timed into histograms"""
+    client.get('/api/contacts')
+    client.post('/api/sms/send', json={'phone': 'nope', 'message': 'Hi'})
+    response = client.get('/metrics')
+    assert response.status_code == 200
+    assert response.mimetype == 'text/plain'
+    text = response.get_data(as_text=True)
+    assert '# TYPE sms_http_request_duration_seconds histogram' in text
+    assert 'sms_http_requests_total{method="POST",route="/api/sms/send",status="400"}' in text
+    assert 'sms_http_request_duration_seconds_bucket{method="GET",route="/api/contacts",le="+Inf"}' in text
+    assert f'sms_contacts {len(app_module.contacts)}' in text
+    assert 'sms_delivery_queue_depth ' in text
+
+
+def test_metrics_aggregate_worker_files(tmp_path):
+    """Counters and histograms of every worker file are summed"""
+    from metrics import Metrics, read_series
+    import shutil
+    # Another worker's file, as if written by pid 1
+    other = Metrics(str(tmp_path / 'other'))
+    other.observe_request('/api/sms/send', 'POST', 200, 0.002)
+    other.observe_request('/api/sms/send', 'POST', 500, 0.3)
+    shutil.copy(other.path, tmp_path / 'metrics-1.db')
+    other.close()
+    first = Metrics(str(tmp_path))
+    first.observe_request('/api/sms/send', 'POST', 200, 0.004)
+
+    text = first.render()
+    assert 'sms_http_requests_total{method="POST",route="/api/sms/send",status="200"} 2' in text
+    assert 'sms_http_request_errors_total{method="POST",route="/api/sms/send"} 1' in text
+    assert 'sms_http_request_duration_seconds_bucket{method="POST",route="/api/sms/send",le="0.005"} 2' in text
+    assert 'sms_http_request_duration_seconds_count{method="POST",route="/api/sms/send"} 3' in text
+    with open(tmp_path / 'metrics-1.db', 'rb') as file:
+        assert len(read_series(file.read())) == 3
+    first.close()
+
+
+def test_sampling_profiler_folds_stacks():
+    """Only registered threads are sampled, as root-first folded stacks"""
+    import time
+    from profiler import SamplingProfiler
+
+    def busy_view():
+        deadline = time.perf_counter() + 0.1
+        while time.perf_counter() < deadline:
+            pass
+
+    profiler = SamplingProfiler(interval=0.001)
+    profiler.start()
+    busy_view()
+    assert profiler.samples == 0
+    profiler.begin('send_sms')
+    busy_view()
+    profiler.end()
+    profiler.stop()
+
+    assert profiler.samples > 0
+    assert set(profiler.endpoints()) == {'send_sms'}
+    lines = profiler.folded().splitlines()
+    assert all(line.startswith('send_sms;') for line in lines)
+    assert any('/test_app.py:' in line and ';busy_view (' in line for line in lines)
+    stack, count = lines[0].rsplit(' ', 1)
+    assert int(count) > 0
+    assert profiler.folded('send_sms').count('\n') == len(lines)
+
+
+def test_profile_endpoint_disabled(client):
+    """Without PROFILER_ENABLED there is no profile to read"""
+    assert app_module.profiler is None
+    response = client.get('/api/admin/profile')
+    assert response.status_code == 404
+
+
+def test_idempotency_key_replays_send(client):
+    """A retried send with the same key is answered without a second message"""
+    payload = {'phone': '+1234567890', 'message': 'Charge me once'}
+    headers = {'Idempotency-Key': 'retry-once-1'}
+    count = len(app_module.messages)
+    first = client.post('/api/sms/send', json=payload, headers=headers)
+    second = client.post('/api/sms/send', json=payload, headers=headers)
+    assert first.status_code == second.status_code == 202
+    assert second.headers['Idempotent-Replayed'] == 'true'
+    assert second.get_json() == first.get_json()
+    assert len(app_module.messages) == count + 1
+    
+    changed = client.post('/api/sms/send', json={**payload, 'message': 'Other'}, headers=headers)
+    assert changed.status_code == 422
+
+
+def test_idempotency_cache_waits_and_persists(tmp_path):
+    """Concurrent duplicates wait for the first response, which survives a restart"""
+    import threading
+    from idempotency import IdempotencyCache
+    store = Storage(str(tmp_path / 'sms.db'))
+    cache = IdempotencyCache(max_entries=2, ttl=60, storage=store)
+    assert cache.acquire('k1') is None
+    results = []
+    waiter = threading.Thread(target=lambda: results.append(cache.acquire('k1', timeout=5)))
+    waiter.start()
+    cache.complete('k1', ('fp', 200, b'{"ok": true}'))
+    waiter.join()
+    assert results == [('fp', 200, b'{"ok": true}')]
+    
+    for key in ('k2', 'k3'):
+        cache.acquire(key)
+        cache.complete(key, ('fp', 201, b'{}'))
+    assert len(cache) == 2
+    # Evicted from memory, still answered from storage
+    assert cache.acquire('k1') == ('fp', 200, b'{"ok": true}')
+    store.close()
+    
+    reopened = Storage(str(tmp_path / 'sms.db'))
+    restarted = IdempotencyCache(ttl=60, storage=reopened)
+    restarted.load()
+    assert len(restarted) == 3
+    assert restarted.acquire('k2') == ('fp', 201, b'{}')
+    # Startup loads only the newest responses that fit in memory, by count and by body size
+    bounded = IdempotencyCache(max_entries=2, ttl=60, storage=reopened)
+    bounded.load()
+    assert list(bounded._entries) == ['k2', 'k3']
+    bounded = IdempotencyCache(ttl=60, storage=reopened, max_bytes=5)
+    bounded.load()
+    assert list(bounded._entries) == ['k2', 'k3']
+    reopened.close()
+
+
+def test_idempotency_response_stored_once_durable(tmp_path):
+    """A response whose journal write fails is not replayed to retries"""
+    from idempotency import IdempotencyCache
+    from journal import Journal, JournalError
+    journal = Journal(str(tmp_path / 'journal'))
+    journal.stop()
+    store = Storage(str(tmp_path / 'sms.db'))
+    cache = IdempotencyCache(ttl=60, storage=store, journal=journal)
+    assert cache.acquire('k1') is None
+    with pytest.raises(JournalError):
+        cache.complete('k1', ('fp', 202, b'{}'))
+    cache.release('k1')
+    assert cache.acquire('k1', timeout=0) is None
+    assert store.get_idempotency('k1', 0) is None
+    store.close()
+
+
+def test_templates_render_and_send(client):
+    """Templates are rendered per contact with per-body segments"""
+    response = client.post('/api/templates', json={'name': 'Promo', 'body': 'Hi {first_name}, 10% off {{today}}'})
+    assert response.status_code == 201
+    template = response.get_json()['template']
+    assert template['fields'] == ['first_name']
+    assert client.post('/api/templates', json={'name': 'Bad', 'body': 'Hi {nickname}'}).status_code == 400
+    
+    response = client.post(f"/api/templates/{template['id']}/render", json={'contact_ids': [1, 2, 999]})
+    data = response.get_json()
+    assert data['summary']['recipients'] == 2
+    assert data['summary']['missing_contact_ids'] == [999]
+    assert data['messages'][0]['message'] == 'Hi John, 10% off {today}'
+    assert data['summary']['segments'] == 2
+    
+    count = len(app_module.messages)
+    response = client.post('/api/sms/send/template', json={'template_id': template['id'], 'contact_ids': [2]})
+    assert response.status_code == 202
+    assert response.get_json()['results'][0]['data']['message'] == 'Hi Jane, 10% off {today}'
+    assert response.get_json()['results'][0]['data']['phone'] == '+12345678902'
+    assert len(app_module.messages) == count + 1
+
+
+def test_template_bulk_segments_match_segmenter():
+    """Bulk rendering counts segments exactly like analysing each body"""
+    from templates import Template
+    from utils import calculate_message_segments
+    contacts = [
+        {'name': name, 'phone': '+1234567890', 'tags': tags}
+        for name in ('Ann Lee', 'Zoë Ω', 'Wei 王', 'Bob 😀', 'Ed {€}', '')
+        for tags in ([], ['vip', 'new'])
+    ]
+    for body in ('Hi {first_name}!', 'Привет {name}', 'x' * 150 + '{name} [{tags}]', '{phone}'):
+        bodies, segments = Template(body).render_many(contacts)
+        assert segments == [calculate_message_segments(rendered) for rendered in bodies]
+
+
+def test_tag_index_expressions():
+    """AND/OR/NOT over tag bitmaps, kept current when tags change"""
+    from tags import TagIndex, bitmap_ids
+    index = TagIndex()
+    tagged = {1: ['VIP', 'us-east'], 2: ['vip', 'us-west'], 3: ['us-east'], 4: ['vip', 'us-east', 'churned'], 70: []}
+    for contact_id, tags in tagged.items():
+        index.add({'id': contact_id, 'tags': tags})
+    assert bitmap_ids(index.query('vip AND us-east')) == [1, 4]
+    assert bitmap_ids(index.query('vip AND (us-east OR us-west) AND NOT churned')) == [1, 2]
+    assert bitmap_ids(index.query('NOT vip')) == [3, 70]
+    assert bitmap_ids(index.query('vip or us-east'), limit=2) == [1, 2]
+    
+    index.update({'id': 4, 'tags': ['us-east']}, old_tags=tagged[4])
+    assert bitmap_ids(index.query('vip')) == [1, 2]
+    assert index.tags() == {'us-east': 3, 'us-west': 1, 'vip': 2}
+    with pytest.raises(ValueError):
+        index.query('vip AND (us-east')
+
+
+def test_audience_quote_and_send(client, monkeypatch):
+    """Contacts are filtered by tag expression and an audience can be quoted and sent"""
+    for n, tags in enumerate((['gold', 'north'], ['gold', 'south'], ['north'])):
+        response = client.post('/api/contacts/add', json={'name': f'Tagged {n}', 'phone': f'+1555222000{n}',
+                                                           'tags': tags})
+        assert response.status_code == 201
+    ids = [contact['id'] for contact in client.get('/api/contacts?tags=gold').get_json()['contacts']]
+    assert len(ids) == 2
+    
+    response = client.patch(f'/api/contacts/{ids[1]}', json={'tags': ['gold', 'north']})
+    assert response.status_code == 200
+    data = client.get('/api/contacts?tags=gold AND north&search=tagged').get_json()
+    assert [contact['id'] for contact in data['contacts']] == ids
+    
+    quote = client.post('/api/audience', json={'tags': 'north AND NOT gold', 'message': 'Hello'}).get_json()
+    assert quote['audience']['size'] == 1
+    assert quote['quote'] == {'recipients': 1, 'segments': 1, 'estimated_cost': 0.01}
+    assert client.post('/api/audience', json={'tags': 'gold AND'}).status_code == 400
+    
+    count = len(app_module.messages)
+    response = client.post('/api/audience/send', json={'tags': 'gold', 'message': 'Gold offer'})
+    assert response.status_code == 202
+    assert response.get_json()['summary']['queued'] == 2
+    assert len(app_module.messages) == count + 2
+    
+    monkeypatch.setitem(app.config, 'MAX_MESSAGE_LENGTH', 5)
+    response = client.post('/api/audience/send', json={'tags': 'gold', 'message': 'Gold offer'})
+    assert response.get_json()['errors'][0]['error'] == 'Message too long (max 5 characters)'
+
+
+def test_audience_send_charges_recipient_budget(client, monkeypatch):
+    """Audiences larger than the hourly request budget are charged to the recipient budget"""
+    monkeypatch.setattr(app_module, 'rate_limiter', SharedTokenBuckets([(1000, 3600), (10000, 86400)], slots=16))
+    monkeypatch.setattr(app_module, 'recipient_limiter',
+                        SharedTokenBuckets([(1500, 3600), (15000, 86400)], slots=16))
+    for n in range(1200):
+        app_module.repository.add_contact({'id': None, 'name': f'Bulk {n}', 'phone': f'+1555444{n:04d}',
+                                           'messages': 0, 'created_at': '2025-01-01T00:00:00',
+                                           'tags': ['bulk']})
+    
+    resolved = []
+    resolve_audience = app_module.resolve_audience
+    monkeypatch.setattr(app_module, 'resolve_audience', lambda data: resolved.append(data) or resolve_audience(data))
+    response = client.post('/api/audience/send', json={'tags': 'bulk', 'message': 'Bulk offer'})
+    assert response.status_code == 202
+    assert response.get_json()['summary']['queued'] == 1200
+    # The rate limiter and the view share one resolution of the tag expression
+    assert len(resolved) == 1
+    app_module.audience_sends.submit(lambda: None).result(timeout=10)
+    # Spent recipient tokens come back over time
+    response = client.post('/api/audience/send', json={'tags': 'bulk', 'message': 'Bulk offer'})
+    assert response.status_code == 429
+    assert 1 <= int(response.headers['Retry-After']) <= 3600
+    # An audience no full bucket could pay for is refused outright instead
+    monkeypatch.setattr(app_module, 'recipient_limiter', SharedTokenBuckets([(1000, 3600)], slots=16))
+    response = client.post('/api/audience/send', json={'tags': 'bulk', 'message': 'Bulk offer'})
+    assert response.status_code == 413
+    assert 'at most 1000' in response.get_json()['error']
+
+
+def test_contact_conversation_and_counters(client):
+    """Sends to a contact's number update its counters and page through its conversation"""
+    contact = client.post('/api/contacts/add', json={'name': 'Talkative', 'phone': '+15553330001'}).get_json()['contact']
+    client.post('/api/sms/send', json={'phone': '+15553330002', 'message': 'Someone else'})
+    for n in range(5):
+        response = client.post('/api/sms/send', json={'phone': '+15553330001', 'message': f'Hello {n}'})
+        assert response.status_code == 202
+    
+    contact = app_module.contact_index.get(contact['id'])
+    assert contact['messages'] == 5
+    assert contact['last_message_at'] == app_module.messages[-1].timestamp
+    
+    url = f"/api/contacts/{contact['id']}/messages?per_page=2"
+    first = client.get(url).get_json()
+    assert [msg['message'] for msg in first['messages']] == ['Hello 4', 'Hello 3']
+    second = client.get(f"{url}&cursor={first['next_cursor']}").get_json()
+    assert [msg['message'] for msg in second['messages']] == ['Hello 2', 'Hello 1']
+    oldest = client.get(f"{url}&order=asc").get_json()
+    assert [msg['message'] for msg in oldest['messages']] == ['Hello 0', 'Hello 1']
+    assert client.get('/api/contacts/999999/messages').status_code == 404
+
+
+def test_snapshot_round_trip_and_catch_up(tmp_path):
+    """Test a snapshot restores every store and index, then takes later stored changes"""
+    from snapshot import open_snapshot, write_snapshot
+    store = Storage(str(tmp_path / 'sms.db'))
+    repo = Repository(store)
+    repo.load(contacts=[{'id': 1, 'name': 'Ann Lee', 'phone': '+15550000001', 'messages': 0,
+                        'created_at': '2025-01-01T00:00:00', 'tags': ['vip']}])
+    for number in range(10, 60, 10):
+        msg = Message(phone=f'+1555000000{number % 3}', message=f'Hello {number}', message_id=number)
+        repo.add_message(msg)
+    repo.update_message(repo.message_index.get(20), status='failed')
+    repo.add_scheduled({'phone': '+15550000001', 'message': 'Later', 'scheduled_time': '2099-01-01T10:00:00',
+                        'created_at': '2025-01-01T00:00:00', 'status': 'scheduled'})
+    repo.add_template({'name': 'Hi', 'body': 'Hi {name}', 'created_at': '2025-01-01T00:00:00'})
+    store.flush()
+    path = str(tmp_path / 'sms.snapshot')
+    write_snapshot(path, repo.dump(), {'synced': store.synced})
+    snapshotted = [msg.to_dict() for msg in repo.messages]
+
+    # Stored after the snapshot: a new message, a status change and a contact edit
+    repo.add_message(Message(phone='+15550000009', message='After', message_id=70))
+    repo.update_message(repo.message_index.get(10), delivery_status='delivered')
+    repo.update_contact(repo.contact_index.get(1), tags=['vip', 'new'])
+    store.flush()
+
+    snapshot = open_snapshot(path)
+    restored = Repository(store)
+    restored.restore(snapshot.sections)
+    assert [msg.to_dict() for msg in restored.messages] == snapshotted
+    assert [msg.id for msg in restored.message_index.query(status='failed')[0]] == [20]
+    assert restored.contact_index.search('ann')[0] == 1
+    assert restored.scheduled[0]['message'] == 'Later' and restored.templates[1]['body'] == 'Hi {name}'
+
+    since = snapshot.meta['synced']
+    added, delivery_changes = restored.catch_up(store.load_messages(since), store.load_contacts(since),
+                                                store.load_scheduled(since), store.load_templates(since))
+    assert [msg.id for msg in added] == [70]
+    assert [(msg.id, old) for msg, old in delivery_changes] == [(10, 'pending')]
+    assert [msg.to_dict() for msg in restored.messages] == [msg.to_dict() for msg in repo.messages]
+    assert [msg.id for msg in restored.message_index.query(phone='+15550000009')[0]] == [70]
+    assert restored.tag_index.query('new') == repo.tag_index.query('new')
+
+    # Rows the restored log cannot append in order are refused
+    store.save_message(Message(phone='+15550000001', message='Out of order', message_id=15))
+    store.flush()
+    again = Repository(store)
+    again.restore(snapshot.sections)
+    assert again.catch_up(store.load_messages(since)) is None
+    assert len(again.messages) == 5
+    store.close()
+
+    with open(path, 'r+b') as f:
+        f.write(b'garbage')
+    assert open_snapshot(path) is None
+
+
+JOURNAL_WRITER = """
+import sys, threading
+from journal import Journal
+from models import Message
+from repository import Repository
+
+journal = Journal(sys.argv[1], commit_window=0.005)
+journal.start()
+repo = Repository(journal=journal)
+
+def send(first):
+    for number in range(first, first + 25):
+        repo.add_message(Message(phone='+15550000001', message=f'Hello {number}'))
+        journal.wait()
+
+threads = [threading.Thread(target=send, args=(first,)) for first in range(0, 200, 25)]
+for thread in threads:
+    thread.start()
+for thread in threads:
+    thread.join()
+repo.update_message(repo.message_index.get(3), status='sent')
+repo.add_contact({'name': 'Ann Lee', 'phone': '+15550000001', 'tags': ['vip']})
+journal.wait()
+print(journal.records, journal.commits)
+"""
+
+
+def test_journal_recovers_acknowledged_changes(tmp_path):
+    """Test group commit shares fsyncs, and a crashed writer's changes are recovered and compacted"""
+    import subprocess
+    import sys
+    from journal import Journal
+    directory = str(tmp_path / 'journal')
+    # The writer exits without stopping its journal, as a crash would
+    result = subprocess.run([sys.executable, '-c', JOURNAL_WRITER, directory], capture_output=True,
+                            text=True, cwd=os.path.dirname(os.path.abspath(__file__)), check=True)
+    records, commits = map(int, result.stdout.split())
+    assert records == 202 and commits < records
+    segment = next(name for name in os.listdir(directory) if name.endswith('.journal'))
+    with open(os.path.join(directory, segment), 'ab') as f:
+        f.write(b'\x10\x00\x00\x00torn')
+
+    journal = Journal(directory)
+    recovered = journal.recover()
+    assert [row['id'] for row in recovered['messages']] == list(range(1, 201))
+    assert recovered['messages'][2]['status'] == 'sent'
+    assert recovered['contacts'][0]['tags'] == ['vip']
+    # Processes still running are left alone
+    assert Journal(directory).recover() == {}
+
+    repo = Repository()
+    added, _ = repo.catch_up(messages=recovered['messages'], contacts=recovered['contacts'])
+    assert len(added) == 200 and repo.message_index.get(3).status == 'sent'
+    assert repo.get_contact_by_phone('+15550000001')['name'] == 'Ann Lee'
+
+    checkpoints = []
+    assert journal.compact(lambda: checkpoints.append(True)) == 2
+    assert checkpoints and not any(name.startswith(segment.split('-')[0]) for name in os.listdir(directory))
+    journal.stop(checkpoint=lambda: None)
+    assert Journal(directory).recover() == {}
+
+
+def test_receipts_journaled_before_acknowledged(client, monkeypatch, tmp_path):
+    """Acknowledged receipts are journaled, and unmatched ones survive compaction"""
+    from journal import Journal
+    directory = str(tmp_path / 'journal')
+    journal = Journal(directory)
+    journal.start()
+    monkeypatch.setattr(app_module, 'journal', journal)
+    response = client.post('/api/sms/receipts', json={'receipts': [
+        {'provider_message_id': 'SM-journaled', 'status': 'delivered'}
+    ]}, headers=WEBHOOK_HEADERS)
+    assert response.status_code == 202
+    journal.wait()
+    
+    # It matches no message yet, so the checkpoint journals it again in the new segment
+    journal.compact(app_module.checkpoint)
+    assert ('SM-journaled', 'delivered') in [receipt[:2] for receipt in app_module.receipts.unmatched()]
+    # Stopped without a checkpoint and unlocked, as a crash leaves it
+    journal.stop()
+    journal._lock_file.close()
+    recovered = Journal(directory).recover()
+    assert ('SM-journaled', 'delivered') in [receipt[:2] for receipt in recovered['receipts']]
+
+
+def test_checkpoint_fsyncs_database(tmp_path, monkeypatch):
+    """The checkpoint before journal segments are deleted fsyncs the database and its WAL"""
+    import storage as storage_module
+    synced = []
+    monkeypatch.setattr(storage_module, '_fsync_file', synced.append)
+    path = str(tmp_path / 'sms.db')
+    store = Storage(path)
+    store.save_template({'id': 1, 'name': 'Hi', 'body': 'Hi', 'created_at': '2025-01-01T00:00:00'})
+    store.sync()
+    assert synced == [path + '-wal', path]
+    assert store.load_templates()[0]['name'] == 'Hi'
+    store.close()
+    
+    from journal import Journal
+    journal = Journal(str(tmp_path / 'journal'))
+    journal.start()
+    monkeypatch.setattr(app_module, 'journal', journal)
+    calls = []
+    monkeypatch.setattr(app_module.storage, 'sync', lambda: calls.append('sync'))
+    monkeypatch.setattr(app_module.storage, 'flush', lambda: calls.append('flush'))
+    assert journal.compact(app_module.checkpoint) == 1
+    assert calls == ['sync']
+    journal.stop()
+
+
+SCHEDULER_WORKER = """
+import sys, time
+import app as app_module
+
+entry = app_module.repository.get_scheduled(int(sys.argv[1]))
+deadline = time.time() + 10
+while entry['status'] == 'scheduled' and time.time() < deadline:
+    time.sleep(0.05)
+app_module.storage.flush()
+print(entry['status'], sum(1 for msg in app_module.messages if msg.message == 'Sent once'))
+"""
+
+
+def test_scheduled_message_sent_once_by_concurrent_workers(tmp_path):
+    """Test workers sharing a database all dispatch a due entry, and exactly one of them sends it"""
+    import subprocess
+    import sys
+    import time
+    from utils import format_utc
+    path = str(tmp_path / 'shared.db')
+    store = Storage(path)
+    store.save_scheduled({'id': 1, 'phone': '+15550001234', 'message': 'Sent once',
+                          'scheduled_time': '2030-01-01T00:00:00', 'created_at': '2024-01-01T00:00:00',
+                          'status': 'scheduled', 'sent_at': None, 'scheduled_at': format_utc(time.time() + 2)})
+    store.close()
+
+    env = {**os.environ, 'FLASK_ENV': 'production', 'DATABASE_URL': f'sqlite:///{path}', 'SMS_PROVIDER': 'none',
+           'RATE_LIMIT_ENABLED': 'false', 'SNAPSHOT_PATH': '', 'JOURNAL_DIR': ''}
+    workers = [subprocess.Popen([sys.executable, '-c', SCHEDULER_WORKER, '1'], env=env, stdout=subprocess.PIPE,
+                                text=True, cwd=os.path.dirname(os.path.abspath(__file__)))
+               for _ in range(2)]
+    results = sorted(worker.communicate(timeout=30)[0].split() for worker in workers)
+    # The loser sees the claim of the winner instead of sending
+    assert [int(sent) for _, sent in results] == [0, 1]
+    assert 'scheduled' not in [status for status, _ in results]
+
+    store = Storage(path)
+    assert [row['message'] for row in store.load_messages()] == ['Sent once']
+    assert store.load_scheduled()[0]['status'] == 'sent'
+    store.close()
+
+
 if __name__ == '__main__':
     pytest.main([__file__, '-v'])
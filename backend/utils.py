@@ -3,9 +3,29 @@ SMS Platform - Utility Functions
 Helper functions for validation, formatting, and processing
 """
 
+import csv
+import json
 import re
-from datetime import datetime
-from typing import Optional, Tuple
+from datetime import datetime, timezone
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple
+
+PHONE_CLEAN_RE = re.compile(r'[^\d+]')
+PHONE_FORMAT_RE = re.compile(r'^\+\d{10,15}$')
+CONTROL_CHARS_RE = re.compile(r'[\x00-\x09\x0b-\x1f]')
+
+# GSM 03.38 default alphabet and its extension table (escape + char, two septets)
+GSM7_BASIC = (
+    '@£$¥èéùìòÇ\nØø\rÅåΔ_ΦΓΛΩΠΨΣΘΞÆæßÉ !"#¤%&\'()*+,-./0123456789:;<=>?'
+    '¡ABCDEFGHIJKLMNOPQRSTUVWXYZÄÖÑÜ§¿abcdefghijklmnopqrstuvwxyzäöñüà'
+)
+GSM7_EXTENSION = frozenset('\f^{}\\[~]|€')
+GSM7_DELETE_TABLE = str.maketrans('', '', GSM7_BASIC + ''.join(GSM7_EXTENSION))
+GSM7_EXTENSION_DELETE_TABLE = str.maketrans('', '', ''.join(GSM7_EXTENSION))
+
+GSM7 = 'GSM-7'
+UCS2 = 'UCS-2'
+# (single segment limit, per-segment limit when concatenated)
+SEGMENT_LIMITS = {GSM7: (160, 153), UCS2: (70, 67)}
 
 def validate_phone_number(phone: str) -> Tuple[bool, Optional[str]]:
     """
@@ -16,10 +36,10 @@ def validate_phone_number(phone: str) -> Tuple[bool, Optional[str]]:
         return False, "Phone number is required"
     
     # Remove all non-digit characters except +
-    cleaned = re.sub(r'[^\d+]', '', phone)
+    cleaned = PHONE_CLEAN_RE.sub('', phone)
     
     # Check if it starts with + and has 10-15 digits
-    if not re.match(r'^\+\d{10,15}$', cleaned):
+    if not PHONE_FORMAT_RE.match(cleaned):
         return False, "Phone number must be in format: +1234567890 (10-15 digits)"
     
     return True, None
@@ -47,42 +67,192 @@ def format_phone_number(phone: str) -> str:
     Format phone number to standard format
     """
     # Remove all non-digit characters except +
-    cleaned = re.sub(r'[^\d+]', '', phone)
+    cleaned = PHONE_CLEAN_RE.sub('', phone)
     return cleaned
 
 
-def calculate_message_segments(message: str) -> int:
+def analyze_message(message: str) -> Tuple[str, int, int]:
     """
-    Calculate how many SMS segments are needed for the message
-    Standard SMS: 160 characters per segment
-    Unicode SMS: 70 characters per segment
+    Work out the encoding, length and segment count of an SMS body.
+    GSM-7 is used when every character is in the GSM 03.38 alphabet (extension
+    characters such as { } [ ] ~ \\ ^ | € take two septets), otherwise UCS-2
+    (characters outside the BMP take two units). Concatenated messages carry a
+    header, leaving 153 septets or 67 UCS-2 units per segment.
+    Returns: (encoding, units, segments)
     """
-    # Check if message contains unicode characters
-    try:
-        message.encode('ascii')
-        is_unicode = False
-    except UnicodeEncodeError:
-        is_unicode = True
+    if not message:
+        return GSM7, 0, 0
     
-    segment_length = 70 if is_unicode else 160
-    message_length = len(message)
+    # str.translate runs the table lookups in C, one pass per table
+    if message.translate(GSM7_DELETE_TABLE):
+        encoding = UCS2
+        units = len(message.encode('utf-16-le')) // 2
+    else:
+        encoding = GSM7
+        units = 2 * len(message) - len(message.translate(GSM7_EXTENSION_DELETE_TABLE))
     
-    if message_length == 0:
+    return encoding, units, count_segments(encoding, units)
+
+
+def count_segments(encoding: str, units: int) -> int:
+    """Segments needed for `units` septets (GSM-7) or UCS-2 code units"""
+    if not units:
         return 0
+    single, multi = SEGMENT_LIMITS[encoding]
+    if units <= single:
+        return 1
+    return (units + multi - 1) // multi
+
+
+def split_message_segments(message: str) -> List[Tuple[int, int]]:
+    """
+    Split an SMS body into the segments a handset would receive.
+    Two-septet GSM characters and surrogate pairs are never split.
+    Returns: list of (start, end) character offsets into the message
+    """
+    encoding, units, segments = analyze_message(message)
+    if segments <= 1:
+        return [(0, len(message))] if message else []
+    
+    limit = SEGMENT_LIMITS[encoding][1]
+    if encoding == GSM7:
+        widths = [2 if char in GSM7_EXTENSION else 1 for char in message]
+    else:
+        widths = [2 if ord(char) > 0xFFFF else 1 for char in message]
     
-    return (message_length + segment_length - 1) // segment_length
+    boundaries = []
+    start = 0
+    used = 0
+    for index, width in enumerate(widths):
+        if used + width > limit:
+            boundaries.append((start, index))
+            start = index
+            used = 0
+        used += width
+    boundaries.append((start, len(message)))
+    return boundaries
+
+
+def calculate_message_segments(message: str) -> int:
+    """
+    Calculate how many SMS segments are needed for the message
+    GSM-7 SMS: 160 septets in one segment, 153 per concatenated segment
+    Unicode (UCS-2) SMS: 70 units in one segment, 67 per concatenated segment
+    """
+    return analyze_message(message)[2]
+
+
+def calculate_segments_batch(messages: Iterable[str]) -> List[int]:
+    """
+    Segment counts for many bodies at once; each distinct body is analysed once
+    """
+    cache: Dict[str, int] = {}
+    results = []
+    for message in messages:
+        segments = cache.get(message)
+        if segments is None:
+            segments = cache[message] = analyze_message(message)[2]
+        results.append(segments)
+    return results
 
 
-def estimate_cost(message: str, recipient_count: int = 1) -> float:
+def estimate_cost(message: str, recipient_count: int = 1, segments: int = None) -> float:
     """
     Estimate the cost of sending a message
     (Mock pricing: $0.01 per segment per recipient)
+    Pass `segments` when already known to skip re-analysing the body.
     """
-    segments = calculate_message_segments(message)
+    if segments is None:
+        segments = calculate_message_segments(message)
     cost_per_segment = 0.01
     return segments * recipient_count * cost_per_segment
 
 
+def validate_batch(entries: List[Tuple[str, str]]) -> List[Tuple[Optional[str], Optional[str], Optional[str]]]:
+    """
+    Validate, format and sanitize a batch of (phone, message) pairs in one pass.
+    Repeated phones and bodies are only validated once.
+    Returns: list of (phone, message, error_message) in input order
+    """
+    phone_cache: Dict[str, Tuple[Optional[str], Optional[str]]] = {}
+    message_cache: Dict[str, Tuple[Optional[str], Optional[str]]] = {}
+    results = []
+    
+    for phone, message in entries:
+        if not isinstance(phone, str) or not isinstance(message, str):
+            results.append((None, None, "Phone and message must be strings"))
+            continue
+        
+        phone_result = phone_cache.get(phone)
+        if phone_result is None:
+            is_valid, error = validate_phone_number(phone)
+            phone_result = (format_phone_number(phone), None) if is_valid else (None, error)
+            phone_cache[phone] = phone_result
+        
+        message_result = message_cache.get(message)
+        if message_result is None:
+            is_valid, error = validate_message_content(message)
+            message_result = (sanitize_input(message), None) if is_valid else (None, error)
+            message_cache[message] = message_result
+        
+        error = phone_result[1] or message_result[1]
+        if error:
+            results.append((None, None, error))
+        else:
+            results.append((phone_result[0], message_result[0], None))
+    
+    return results
+
+
+def iter_contact_rows(lines: Iterable[str], fmt: str) -> Iterator[Tuple[int, Optional[Dict], Optional[str]]]:
+    """
+    Lazily parse contact rows from CSV (header: name,phone[,tags]) or NDJSON lines.
+    CSV tags are separated by ';'. Nothing is read ahead of the current row.
+    Yields: (line_number, row, error_message)
+    """
+    if fmt == 'csv':
+        reader = csv.DictReader(lines)
+        for row in reader:
+            tags = row.get('tags') or ''
+            yield reader.line_num, {
+                'name': row.get('name') or '',
+                'phone': row.get('phone') or '',
+                'tags': [tag.strip() for tag in tags.split(';') if tag.strip()]
+            }, None
+        return
+    
+    for line_number, line in enumerate(lines, start=1):
+        if not line.strip():
+            continue
+        try:
+            row = json.loads(line)
+        except ValueError:
+            yield line_number, None, "Invalid JSON"
+            continue
+        if not isinstance(row, dict):
+            yield line_number, None, "Row must be a JSON object"
+            continue
+        tags = row.get('tags') or []
+        yield line_number, {
+            'name': str(row.get('name') or ''),
+            'phone': str(row.get('phone') or ''),
+            'tags': tags if isinstance(tags, list) else [tags]
+        }, None
+
+
+def parse_timestamp(value: str) -> float:
+    """
+    Parse an ISO timestamp to epoch seconds.
+    Naive timestamps are treated as server local time; raises ValueError.
+    """
+    return datetime.fromisoformat(value.replace('Z', '+00:00')).timestamp()
+
+
+def format_utc(epoch: float) -> str:
+    """Epoch seconds to an ISO timestamp in UTC, e.g. 2099-01-01T10:00:00Z"""
+    return datetime.fromtimestamp(epoch, timezone.utc).isoformat().replace('+00:00', 'Z')
+
+
 def parse_scheduled_time(scheduled_time: str) -> Tuple[bool, Optional[str]]:
     """
     Validate and parse scheduled time
@@ -92,14 +262,12 @@ def parse_scheduled_time(scheduled_time: str) -> Tuple[bool, Optional[str]]:
         return False, "Scheduled time is required"
     
     try:
-        scheduled_dt = datetime.fromisoformat(scheduled_time.replace('Z', '+00:00'))
-        now = datetime.now()
-        
-        if scheduled_dt <= now:
+        # Compare as epoch seconds so offset-aware times ("...Z") work too
+        if parse_timestamp(scheduled_time) <= datetime.now().timestamp():
             return False, "Scheduled time must be in the future"
         
         return True, None
-    except ValueError:
+    except (ValueError, TypeError, AttributeError):
         return False, "Invalid date format. Use ISO format: YYYY-MM-DDTHH:MM:SS"
 
 
@@ -113,8 +281,8 @@ def sanitize_input(text: str) -> str:
     # Remove any potentially harmful characters
     sanitized = text.strip()
     
-    # Remove control characters
-    sanitized = ''.join(char for char in sanitized if ord(char) >= 32 or char == '\n')
+    # Remove control characters (newlines are kept)
+    sanitized = CONTROL_CHARS_RE.sub('', sanitized)
     
     return sanitized
 